@@ -0,0 +1,422 @@
+"""
+Benchmarks for layout.py on synthetic crease patterns of growing size.
+
+    python benchmark.py --patterns miura waterbomb --sizes 2 4 8 --output out.json
+
+Each generator takes a size parameter and returns (node_list, crease_list,
+crease_types, drivers), where drivers holds driving crease angles for
+solve_pattern.  For every pattern and size, the stages load_creasepattern,
+get_neighbors, solve_node (over every interior node), solve_pattern,
+search_pattern, triangulate_pattern and propagate_frames are timed
+separately, and the results are written as JSON.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import timeit
+import argparse
+import platform
+import tempfile
+import unittest
+
+import numpy as np
+
+import layout
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def _boundary_creases(node_list, boundary):
+    """
+    Creases joining the nodes listed in boundary around the edge of the
+    paper, in order of angle about the center of the paper.
+    """
+    boundary = np.array(boundary)
+    center = np.mean(node_list[boundary], axis=0)
+    d = node_list[boundary] - center
+    boundary = boundary[np.argsort(np.arctan2(d[:,1], d[:,0]))]
+    return np.array([boundary, np.roll(boundary, -1)]).T
+
+
+def miura_ori(size, angle=70.0, height=1.0):
+    """
+    A Miura-ori grid of size by size parallelograms.  The zigzag creases
+    lean by (90 - angle) degrees; the two columns at the edge of the paper
+    are straight, so the paper stays rectangular.  Driven by one crease, in
+    the direction that agrees with the mountain/valley labels.
+    """
+    shift = height / np.tan(angle * np.pi / 180)
+    index = {}
+    nodes = []
+    for j in range(size + 1):
+        for i in range(size + 1):
+            x = i + (shift if (j % 2 == 1 and 0 < i < size) else 0)
+            index[(i, j)] = len(nodes)
+            nodes.append((x, j * height))
+    node_list = np.array(nodes, dtype='float64')
+    creases = []
+    crease_types = []
+    for j in range(size + 1):
+        for i in range(size + 1):
+            if i < size:
+                creases.append((index[(i, j)], index[(i + 1, j)]))
+                crease_types.append('' if j in (0, size) else 'MV'[(i + j + 1) % 2])
+            if j < size:
+                creases.append((index[(i, j)], index[(i, j + 1)]))
+                crease_types.append('' if i in (0, size) else 'MV'[i % 2])
+    crease_list = np.array(creases)
+    a, b = index[(1, 1)], index[(2, 1)] if size > 2 else index[(1, 2)]
+    drivers = {(a, b): 150.0}
+    return node_list, crease_list, crease_types, drivers
+
+
+def waterbomb_grid(size):
+    """
+    size by size copies of the waterbomb base in test.creasepattern, side by
+    side.  Driven by the creases around every center node, each as the one
+    in demo.foo3.
+    """
+    n = 2 * size + 1
+    node_list = np.array([(i, j) for j in range(n) for i in range(n)],
+        dtype='float64') / (n - 1)
+    index = lambda i, j: j * n + i
+    creases = []
+    for j in range(n):
+        for i in range(n):
+            if i < n - 1:
+                creases.append((index(i, j), index(i + 1, j)))
+            if j < n - 1:
+                creases.append((index(i, j), index(i, j + 1)))
+    for cj in range(size):
+        for ci in range(size):
+            center = index(2 * ci + 1, 2 * cj + 1)
+            for di, dj in [(-1, -1), (1, -1), (1, 1), (-1, 1)]:
+                creases.append((index(2 * ci + 1 + di, 2 * cj + 1 + dj), center))
+    crease_list = np.array(creases)
+    crease_types = [''] * len(creases)
+
+    neighbors, neighbor_angles = layout.get_neighbors(node_list, crease_list)
+    drivers = {}
+    angle = 15
+    for cj in range(size):
+        for ci in range(size):
+            center = index(2 * ci + 1, 2 * cj + 1)
+            for j, crease_angle in zip(neighbors[center],
+                    [angle, 180, angle, None, angle, 180, angle, None]):
+                if crease_angle is not None:
+                    drivers[(center, j)] = crease_angle
+    return node_list, crease_list, crease_types, drivers
+
+
+def square_twist(size, twist=20.0, half_width=0.25):
+    """
+    A square twist tessellation: a size by size grid of squares, each turned
+    by twist degrees, joined by parallelogram pleats, with twisted squares
+    between every four of them.  Pleats at the edge run out to the boundary
+    of the (rectangular) paper.  Driven by one crease of the first square.
+    """
+    t = twist * np.pi / 180
+    R = np.array([[np.cos(t), -np.sin(t)], [np.sin(t), np.cos(t)]])
+    corners = [(-1, -1), (1, -1), (1, 1), (-1, 1)]
+    nodes = []
+    index = {}
+    for j in range(size):
+        for i in range(size):
+            center = np.array([i + 0.5, j + 0.5])
+            for k, c in enumerate(corners):
+                index[(i, j, k)] = len(nodes)
+                nodes.append(center + R.dot(np.array(c) * half_width))
+    creases = []
+    boundary = []
+    def to_edge(k, d):
+        # Run a pleat from node k in direction d out to the edge of the paper
+        p = nodes[k]
+        s = [(bound - p[axis]) / d[axis] for axis in (0, 1)
+            for bound in (0, size) if d[axis] != 0]
+        s = min(x for x in s if x > 0)
+        boundary.append(len(nodes))
+        creases.append((k, len(nodes)))
+        nodes.append(p + s * d)
+
+    for j in range(size):
+        for i in range(size):
+            for k in range(4):
+                creases.append((index[(i, j, k)], index[(i, j, (k + 1) % 4)]))
+            # Horizontal pleats join corners 1, 2 to corners 0, 3 on the right
+            for k, m in [(1, 0), (2, 3)]:
+                a = index[(i, j, k)]
+                if i + 1 < size:
+                    creases.append((a, index[(i + 1, j, m)]))
+                else:
+                    to_edge(a, nodes[index[(0, 0, m)]] + [1, 0] - nodes[index[(0, 0, k)]])
+                if i == 0:
+                    to_edge(index[(i, j, m)], nodes[index[(0, 0, k)]] - [1, 0] - nodes[index[(0, 0, m)]])
+            # Vertical pleats join corners 3, 2 to corners 0, 1 above
+            for k, m in [(3, 0), (2, 1)]:
+                a = index[(i, j, k)]
+                if j + 1 < size:
+                    creases.append((a, index[(i, j + 1, m)]))
+                else:
+                    to_edge(a, nodes[index[(0, 0, m)]] + [0, 1] - nodes[index[(0, 0, k)]])
+                if j == 0:
+                    to_edge(index[(i, j, m)], nodes[index[(0, 0, k)]] - [0, 1] - nodes[index[(0, 0, m)]])
+
+    for corner in [(0, 0), (size, 0), (size, size), (0, size)]:
+        boundary.append(len(nodes))
+        nodes.append(np.array(corner, dtype='float64'))
+    node_list = np.array(nodes)
+    crease_list = np.concatenate([np.array(creases),
+        _boundary_creases(node_list, boundary)])
+    crease_types = [''] * crease_list.shape[0]
+    drivers = {(index[(0, 0, 0)], index[(0, 0, 1)]): 170.0}
+    return node_list, crease_list, crease_types, drivers
+
+
+def random_vertex(size, seed=0):
+    """
+    One interior node with size creases in random directions (no gap
+    between them over 150 degrees), out to nodes on a unit circle.  All but
+    three creases are driven, at random angles near flat.
+    """
+    rng = np.random.RandomState(seed)
+    while True:
+        theta = np.sort(rng.uniform(0, 360, size))
+        gaps = np.diff(np.concatenate([theta, theta[:1] + 360]))
+        if np.amax(gaps) < 150:
+            break
+    theta = theta * np.pi / 180
+    node_list = np.concatenate([[[0, 0]],
+        np.array([np.cos(theta), np.sin(theta)]).T])
+    outer = np.arange(1, size + 1)
+    crease_list = np.concatenate([np.array([np.zeros(size, dtype='int'),
+        outer]).T, np.array([outer, np.roll(outer, -1)]).T])
+    crease_types = [''] * crease_list.shape[0]
+    drivers = dict(((0, j), 180 + rng.uniform(-5, 5)) for j in outer[:size - 3])
+    return node_list, crease_list, crease_types, drivers
+
+
+generators = {
+    'miura': miura_ori,
+    'waterbomb': waterbomb_grid,
+    'square_twist': square_twist,
+    'random_vertex': random_vertex,
+}
+
+
+def write_creasepattern(filename, node_list, crease_list, crease_types):
+    """Write a crease pattern in the text format read by load_creasepattern."""
+    with open(filename, 'w') as f:
+        f.write('begin nodes\n')
+        for x, y in node_list:
+            f.write('%r %r\n' % (float(x), float(y)))
+        f.write('begin creases\n')
+        for (a, b), t in zip(crease_list, crease_types):
+            f.write(('%d %d %s\n' % (a, b, t)).rstrip() + '\n')
+
+
+def measure(f, repeat):
+    """
+    Run f repeat times.  Returns (result, seconds, peak_bytes): the last
+    result, the fastest time, and the most memory allocated at once while
+    running it (None without tracemalloc).
+    """
+    best = None
+    for i in range(repeat):
+        start = timeit.default_timer()
+        result = f()
+        seconds = timeit.default_timer() - start
+        if best is None or seconds < best:
+            best = seconds
+    peak = None
+    if tracemalloc is not None:
+        tracemalloc.start()
+        f()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return result, best, peak
+
+
+def _solved_nodes(known_creases, nodes, neighbors):
+    """The number of the given nodes with all their creases known."""
+    return len([i for i in nodes
+        if all((i, j) in known_creases for j in neighbors[i])])
+
+
+def benchmark_pattern(name, size, repeat=3, directory=None):
+    """
+    Time each stage on the pattern made by generators[name](size).  Returns
+    a dict with the pattern's size, and for each stage the fastest time in
+    seconds, the throughput in items per second (nodes, nodes actually
+    solved, or triangles, as appropriate), and the peak memory in bytes.
+    """
+    node_list, crease_list, crease_types, drivers = generators[name](size)
+    record = {'pattern': name, 'size': size, 'nodes': node_list.shape[0],
+        'creases': crease_list.shape[0], 'stages': {}}
+    def add(stage, seconds, peak, items):
+        record['stages'][stage] = {'seconds': seconds, 'peak_bytes': peak,
+            'items': items,
+            'per_second': items / seconds if seconds > 0 else None}
+
+    cleanup = directory is None
+    if directory is None:
+        directory = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(directory, '%s_%d.creasepattern' % (name, size))
+        write_creasepattern(filename, node_list, crease_list, crease_types)
+        result, seconds, peak = measure(
+            lambda: layout.load_creasepattern(filename), repeat)
+        add('load_creasepattern', seconds, peak, node_list.shape[0])
+    finally:
+        if cleanup:
+            shutil.rmtree(directory)
+
+    (neighbors, neighbor_angles), seconds, peak = measure(
+        lambda: layout.get_neighbors(node_list, crease_list), repeat)
+    add('get_neighbors', seconds, peak, node_list.shape[0])
+
+    # Every interior node, with all but three creases flat
+    interior = np.nonzero(~layout.get_boundary_nodes(node_list))[0]
+    problems = [(neighbor_angles[i],
+        [180.0] * (len(neighbors[i]) - 3) + [None] * 3) for i in interior]
+    def solve_nodes():
+        return [layout.solve_node(a, c) for a, c in problems]
+    result, seconds, peak = measure(solve_nodes, repeat)
+    add('solve_node', seconds, peak, len(problems))
+
+    solved = []
+    def solve():
+        del solved[:]
+        return layout.solve_pattern(node_list, crease_list, dict(drivers),
+            neighbors, neighbor_angles, record=solved)
+    known_creases, seconds, peak = measure(solve, repeat)
+    add('solve_pattern', seconds, peak, len(solved))
+    if not isinstance(known_creases, dict):
+        record['solve_error'] = known_creases
+
+    def search():
+        return layout.search_pattern(node_list, crease_list, dict(drivers),
+            crease_types, neighbors, neighbor_angles)
+    solutions, seconds, peak = measure(search, repeat)
+    add('search_pattern', seconds, peak, _solved_nodes(solutions[0], interior,
+        neighbors) if len(solutions) > 0 else 0)
+    if len(solutions) > 0:
+        known_creases = solutions[0]
+    elif not isinstance(known_creases, dict):
+        known_creases = dict(drivers)
+    record['solved_creases'] = len([e for e in known_creases if e[0] < e[1]])
+
+    def triangulate():
+        layout._triangulations.clear()
+        return layout.triangulate_pattern(node_list, crease_list)
+    t, seconds, peak = measure(triangulate, repeat)
+    triangles = t['triangles']
+    add('triangulate_pattern', seconds, peak, triangles.shape[0])
+    record['triangles'] = triangles.shape[0]
+
+    table = layout.make_crease_table(t['vertices'], crease_list, triangles)
+    for edge, angle in known_creases.items():
+        if edge in table:
+            table[edge] = angle
+    layout.add_flat_creases(table, triangles)
+    plan = layout.build_traversal_plan(t['vertices'], triangles)
+    result, seconds, peak = measure(lambda: layout.propagate_frames(
+        t['vertices'], triangles, table, plan=plan, by_level=True), repeat)
+    add('propagate_frames', seconds, peak, triangles.shape[0])
+    return record
+
+
+def run(names, sizes, repeat=3):
+    """Benchmark every pattern in names at every size.  Returns a dict."""
+    results = []
+    for name in names:
+        for size in sizes[name] if isinstance(sizes, dict) else sizes:
+            results.append(benchmark_pattern(name, size, repeat))
+    report = {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'results': results,
+    }
+    if resource is not None:
+        # Peak resident memory of the whole run, in kilobytes on Linux
+        report['max_rss'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return report
+
+
+class TestGenerators(unittest.TestCase):
+    def test1(self):
+        # Every pattern is a valid crease pattern: the sector angles around
+        # each interior node add to 360 degrees, and the creases split the
+        # paper into faces that can be triangulated.
+        for name in sorted(generators):
+            for size in (3, 4):
+                node_list, crease_list, crease_types, drivers = \
+                    generators[name](size)
+                self.assertEqual(len(crease_types), crease_list.shape[0])
+                layout.get_neighbors_csr(node_list, crease_list, check=True)
+                faces = layout.triangulate_faces(node_list, crease_list)
+                self.assertTrue(faces.shape[0] > 0)
+                for a, b in drivers:
+                    self.assertTrue(np.any(np.all(crease_list == [a, b], axis=1)
+                        | np.all(crease_list == [b, a], axis=1)))
+
+    def test2(self):
+        # Miura-ori folds rigidly from one driving crease, following its
+        # mountain/valley labels
+        node_list, crease_list, crease_types, drivers = miura_ori(4)
+        solutions = layout.search_pattern(node_list, crease_list, drivers,
+            crease_types)
+        self.assertEqual(len(solutions), 1)
+        interior = ~layout.get_boundary_nodes(node_list)
+        solved = set(a for a, b in solutions[0])
+        self.assertTrue(set(np.nonzero(interior)[0]) <= solved)
+
+    def test3(self):
+        report = run(['random_vertex', 'miura'], [3], repeat=1)
+        report = json.loads(json.dumps(report))
+        self.assertEqual(len(report['results']), 2)
+        for record in report['results']:
+            for stage in ['load_creasepattern', 'get_neighbors', 'solve_node',
+                    'solve_pattern', 'search_pattern', 'triangulate_pattern',
+                    'propagate_frames']:
+                self.assertTrue(record['stages'][stage]['seconds'] >= 0)
+
+    def test4(self):
+        # Throughput counts only the nodes that were solved
+        for size, solved in [(1, 1), (2, 6)]:
+            record = benchmark_pattern('waterbomb', size, repeat=1)
+            self.assertEqual(record['stages']['solve_pattern']['items'], solved)
+            self.assertEqual(record['stages']['search_pattern']['items'], solved)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--patterns', nargs='+', default=sorted(generators),
+        choices=sorted(generators))
+    parser.add_argument('--sizes', nargs='+', type=int, default=[2, 4, 8, 16])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', help='JSON file (default: standard output)')
+    args = parser.parse_args(argv)
+    # random_vertex's size is the degree of the node, at least 3
+    sizes = dict((name, [max(s, 3) if name == 'random_vertex' else s
+        for s in args.sizes]) for name in args.patterns)
+    report = run(args.patterns, sizes, args.repeat)
+    if args.output is None:
+        json.dump(report, sys.stdout, indent=1, sort_keys=True)
+        sys.stdout.write('\n')
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=1, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+"""
+Plotting and demos for layout.py.  Kept apart from the solver so that
+importing layout does not pull in matplotlib.
+"""
+import numpy as np
+import matplotlib.pyplot as mpl
+
+from layout import (load_creasepattern, get_neighbors, solve_node,
+    add_node_creases, profiling, FoldModel)
+
+
+def plot_creasepattern(node_list, crease_list, crease_types=None, triangles=None):
+    if crease_types == None:
+        crease_types = ['' for i in range(crease_list.shape[0])]
+    mpl.figure()
+    ax = mpl.subplot(1,1,1)
+    mpl.plot(node_list[:,0], node_list[:,1], '.b')
+    mpl.xlim((-0.05, 1.05))
+    mpl.ylim((-0.05, 1.05))
+    offset = 0.01
+    for i in range(node_list.shape[0]):
+        mpl.text(node_list[i,0]+offset, node_list[i,1]+offset, '%d' % i)
+
+    for i, t in enumerate(crease_types):
+        # range(crease_list.shape[0]):
+        x = node_list[crease_list[i,:],0]
+        y = node_list[crease_list[i,:],1]
+        #print(t.upper())
+        if t.upper() == 'M':
+            mpl.plot(x, y, 'k')
+        elif t.upper() == 'V':
+            mpl.plot(x, y, '--k')
+        else:
+            mpl.plot(x, y, 'b')
+
+    if triangles is not None:
+        for i in range(triangles.shape[0]):
+            mean_x = np.mean(node_list[triangles[i,:],0])
+            mean_y = np.mean(node_list[triangles[i,:],1])
+            mpl.text(mean_x, mean_y, '%d' % i)
+
+    ax.set_aspect('equal')
+    mpl.show()
+
+
+def foo():
+    node_list, crease_list, crease_types = load_creasepattern('test.creasepattern')
+    #print(node_list)
+    #print(crease_list)
+
+    neighbors, neighbor_angles = get_neighbors(node_list, crease_list)
+    #for i in range(len(neighbors)):
+    #    print(i)
+    #    print(neighbors[i])
+    #    print(neighbor_angles[i])
+
+    i = 4
+    print(neighbors[i])
+    print(neighbor_angles[i])
+
+    angle = 15
+    crease_angles = [angle, 180, angle, None, angle, 180, angle, None]
+    ans = solve_node(neighbor_angles[i], crease_angles)
+    print(ans)
+
+    crease_angles = ans[0]
+    known_creases = {}
+    known_creases = add_node_creases(known_creases, i, neighbors[i], crease_angles)
+    print(known_creases)
+
+    plot_creasepattern(node_list, crease_list, crease_types)
+
+
+def foo2():
+    # From http://dzhelil.info/triangle/delaunay.html
+    # (not my code)
+    import triangle
+    import triangle.plot as plot
+
+    face = triangle.get_data('face')
+    print(face)
+
+    ax1 = mpl.subplot(121, aspect='equal')
+    plot.plot(ax1, **face)
+
+    t = triangle.triangulate(face, 'p')
+
+    ax2 = mpl.subplot(122, sharex=ax1, sharey=ax1)
+    triangle.plot.plot(ax2, **t)
+
+    mpl.show()
+
+
+def foo3():
+    import triangle.plot as plot
+
+    node_list, crease_list, crease_types = load_creasepattern('test.creasepattern')
+    #print(node_list)
+    #print(crease_list)
+
+    paper = {}
+    paper['vertices'] = node_list
+    paper['segments'] = crease_list
+
+    ax1 = mpl.subplot(121, aspect='equal')
+    plot.plot(ax1, **paper)
+
+    with profiling() as profiler:
+        model = FoldModel(node_list, crease_list, crease_types,
+            cache_dir='.triangulations')
+        i = 4
+        angle = 15
+        crease_angles = [angle, 180, angle, None, angle, 180, angle, None]
+        drivers = {}
+        for j, crease_angle in zip(model.neighbors[i], crease_angles):
+            if crease_angle is not None:
+                drivers[(i, j)] = crease_angle
+        nodes3d = model.pose(drivers)
+    print(profiler.summary())
+
+    ax2 = mpl.subplot(122, sharex=ax1, sharey=ax1)
+    plot.plot(ax2, vertices=model.vertices, triangles=model.triangles)
+
+    nodes = model.vertices
+    triangles = model.triangles
+    #offset = 0.01
+    for i in range(triangles.shape[0]):
+        mean_x = np.mean(nodes[triangles[i,:],0])
+        mean_y = np.mean(nodes[triangles[i,:],1])
+        mpl.text(mean_x, mean_y, '%d' % i)
+
+    plot_creasepattern(nodes, crease_list, crease_types=crease_types, triangles=triangles)
+
+
+if __name__ == "__main__":
+    #foo()
+    #foo2()
+    foo3()
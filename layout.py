@@ -1,133 +1,524 @@
-import re
+import os
+import json
+import time
+import heapq
+import shutil
+import hashlib
 import numbers
+import functools
+import contextlib
+import collections
+import tempfile
 import unittest
-import copy
+import multiprocessing
 
 import numpy as np
-import matplotlib.pyplot as mpl
 
-def load_creasepattern(filename):
-    with open(filename) as f:
-        lines = f.readlines()
-        f.close()
 
-    read_nodes = False
-    read_creases = False
-    node_list = []
-    crease_list = []
-    crease_types = []
-    for line in lines:
-        if re.search('begin', line):
-            read_nodes = False 
-            read_creases = False 
-        if read_nodes:
-            a = line.split(None, 2)       
-            x = float(a[0])
-            y = float(a[1])
-            node_list.append((x, y))
-        if read_creases:
-            a = line.split(None, 2)       
-            a0 = int(a[0])
-            a1 = int(a[1])
-            if len(a) > 2:
-                crease_types.append(a[2].strip())
-            else:
-                crease_types.append('')
-            crease_list.append((a0, a1))
-        if re.search('begin nodes', line):
-            read_nodes = True
-        if re.search('begin creases', line):
-            read_creases = True
+# The active Profiler, if any; see profiling()
+_profiler = None
 
-    return (np.array(node_list), np.array(crease_list), crease_types)
 
+class Profiler(object):
+    """
+    Collects how long each stage of the solver takes and how often notable
+    events happen in it, while installed by profiling().
+
+    times and calls map stage names ('parse', 'neighbors', 'triangulate',
+    'solve', 'frames', 'refine') to the total seconds spent in them and the
+    number of calls.  Stages can nest (solve_frame runs 'solve' and then
+    'frames'), and each stage's time includes any stages inside it.  counts
+    maps event names to the number of times they happened:
+
+    node_solves        nodes solved by solve_pattern or search_pattern
+    branch_points      nodes where solve_node gave two solutions
+    branches           branches pushed by search_pattern
+    degenerate         zero length sides met in solve_node or solve_triangles
+    renorm             frames orthonormalized
+    triangulation_hits triangulations found in the cache
+    vertex_cache_hits  nodes solved from a table of a VertexSolutionCache
+
+    peaks maps names to the largest value seen; search_stack is the deepest
+    the stack of search_pattern got.
+
+    If sink is given, it is called as sink(kind, name, value) for every
+    event as it happens: kind is 'time' (value in seconds), 'count' or
+    'peak'.
+    """
+    def __init__(self, sink=None):
+        self.times = collections.defaultdict(float)
+        self.calls = collections.defaultdict(int)
+        self.counts = collections.defaultdict(int)
+        self.peaks = {}
+        self.sink = sink
+
+    def add_time(self, stage, seconds):
+        self.times[stage] += seconds
+        self.calls[stage] += 1
+        if self.sink is not None:
+            self.sink('time', stage, seconds)
+
+    def count(self, name, n=1):
+        self.counts[name] += n
+        if self.sink is not None:
+            self.sink('count', name, n)
+
+    def peak(self, name, value):
+        if name not in self.peaks or value > self.peaks[name]:
+            self.peaks[name] = value
+            if self.sink is not None:
+                self.sink('peak', name, value)
+
+    def summary(self):
+        """The collected numbers, as lines of text."""
+        lines = ['%-12s %10.6f s %6d calls' % (stage, self.times[stage],
+            self.calls[stage]) for stage in sorted(self.times)]
+        lines += ['%-18s %10d' % (name, self.counts[name])
+            for name in sorted(self.counts)]
+        lines += ['%-18s %10d (peak)' % (name, self.peaks[name])
+            for name in sorted(self.peaks)]
+        return '\n'.join(lines)
+
+
+@contextlib.contextmanager
+def profiling(sink=None):
+    """
+    Collect timings and counts for everything done inside a with block:
+
+        with profiling() as profiler:
+            ...
+        print(profiler.summary())
 
-def plot_creasepattern(node_list, crease_list, crease_types=None, triangles=None):
-    if crease_types == None:
-        crease_types = ['' for i in range(crease_list.shape[0])]
-    mpl.figure()
-    ax = mpl.subplot(1,1,1)
-    mpl.plot(node_list[:,0], node_list[:,1], '.b')
-    mpl.xlim((-0.05, 1.05))
-    mpl.ylim((-0.05, 1.05))
-    offset = 0.01
-    for i in range(node_list.shape[0]):
-        mpl.text(node_list[i,0]+offset, node_list[i,1]+offset, '%d' % i)
-        
-    for i, t in enumerate(crease_types): 
-        # range(crease_list.shape[0]):
-        x = node_list[crease_list[i,:],0]
-        y = node_list[crease_list[i,:],1]
-        #print t.upper()
-        if t.upper() == 'M':
-            mpl.plot(x, y, 'k')
-        elif t.upper() == 'V':
-            mpl.plot(x, y, '--k')
+    Yields the Profiler (see there for sink).  When no profiling block is
+    active, the solver only checks one module variable at each hook.
+    Worker processes started by animate are not profiled.
+    """
+    global _profiler
+    previous = _profiler
+    _profiler = Profiler(sink)
+    try:
+        yield _profiler
+    finally:
+        _profiler = previous
+
+
+def _timed(stage):
+    """Decorator counting the time spent in a function towards stage."""
+    def decorate(f):
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            profiler = _profiler
+            if profiler is None:
+                return f(*args, **kwargs)
+            start = time.time()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                profiler.add_time(stage, time.time() - start)
+        return wrapper
+    return decorate
+
+
+def _parse_nodes(filename, lines, line_numbers):
+    """
+    Parse a chunk of lines from the nodes section of a crease pattern file
+    into an array of shape (len(lines), 2).
+    """
+    counts = [len(line.split()) for line in lines]
+    if counts.count(2) == len(lines):
+        try:
+            return np.array(' '.join(lines).split(),
+                dtype='float64').reshape((-1, 2))
+        except ValueError:
+            pass
+    # Slow path: extra columns (which are ignored), or an error to report
+    nodes = np.empty((len(lines), 2))
+    for k, line in enumerate(lines):
+        a = line.split(None, 2)
+        try:
+            nodes[k] = [float(a[0]), float(a[1])]
+        except (ValueError, IndexError):
+            raise ValueError('%s, line %d: expected two coordinates for a '
+                'node, got %r' % (filename, line_numbers[k], line.strip()))
+    return nodes
+
+
+def _parse_creases(filename, lines, line_numbers):
+    """
+    Parse a chunk of lines from the creases section of a crease pattern file
+    into an array of shape (len(lines), 2) of node indices and a list of
+    crease types.
+    """
+    fields = [line.split(None, 2) for line in lines]
+    for k, a in enumerate(fields):
+        if len(a) < 2:
+            raise ValueError('%s, line %d: expected two node indices for a '
+                'crease, got %r' % (filename, line_numbers[k], lines[k].strip()))
+    crease_types = [a[2].strip() if len(a) > 2 else '' for a in fields]
+    try:
+        creases = np.array([a[:2] for a in fields], dtype='int64')
+    except ValueError:
+        for k, a in enumerate(fields):
+            try:
+                int(a[0]), int(a[1])
+            except ValueError:
+                raise ValueError('%s, line %d: expected two node indices for '
+                    'a crease, got %r' % (filename, line_numbers[k],
+                    lines[k].strip()))
+        raise
+    return creases.reshape((-1, 2)), crease_types
+
+
+@_timed('parse')
+def load_creasepattern(filename, cache=False, chunk_size=65536):
+    """
+    Read a crease pattern file.  After a line "begin nodes", each line gives
+    the X and Y coordinates of a node; after a line "begin creases", each
+    line gives the indices of the two nodes a crease joins, optionally
+    followed by its type ("M" for mountain, "V" for valley).  Blank lines
+    and lines starting with "#" are skipped.  Returns (node_list,
+    crease_list, crease_types).  Raises ValueError, giving the line number,
+    for lines that cannot be read.
+
+    The file is read line by line, and chunk_size lines at a time are
+    converted to numbers together.  Files ending in ".npz" are read as the
+    binary format written by save_creasepattern.  With cache, the binary
+    format is also saved next to the text file (with ".npz" added to the
+    name), and read instead of the text file from then on, as long as it is
+    newer.
+    """
+    if filename.endswith('.npz'):
+        return _load_creasepattern_npz(filename)
+    if cache:
+        cache_name = filename + '.npz'
+        if os.path.exists(cache_name) and \
+                os.path.getmtime(cache_name) >= os.path.getmtime(filename):
+            return _load_creasepattern_npz(cache_name)
+
+    node_chunks = []
+    crease_chunks = []
+    crease_types = []
+    section = None
+    lines = []
+    line_numbers = []
+
+    def flush():
+        if len(lines) == 0:
+            return
+        if section == 'nodes':
+            node_chunks.append(_parse_nodes(filename, lines, line_numbers))
         else:
-            mpl.plot(x, y, 'b')
+            creases, types = _parse_creases(filename, lines, line_numbers)
+            crease_chunks.append(creases)
+            crease_types.extend(types)
+        del lines[:]
+        del line_numbers[:]
 
-    if triangles is not None:
-        for i in range(triangles.shape[0]):
-            mean_x = np.mean(node_list[triangles[i,:],0])
-            mean_y = np.mean(node_list[triangles[i,:],1])
-            mpl.text(mean_x, mean_y, '%d' % i)
+    with open(filename) as f:
+        for number, line in enumerate(f, 1):
+            stripped = line.strip()
+            if len(stripped) == 0 or stripped.startswith('#'):
+                continue
+            if stripped.startswith('begin'):
+                flush()
+                words = stripped.split()
+                section = None
+                if len(words) > 1 and words[1] in ('nodes', 'creases'):
+                    section = words[1]
+                continue
+            if section is None:
+                continue
+            lines.append(line)
+            line_numbers.append(number)
+            if len(lines) >= chunk_size:
+                flush()
+        flush()
+
+    node_list = np.concatenate(node_chunks) if node_chunks else np.zeros((0, 2))
+    crease_list = np.concatenate(crease_chunks) if crease_chunks else \
+        np.zeros((0, 2), dtype='int64')
+    if cache:
+        save_creasepattern(cache_name, node_list, crease_list, crease_types)
+    return (node_list, crease_list, crease_types)
+
+
+def save_creasepattern(filename, node_list, crease_list, crease_types=None):
+    """
+    Save a crease pattern in a binary format (an uncompressed numpy .npz
+    file), which load_creasepattern can read back without parsing any text.
+    Crease types are stored as small integer codes into a table of the
+    distinct types.
+    """
+    if crease_types is None:
+        crease_types = ['' for i in range(crease_list.shape[0])]
+    labels, codes = np.unique(np.array(crease_types + [''], dtype='U'),
+        return_inverse=True)
+    with open(filename, 'wb') as f:
+        np.savez(f, nodes=np.asarray(node_list, dtype='float64'),
+            creases=np.asarray(crease_list, dtype='int64'),
+            type_labels=labels, type_codes=codes[:-1].astype('int32'))
+
+
+def _load_creasepattern_npz(filename):
+    with np.load(filename) as data:
+        labels = [str(x) for x in data['type_labels']]
+        crease_types = [labels[i] for i in data['type_codes']]
+        return (data['nodes'], data['creases'], crease_types)
+
+
+class TestLoad(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
 
-    ax.set_aspect('equal')
-    mpl.show()
+    def write(self, text):
+        filename = os.path.join(self.directory, 'pattern.creasepattern')
+        with open(filename, 'w') as f:
+            f.write(text)
+        return filename
 
+    def test1(self):
+        node_list, crease_list, crease_types = load_creasepattern('test.creasepattern')
+        self.assertEqual(node_list.shape, (9, 2))
+        self.assertEqual(crease_list.shape, (16, 2))
+        self.assertEqual(list(crease_list[8]), [8, 4])
+        self.assertEqual(crease_types[:9], [''] * 8 + ['M'])
+        for chunk_size in (1, 2, 5):
+            node_list2, crease_list2, crease_types2 = load_creasepattern(
+                'test.creasepattern', chunk_size=chunk_size)
+            self.assertTrue(np.all(node_list == node_list2))
+            self.assertTrue(np.all(crease_list == crease_list2))
+            self.assertEqual(crease_types, crease_types2)
+
+    def test2(self):
+        filename = self.write('# A comment\nbegin nodes\n0 0\n\n1 0 extra\n'
+            '0 1\n  # indented comment\nbegin creases\n0 1 M\n1 2\n')
+        node_list, crease_list, crease_types = load_creasepattern(filename)
+        self.assertEqual(node_list.tolist(), [[0, 0], [1, 0], [0, 1]])
+        self.assertEqual(crease_list.tolist(), [[0, 1], [1, 2]])
+        self.assertEqual(crease_types, ['M', ''])
+
+        filename = self.write('begin nodes\n0 0\n1 x\n')
+        try:
+            load_creasepattern(filename)
+            self.fail()
+        except ValueError as e:
+            self.assertTrue('line 3' in str(e))
+        # A short line and a long one must not be paired up
+        filename = self.write('begin nodes\n0\n1 0 0.5\n')
+        try:
+            load_creasepattern(filename)
+            self.fail()
+        except ValueError as e:
+            self.assertTrue('line 2' in str(e))
+        filename = self.write('begin nodes\n0 0\nbegin creases\n\n0 1\n0\n')
+        try:
+            load_creasepattern(filename)
+            self.fail()
+        except ValueError as e:
+            self.assertTrue('line 6' in str(e))
 
-def get_neighbors(node_list, crease_list):
+    def test3(self):
+        node_list, crease_list, crease_types = load_creasepattern('test.creasepattern')
+        filename = os.path.join(self.directory, 'pattern.npz')
+        save_creasepattern(filename, node_list, crease_list, crease_types)
+        node_list2, crease_list2, crease_types2 = load_creasepattern(filename)
+        self.assertTrue(np.all(node_list == node_list2))
+        self.assertTrue(np.all(crease_list == crease_list2))
+        self.assertEqual(crease_types, crease_types2)
+
+        filename = os.path.join(self.directory, 'pattern.creasepattern')
+        shutil.copy('test.creasepattern', filename)
+        load_creasepattern(filename, cache=True)
+        self.assertTrue(os.path.exists(filename + '.npz'))
+        node_list2, crease_list2, crease_types2 = load_creasepattern(filename,
+            cache=True)
+        self.assertTrue(np.all(crease_list == crease_list2))
+        self.assertEqual(crease_types, crease_types2)
+
+
+@_timed('neighbors')
+def get_neighbors_csr(node_list, crease_list, check=True):
+    """
+    Find the neighbors of every node, sorted by angle, in compressed sparse
+    row form.  The neighbors of node n are indices[indptr[n]:indptr[n+1]],
+    in counter-clockwise order starting from the -X direction, and
+    sector_angles[indptr[n]+k] gives the angle in degrees between neighbors
+    k and k+1 (wrapping around to the first).  This is the same information
+    as get_neighbors, computed with whole-array operations: duplicate creases
+    are removed with np.unique, and all the (node, angle) pairs are sorted
+    at once with np.lexsort.
+
+    With check, raise ValueError if the sector angles around some interior
+    node (see get_boundary_nodes) do not add up to 360 degrees, as happens
+    when the node has fewer than two creases in different directions.
+    """
+    nn = node_list.shape[0]
+    creases = np.asarray(crease_list, dtype='int64').reshape((-1, 2))
+    src = np.concatenate([creases[:,0], creases[:,1]])
+    dst = np.concatenate([creases[:,1], creases[:,0]])
+    # Remove duplicate neighbors
+    keys = np.unique(src * nn + dst)
+    src = keys // nn
+    dst = keys % nn
+    # Determine angles to each neighbor, and sort by node, then angle
+    vectors = node_list[dst,:] - node_list[src,:]
+    angles = np.arctan2(vectors[:,1], vectors[:,0]) * 180 / np.pi
+    order = np.lexsort((angles, src))
+    src = src[order]
+    indices = dst[order]
+    angles = angles[order]
+
+    counts = np.bincount(src, minlength=nn)
+    indptr = np.concatenate([[0], np.cumsum(counts)])
+    # Find angles between neighbors, with each node's last neighbor followed
+    # by its first (a roll within each row)
+    following = np.arange(1, indices.shape[0] + 1)
+    rows = counts > 0
+    following[indptr[1:][rows] - 1] = indptr[:-1][rows]
+    sector_angles = np.mod(angles[following] - angles + 720, 360)
+
+    if check:
+        sums = np.zeros(nn)
+        np.add.at(sums, src, sector_angles)
+        interior = ~get_boundary_nodes(node_list)
+        bad = np.nonzero(interior & (np.fabs(sums - 360) > 1e-9))[0]
+        if bad.shape[0] > 0:
+            raise ValueError('sector angles around interior node %d add up '
+                'to %g degrees, not 360' % (bad[0], sums[bad[0]]))
+    return indptr, indices, sector_angles
+
+
+def get_neighbors(node_list, crease_list, check=False):
     """
     neighbor_angles[n][0] gives the angle in degrees between the nodes
     neighbors[n][0] and neighbors[n][1].
-    """
-    neighbors = [[] for i in range(node_list.shape[0])]
-    neighbor_angles = [[] for i in range(node_list.shape[0])]
-    for i in range(crease_list.shape[0]):    
-        node0 = crease_list[i,0]
-        node1 = crease_list[i,1]
-        neighbors[node0].append(node1)
-        neighbors[node1].append(node0)
-
-    for i in range(node_list.shape[0]):    
-        # Remove duplicate neighbors
-        node_neighbors = np.array(list(set(neighbors[i])), dtype='int32')
-        # Determine angles to each neighbor
-        vectors = node_list[node_neighbors,:]
-        vectors = vectors - np.tile(node_list[i,:], (len(node_neighbors),1))
-        angles = np.arctan2(vectors[:,1], vectors[:,0]) * 180 / np.pi
-        # Sort the neighbors by angle
-        indices = np.argsort(angles)
-        angles = angles[indices]
-        node_neighbors = node_neighbors[indices]
-        # Find angles between neighbors
-        angle_diffs = np.roll(angles, -1) - angles
-        #print i
-        #print np.roll(angles, -1)
-        #print angles
-        angle_diffs = np.mod(angle_diffs + 720, 360)
-        neighbors[i] = node_neighbors
-        neighbor_angles[i] = angle_diffs
 
+    This splits the result of get_neighbors_csr into a list of arrays per
+    node.  check is as for get_neighbors_csr; the entry points that work
+    neighbors out from a crease pattern themselves pass check=True.
+    """
+    indptr, indices, sector_angles = get_neighbors_csr(node_list, crease_list,
+        check=check)
+    neighbors = np.split(indices.astype('int32'), indptr[1:-1])
+    neighbor_angles = np.split(sector_angles, indptr[1:-1])
     return neighbors, neighbor_angles
 
 
+def get_boundary_nodes(node_list):
+    """
+    Return a boolean array that is True for nodes on the edge of the paper.
+    The paper is taken to be the convex hull of the nodes (normally the unit
+    square), and nodes lying anywhere along a hull edge count as boundary
+    nodes, not just the corners.  Crease angles are only solved at the other
+    (interior) nodes.
+    """
+    eps = 1e-12
+    points = np.asarray(node_list, dtype='float64')
+    # Andrew's monotone chain for the hull corners
+    order = np.lexsort((points[:,1], points[:,0]))
+    def cross(o, a, b):
+        return (a[0] - o[0]) * (b[1] - o[1]) - (a[1] - o[1]) * (b[0] - o[0])
+    hull = []
+    for sweep in (order, order[::-1]):
+        chain = []
+        for i in sweep:
+            while len(chain) >= 2 and \
+                    cross(points[chain[-2]], points[chain[-1]], points[i]) <= eps:
+                chain.pop()
+            chain.append(i)
+        hull.extend(chain[:-1])
+
+    boundary = np.zeros(points.shape[0], dtype='bool')
+    boundary[hull] = True
+    for k in range(len(hull)):
+        p0 = points[hull[k]]
+        p1 = points[hull[(k + 1) % len(hull)]]
+        edge = p1 - p0
+        vectors = points - p0
+        along = np.dot(vectors, edge) / np.dot(edge, edge)
+        off = np.fabs(vectors[:,0] * edge[1] - vectors[:,1] * edge[0])
+        boundary |= (off <= eps * np.sqrt(np.dot(edge, edge))) & \
+            (along >= -eps) & (along <= 1 + eps)
+    return boundary
+
+
+class TestNeighbors(unittest.TestCase):
+    def setUp(self):
+        self.eps = 1e-12
+
+    def test1(self):
+        node_list, crease_list, crease_types = load_creasepattern('test.creasepattern')
+        neighbors, neighbor_angles = get_neighbors(node_list, crease_list)
+        self.assertEqual(list(neighbors[4]), [0, 7, 2, 6, 3, 8, 1, 5])
+        self.assertTrue(np.amax(np.fabs(neighbor_angles[4] - 45)) < self.eps)
+        self.assertEqual(list(neighbors[0]), [7, 4, 5])
+        self.assertTrue(np.amax(np.fabs(neighbor_angles[0] - [45, 45, 270])) < self.eps)
+
+    def test2(self):
+        # Compare with sorting each node's neighbors separately
+        rng = np.random.RandomState(3)
+        node_list = rng.uniform(0, 1, size=(30, 2))
+        crease_list = rng.randint(0, 30, size=(120, 2))
+        crease_list = crease_list[crease_list[:,0] != crease_list[:,1]]
+        indptr, indices, sector_angles = get_neighbors_csr(node_list,
+            crease_list, check=False)
+        for i in range(node_list.shape[0]):
+            expected = set(crease_list[crease_list[:,0] == i,1]) | \
+                set(crease_list[crease_list[:,1] == i,0])
+            expected = np.array(sorted(expected), dtype='int64')
+            vectors = node_list[expected] - node_list[i]
+            angles = np.arctan2(vectors[:,1], vectors[:,0]) * 180 / np.pi
+            expected = expected[np.argsort(angles)]
+            angles = np.sort(angles)
+            diffs = np.mod(np.roll(angles, -1) - angles + 720, 360)
+            self.assertEqual(list(indices[indptr[i]:indptr[i+1]]), list(expected))
+            self.assertTrue(np.all(np.fabs(sector_angles[indptr[i]:indptr[i+1]] -
+                diffs) < self.eps))
+
+    def test3(self):
+        # Node 4 is inside the paper, with a single crease
+        node_list = np.array([[0, 0], [1, 0], [1, 1], [0, 1], [0.5, 0.5]])
+        crease_list = np.array([[0, 1], [1, 2], [2, 3], [3, 0], [4, 0]])
+        self.assertRaises(ValueError, get_neighbors_csr, node_list, crease_list)
+        # Checked where a pattern is first used, too
+        self.assertRaises(ValueError, solve_pattern, node_list, crease_list,
+            {(4, 0): 180})
+        self.assertRaises(ValueError, search_pattern, node_list, crease_list,
+            {(4, 0): 180})
+        self.assertRaises(ValueError, FoldModel, node_list, crease_list)
+        crease_list = np.array([[0, 1], [1, 2], [2, 3], [3, 0], [4, 0], [4, 2]])
+        indptr, indices, sector_angles = get_neighbors_csr(node_list, crease_list)
+        self.assertEqual(list(indices[indptr[4]:indptr[5]]), [0, 2])
+
+
 def find_opposite_side(A, b, c):
     """
     Solve a spherical triangle for side a opposite angle A.  Sides b and c are
     also given.  Return value will be between 0 and 180 degrees, inclusive.
-    Input and output are in degrees.
+    Input and output are in degrees, and may be scalars or arrays.
+
+    Uses the haversine forms of the law of cosines,
+        sin(a/2)^2 = sin((b - c)/2)^2 + sin(b) sin(c) sin(A/2)^2
+        cos(a/2)^2 = cos((b + c)/2)^2 + sin(b) sin(c) cos(A/2)^2
+    and arctan2, which stay accurate where a is near 0 or 180 degrees and
+    cos(a) is too close to 1 or -1 for arccos to recover a.
     """
-    eps = 1e-13  # angles smaller than this in degrees are considered zero
-    if b < eps: return c
-    if c < eps: return b
     d2r = np.pi / 180   # Convert degrees to radians
-    cos_a = np.cos(b * d2r) * np.cos(c * d2r) + \
-        np.sin(b * d2r) * np.sin(c * d2r) * np.cos(A * d2r)
-    a = np.arccos(cos_a)
+    A = np.asarray(A, dtype='float64') * d2r
+    b = np.asarray(b, dtype='float64') * d2r
+    c = np.asarray(c, dtype='float64') * d2r
+    sin_bc = np.clip(np.sin(b) * np.sin(c), 0, None)
+    hav_a = np.sin(0.5 * (b - c))**2 + sin_bc * np.sin(0.5 * A)**2
+    cohav_a = np.cos(0.5 * (b + c))**2 + sin_bc * np.cos(0.5 * A)**2
+    a = 2 * np.arctan2(np.sqrt(hav_a), np.sqrt(cohav_a))
     # Convert back to degrees
-    a = np.mod(a * 180 / np.pi + 360, 360)
-    return a 
+    a = a * 180 / np.pi
+    if a.ndim == 0:
+        return float(a)
+    return a
 
 
 #def make_test_triangle(a_deg, b_deg, c_deg):
@@ -136,9 +527,9 @@ def solve_triangle_angles(a_deg, b_deg, c_deg):
     Return angles opposites sidea a, b, and c, in a spherical triangle.
     Do internal tests for consistency.
 
-    Later: Choose equations to solve based on numerical accuracy concerns.
-    Don't just use law of cosines, as I do below; use law of sines when A, B, or
-    C is close to 0 or 180 degrees.
+    The angles come from the half-angle formulas (see
+    _spherical_triangle_angles), which unlike the law of cosines keep their
+    accuracy when an angle is close to 0 or 180 degrees.
     """
     # Convert to radians
     a = a_deg * np.pi / 180
@@ -164,34 +555,12 @@ def solve_triangle_angles(a_deg, b_deg, c_deg):
         A, B, C = (90, 90, 0)
     
     if A == None:
-        cosA = (np.cos(a) - np.cos(b) * np.cos(c)) / (np.sin(b) * np.sin(c))
-        cosB = (np.cos(b) - np.cos(c) * np.cos(a)) / (np.sin(c) * np.sin(a))
-        cosC = (np.cos(c) - np.cos(a) * np.cos(b)) / (np.sin(a) * np.sin(b))
-        # Clean up numerical noise before arccos
-        if cosA > 1: cosA = 1
-        if cosA < -1: cosA = -1
-        if cosB > 1: cosB = 1
-        if cosB < -1: cosB = -1
-        if cosC > 1: cosC = 1
-        if cosC < -1: cosC = -1
-        A = np.arccos(cosA) 
-        B = np.arccos(cosB)
-        C = np.arccos(cosC)
-
-        # Check that these are all equal...
-        ratio1 = np.sin(A) / np.sin(a)
-        ratio2 = np.sin(B) / np.sin(b)
-        ratio3 = np.sin(C) / np.sin(c)
-
-        eps = 1e-4
-        assert(np.fabs(ratio1 - ratio2) < eps)
-        assert(np.fabs(ratio2 - ratio3) < eps)
-        assert(np.fabs(ratio3 - ratio1) < eps)
+        A, B, C = _spherical_triangle_angles(a, b, c)
 
         # Convert back to degrees
-        A = A * 180 / np.pi
-        B = B * 180 / np.pi
-        C = C * 180 / np.pi
+        A = float(A * 180 / np.pi)
+        B = float(B * 180 / np.pi)
+        C = float(C * 180 / np.pi)
 
     return A, B, C
 
@@ -289,6 +658,30 @@ class TestSphericalTriangle(unittest.TestCase):
         A, B, C = solve_triangle_angles(a, b, c)
         self.assertTrue(np.amax(np.fabs(np.array([A, B, C]) - np.array([90, 90, 90]))) < self.eps)
 
+    def test6(self):
+        # Tiny and nearly flat triangles, where the law of cosines loses
+        # most of its digits
+        for a, b, c in [(1e-5, 1e-5, 1e-5), (2e-6, 1e-6, 1e-6 + 1e-12),
+                (179.999999, 90, 89.9999991), (30, 20, 10 + 1e-9)]:
+            A, B, C = solve_triangle_angles(a, b, c)
+            a2 = find_opposite_side(A, b, c)
+            b2 = find_opposite_side(B, c, a)
+            c2 = find_opposite_side(C, a, b)
+            scale = max(a, b, c)
+            self.assertTrue(np.fabs(a - a2) < 1e-9 * scale)
+            self.assertTrue(np.fabs(b - b2) < 1e-9 * scale)
+            self.assertTrue(np.fabs(c - c2) < 1e-9 * scale)
+        A, B, C = solve_triangle_angles(1e-5, 1e-5, 1e-5)
+        self.assertTrue(np.amax(np.fabs(np.array([A, B, C]) - 60)) < 1e-6)
+
+    def test7(self):
+        # Arrays work like scalars
+        A = np.array([10, 90, 180, 0, 45])
+        b = np.array([90, 90, 90, 90, 0])
+        c = np.array([90, 90, 90, 90, 20])
+        a = find_opposite_side(A, b, c)
+        self.assertTrue(np.amax(np.fabs(a - [10, 90, 180, 0, 20])) < self.eps)
+
 
     
 
@@ -333,152 +726,322 @@ def solve_node(neighbor_angles, crease_angles):
     equal).  However, if all three edge lengths are zero, crease angles of 60,
     60, and 60 are used.  In these cases, only one solution is returned, since
     the other is not effectively different.
-    """
-    neighbor_angles = list(neighbor_angles)
-
-    print 'crease_angles', crease_angles
-    print 'neighbor_angles', neighbor_angles
-    print
 
-    non_numbers = [not(isinstance(x, numbers.Number)) for x in crease_angles]
-    if sum(non_numbers) > 3:
+    Known crease angles are removed one at a time, in order, by cutting off
+    the spherical triangle they make with their two neighboring creases.  This
+    replaces the spherical N-gon with an (N-1)-gon, until only a triangle is
+    left.  The reduction is done in place on preallocated arrays: a linked
+    list of the creases still in the polygon, and the total angle cut off from
+    each crease so far, which is added back to the final solution.  A known
+    crease angle greater than 180 degrees cuts off a triangle that lies
+    outside the polygon, so its neighbors gain angle instead of losing it.
+    Solved crease angles are returned in the range 0 to 360 degrees.
+    """
+    n = len(crease_angles)
+    known = np.array([isinstance(x, numbers.Number) for x in crease_angles])
+    if n - np.sum(known) > 3:
         return -1
 
-    assert(len(neighbor_angles) > 2)
+    assert(n > 2)
 
-    for i in range(len(neighbor_angles)):
-        if neighbor_angles[i] > 180.0:
+    sides = np.array(neighbor_angles, dtype='float64')
+    for i in range(n):
+        if sides[i] > 180.0:
             return -4
-        if neighbor_angles[i] < 0:
+        if sides[i] < 0:
             return -5
 
-    # Solve the spherical triangle case.
+    angles = np.zeros(n)
+    angles[known] = [x for x in crease_angles if isinstance(x, numbers.Number)]
+    offsets = np.zeros(n)  # crease angle cut off so far, for each crease
+    next_crease = np.roll(np.arange(n), -1)
+    prev_crease = np.roll(np.arange(n), 1)
+    d2r = np.pi / 180   # Convert degrees to radians
+
+    # The original recursion always removed the first known crease left in
+    # the polygon, which is the same as taking known creases in index order.
+    removed = np.nonzero(known)[0][:n-3]
+    for i in removed:
+        p = prev_crease[i]
+        q = next_crease[i]
+        b = sides[p]  # arc length between creases p and i
+        c = sides[i]  # arc length between creases i and q
+        angle = np.mod(angles[i] - offsets[i], 360)
+        if angle > 180:
+            sign = -1
+            angle = 360 - angle
+        else:
+            sign = 1
+        new_side = find_opposite_side(angle, b, c)
+        #                     +  q
+        #                    / \
+        #                   / B \
+        #                  /     \  c
+        #       new_side  /       \
+        #                /         \
+        #               /           \
+        #              / C         A \
+        #           p +---------------+ i
+        #                     b
+        # Angles at p and q, following the special cases of
+        # solve_triangle_angles for zero length sides.
+        eps = 1e-13
+        if _profiler is not None and min(new_side, b, c) < eps:
+            _profiler.count('degenerate')
+        if new_side < eps and b < eps and c < eps:
+            B, C = (60, 60)
+        elif new_side < eps:
+            B, C = (90, 90)
+        elif b < eps:
+            B, C = (0, 90)
+        elif c < eps:
+            B, C = (90, 0)
+        else:
+            A, B, C = _spherical_triangle_angles(new_side * d2r, b * d2r,
+                c * d2r)
+            B = B / d2r
+            C = C / d2r
+        offsets[p] += sign * C
+        offsets[q] += sign * B
+        sides[p] = new_side
+        next_crease[p] = q
+        prev_crease[q] = p
+
+    # Solve the remaining spherical triangle.
+    live = np.ones(n, dtype='bool')
+    live[removed] = False
+    live = np.nonzero(live)[0]
+    triangle = np.array([sides[live]])
+    solutions, opposites, status = solve_triangles(triangle)
+    if status[0] < 0:
+        return int(status[0])
+    branches = [solutions[0]]
+    if status[0] > 1:
+        branches.append(opposites[0])
+
+    answers = []
+    for branch in branches:
+        result = angles.copy()
+        values = branch + offsets[live]
+        values = np.where(values > 360, np.mod(values, 360), values)
+        values = np.where(values < 0, np.mod(values, 360), values)
+        # Known creases that made it into the final triangle must agree with
+        # the solution, or this branch is inconsistent.
+        diff = np.mod(values - angles[live] + 180, 360) - 180
+        check = known[live]
+        if np.any(np.fabs(diff[check]) > 1e-6):
+            continue
+        result[live[~check]] = values[~check]
+        answers.append(result.tolist())
+
+    if len(answers) == 0:
+        return -2
+    return tuple(answers)
+
+
+def _spherical_triangle_angles(a, b, c):
+    """
+    Angles A, B, C opposite sides a, b, c of a spherical triangle, from the
+    half-angle formulas: with s = (a + b + c) / 2,
+        tan(A/2) = sqrt(sin(s-b) sin(s-c) / (sin(s) sin(s-a)))
+    and likewise for B and C, evaluated with arctan2 so that angles near 0
+    and 180 degrees come out as accurately as the rest.  Works elementwise on
+    scalars or arrays.  Input and output are in radians.  Sides that break
+    the triangle inequality by rounding noise are treated as just meeting it.
+    Degenerate (zero length) sides give angles of 0; the callers handle those
+    cases themselves.
+    """
+    s = 0.5 * (a + b + c)
+    sin_s = np.sin(s)
+    sin_sa = np.sin(s - a)
+    sin_sb = np.sin(s - b)
+    sin_sc = np.sin(s - c)
+    def half_angle(x, y, z, w):
+        return 2 * np.arctan2(np.sqrt(np.clip(x * y, 0, None)),
+            np.sqrt(np.clip(z * w, 0, None)))
+    A = half_angle(sin_sb, sin_sc, sin_s, sin_sa)
+    B = half_angle(sin_sc, sin_sa, sin_s, sin_sb)
+    C = half_angle(sin_sa, sin_sb, sin_s, sin_sc)
+    return A, B, C
+
+
+def solve_triangles(neighbor_angles):
+    """
+    Batched version of the N=3 case of solve_node, for solving many frames of
+    an animation at once.  neighbor_angles is an array of shape (frames, 3) of
+    arc lengths in degrees, in the same order used by solve_node.  All three
+    crease angles are treated as unknown.
+
+    Returns (crease_angles, opposites, status).  crease_angles and opposites
+    are arrays of shape (frames, 3) holding the two solutions.  status is an
+    integer array of shape (frames,) holding the number of solutions (1 or 2)
+    for each frame, or one of the error codes of solve_node:
+
+    -3 if the spherical triangle is unsolvable due to arc lengths
+    -4 if any neighbor_angle is > 180 degrees
+    -5 if any neighbor_angle is < 0
+
+    The degenerate cases follow solve_node: a zero length edge gives crease
+    angles of 0, 90, and 90, and three zero length edges give 60, 60, and 60.
+    For these frames, status is 1 and opposites is a copy of crease_angles.
+    Frames with an error code get nan for all crease angles.
+    """
+    neighbor_angles = np.asarray(neighbor_angles, dtype='float64')
+    assert(neighbor_angles.ndim == 2 and neighbor_angles.shape[1] == 3)
+    nf = neighbor_angles.shape[0]
+
+    # As in solve_node, the first error encountered determines the code, so
+    # apply the checks in reverse order and let earlier ones overwrite.
+    status = np.full(nf, 2, dtype='int32')
+    for i in (2, 1, 0):
+        status[neighbor_angles[:,i] < 0] = -5
+        status[neighbor_angles[:,i] > 180.0] = -4
+
     eps = 1e-7  # angles below this are considered zero radians
-    if len(neighbor_angles) == 3:
-        # Convert to radians, for the benefit of numpy trig functions
-
-        # B = crease_angles[0] * np.pi / 180   # angle opposite side b
-        a = neighbor_angles[0] * np.pi / 180
-        # C = crease_angles[1] * np.pi / 180   # angle opposite side c
-        b = neighbor_angles[1] * np.pi / 180
-        # A = crease_angles[2] * np.pi / 180   # angle opposite side a
-        c = neighbor_angles[2] * np.pi / 180  
-
-        # Handle special cases
-        if a > b + c + eps: return -3
-        if b > c + a + eps: return -3
-        if c > a + b + eps: return -3
-        if a < eps and b < eps and c < eps: return ([60, 60, 60],)
-        if a < eps: return ([90, 90, 0],)
-        if b < eps: return ([0, 90, 90],)
-        if c < eps: return ([90, 0, 90],)
-
-        # Solve spherical triangle
-        cosA = (np.cos(a) - np.cos(b) * np.cos(c)) / (np.sin(b) * np.sin(c))
-        cosB = (np.cos(b) - np.cos(c) * np.cos(a)) / (np.sin(c) * np.sin(a))
-        cosC = (np.cos(c) - np.cos(a) * np.cos(b)) / (np.sin(a) * np.sin(b))
-        # Clean up numerical noise
-        if cosA > 1: cosA = 1
-        if cosA < -1: cosA = -1
-        if cosB > 1: cosB = 1
-        if cosB < -1: cosB = -1
-        if cosC > 1: cosC = 1
-        if cosC < -1: cosC = -1
-        crease_angles = [np.arccos(cosB), np.arccos(cosC), np.arccos(cosA)]
-        # Convert back to degrees
-        crease_angles = [np.mod(x * 180 / np.pi + 360, 360) for x in crease_angles]
-        # Find alternate solution
-        opposites = [360 - x for x in crease_angles]
+    sides = neighbor_angles * np.pi / 180
+    a = sides[:,0]
+    b = sides[:,1]
+    c = sides[:,2]
+    bad = (a > b + c + eps) | (b > c + a + eps) | (c > a + b + eps)
+    status[bad & (status > 0)] = -3
+
+    A, B, C = _spherical_triangle_angles(a, b, c)
+    crease_angles = np.empty((nf, 3))
+    crease_angles[:,0] = B
+    crease_angles[:,1] = C
+    crease_angles[:,2] = A
+    # Convert back to degrees
+    crease_angles = np.mod(crease_angles * 180 / np.pi + 360, 360)
+
+    # Handle special cases, in the same order of precedence as solve_node
+    zero_a = a < eps
+    zero_b = b < eps
+    zero_c = c < eps
+    zero_all = zero_a & zero_b & zero_c
+    if _profiler is not None:
+        _profiler.count('degenerate',
+            int(np.sum((zero_a | zero_b | zero_c) & (status > 0))))
+    for mask, angles in [
+            (zero_c & ~zero_b & ~zero_a, [90, 0, 90]),
+            (zero_b & ~zero_a, [0, 90, 90]),
+            (zero_a & ~zero_all, [90, 90, 0]),
+            (zero_all, [60, 60, 60])]:
+        mask = mask & (status > 0)
+        crease_angles[mask] = angles
+        status[mask] = 1
+
+    # Find alternate solution
+    opposites = 360 - crease_angles
+    single = status == 1
+    opposites[single] = crease_angles[single]
+    failed = status < 0
+    crease_angles[failed] = np.nan
+    opposites[failed] = np.nan
+
+    return crease_angles, opposites, status
+
+
+class TestBatchTriangle(unittest.TestCase):
+    def setUp(self):
+        self.eps = 1e-10
 
-        print 'crease angles returned', crease_angles
-        print 'crease angles returned', opposites 
-        print
+    def test1(self):
+        rng = np.random.RandomState(1)
+        sides = rng.uniform(0, 180, size=(200, 3))
+        crease_angles, opposites, status = solve_triangles(sides)
+        for i in range(sides.shape[0]):
+            ans = solve_node(list(sides[i]), [None, None, None])
+            if isinstance(ans, numbers.Number):
+                self.assertEqual(status[i], ans)
+                self.assertTrue(np.all(np.isnan(crease_angles[i])))
+                continue
+            self.assertEqual(status[i], len(ans))
+            diff = crease_angles[i] - np.array(ans[0])
+            self.assertTrue(np.amax(np.fabs(diff)) < self.eps)
+            diff = opposites[i] - np.array(ans[1])
+            self.assertTrue(np.amax(np.fabs(diff)) < self.eps)
 
-        if sum(non_numbers) == 3:
-            return (crease_angles, opposites)
-        else:
-            # Check to see if this matches input crease angles?
-            return (crease_angles, opposites)
-    else:
-        # Implement recursion here.
-        neighbor_angles2 = copy.copy(neighbor_angles)
-        crease_angles2 = copy.copy(crease_angles)
+    def test2(self):
+        sides = np.array([
+            [0, 10, 10],
+            [10, 0, 10],
+            [10, 10, 0],
+            [0, 0, 0],
+            [90, 90, 90],
+            [10, 20, 50],
+            [190, 90, 90],
+            [90, -1, 90],
+            [-1, 190, 90]])
+        crease_angles, opposites, status = solve_triangles(sides)
+        expected = [[90, 90, 0], [0, 90, 90], [90, 0, 90], [60, 60, 60],
+            [90, 90, 90]]
+        for i in range(len(expected)):
+            diff = crease_angles[i] - np.array(expected[i])
+            self.assertTrue(np.amax(np.fabs(diff)) < self.eps)
+        self.assertEqual(list(status), [1, 1, 1, 1, 2, -3, -4, -5, -5])
+        self.assertTrue(np.all(opposites[:4] == crease_angles[:4]))
+        self.assertTrue(np.amax(np.fabs(opposites[4] - 270)) < self.eps)
+
+
+def node_closure_error(neighbor_angles, crease_angles):
+    """
+    Check a solution from solve_node.  Rotating by (crease angle - 180) about
+    each crease in turn, counter-clockwise around the node, must bring the
+    paper back to where it started.  Returns the largest deviation of the
+    product of those rotation matrices from the identity.
+    """
+    directions = np.concatenate([[0], np.cumsum(neighbor_angles)[:-1]])
+    matrix = np.eye(3)
+    for d, angle in zip(directions, crease_angles):
+        axis = np.array([np.cos(d * np.pi / 180), np.sin(d * np.pi / 180), 0])
+        matrix = np.dot(matrix, axis_angle_rotation(axis, angle - 180))
+    return np.amax(np.fabs(matrix - np.eye(3)))
 
-        i = 0
-        while not(isinstance(crease_angles2[i], numbers.Number)):
-            i = i + 1
 
-        angle = crease_angles2[i]
-        del crease_angles2[i]
+class TestSolveNode(unittest.TestCase):
+    def setUp(self):
+        self.eps = 1e-6
 
-        # This still works if i == 0
-        new_side = find_opposite_side(angle, neighbor_angles2[i-1],
-            neighbor_angles2[i])
-        """
-                           +  crease_angles2[i+1]
-                          / \
-                         / B \
-                        /     \  neighbor_angles2[i]
-             new_side  /       \
-                      /         \
-                     /           \
-                    / C         A \
-crease_angles2[i-1]+---------------+ crease_angles2[i]
-
-                   neighbor_angles2[i-1]
-        """
+    def test1(self):
+        neighbor_angles = [45] * 8
+        ans = solve_node(neighbor_angles, [15, 180, 15, None, 15, 180, 15, None])
+        self.assertEqual(len(ans), 1)
+        expected = [15, 180, 15, 338.906322201578, 15, 180, 15, 338.906322201578]
+        self.assertTrue(np.amax(np.fabs(np.array(ans[0]) - expected)) < self.eps)
+        self.assertTrue(node_closure_error(neighbor_angles, ans[0]) < self.eps)
 
-        # Get all the angles
-        A, B, C = solve_triangle_angles(new_side, neighbor_angles2[i-1],
-            neighbor_angles2[i])
-        
-        if np.fabs(angle - A) > eps:
-            print new_side, neighbor_angles2[i-1], neighbor_angles2[i]
-            print A, B, C
-            print angle
-            print A - angle
-        assert(np.fabs(angle - A) < eps)
-
-        if isinstance(crease_angles2[i-1], numbers.Number):
-            crease_angles2[i-1] -= C
-        nc = len(crease_angles2)
-        if isinstance(crease_angles2[i % nc], numbers.Number):
-            crease_angles2[i % nc] -= B
-
-        neighbor_angles2[i-1] = new_side
-        #print neighbor_angles2
-        #print type(neighbor_angles2)
-        del neighbor_angles2[i]
-
-        # Now we can recurse.
-        answers = solve_node(neighbor_angles2, crease_angles2)
-
-        crease_angles = answers[0]
-        crease_angles.insert(i, A)
-        crease_angles[i-1] = crease_angles[i-1] + C
-        if i+1 <= len(crease_angles):
-            crease_angles[i+1] = crease_angles[i+1] + B
-        else:
-            crease_angles[0] = crease_angles[0] + B
-
-        if len(answers) > 1:
-            opposites = answers[1]
-            opposites.insert(i, A)
-            opposites[i-1] = opposites[i-1] + C
-            if i+1 <= len(opposites):
-                opposites[i+1] = opposites[i+1] + B
-            else:
-                opposites[0] = opposites[0] + B
-       
-        if len(answers) == 1:
-            print 'crease angles returned', crease_angles
-            print
-            return (crease_angles,)
-        else:
-            print 'crease angles returned', crease_angles
-            print 'crease angles returned', opposites 
-            print
-            return (crease_angles, opposites)
+    def test2(self):
+        rng = np.random.RandomState(0)
+        count = 0
+        for trial in range(500):
+            n = rng.randint(4, 12)
+            neighbor_angles = rng.uniform(5, 90, n)
+            neighbor_angles = list(neighbor_angles / np.sum(neighbor_angles) * 360)
+            crease_angles = list(rng.uniform(0, 360, n))
+            for i in rng.choice(n, 3, replace=False):
+                crease_angles[i] = None
+            ans = solve_node(neighbor_angles, crease_angles)
+            if isinstance(ans, numbers.Number):
+                continue
+            for solution in ans:
+                count += 1
+                self.assertEqual(len(solution), n)
+                for x, y in zip(crease_angles, solution):
+                    if x is not None:
+                        self.assertEqual(x, y)
+                self.assertTrue(node_closure_error(neighbor_angles, solution) < self.eps)
+        self.assertTrue(count > 100)
+
+    def test3(self):
+        self.assertEqual(solve_node([90] * 4, [None] * 4), -1)
+        self.assertEqual(solve_node([190, 90, 80], [None] * 3), -4)
+        self.assertEqual(solve_node([-10, 190, 180], [None] * 3), -5)
+        self.assertEqual(solve_node([10, 10, 50], [None] * 3), -3)
+        self.assertEqual(solve_node([90] * 4, [180, None, 90, None]), -2)
+        crease_angles = [15, 180, 15, 338.906322201578, 15, 180, 15, None]
+        ans = solve_node([45] * 8, crease_angles)
+        self.assertEqual(len(ans), 1)
+        self.assertTrue(np.fabs(ans[0][7] - 338.906322201578) < self.eps)
 
 
 def add_node_creases(known_creases, inode, neighbors, crease_angles):
@@ -488,7 +1051,1009 @@ def add_node_creases(known_creases, inode, neighbors, crease_angles):
     return known_creases
 
 
+def _angle_difference(a, b):
+    """Signed difference a - b of angles in degrees, wrapped to [-180, 180)."""
+    return np.mod(np.asarray(a) - np.asarray(b) + 180, 360) - 180
+
+
+def _nearest_branch(answers, reference):
+    """
+    Index of the solution in answers (as from solve_node) closest to the
+    reference crease angles, a list with None where there is no reference.
+    """
+    check = np.array([x is not None for x in reference])
+    if len(answers) == 1 or not np.any(check):
+        return 0
+    ref = np.array([x for x in reference if x is not None], dtype='float64')
+    distances = [np.amax(np.fabs(_angle_difference(np.array(a)[check], ref)))
+        for a in answers]
+    return int(np.argmin(distances))
+
+
+@_timed('solve')
+def solve_pattern(node_list, crease_list, known_creases, neighbors=None,
+        neighbor_angles=None, branch=0, record=None, reference=None,
+        margins=None, cache=None):
+    """
+    Propagate crease angles through the whole crease pattern.  known_creases
+    holds the driving crease angles, keyed like add_node_creases does.  We
+    repeatedly solve an interior node with three or fewer unknown creases,
+    which makes its creases known at the nodes on their other ends, until no
+    such node is left.
+
+    Nodes wait in a priority queue keyed by their number of unknown creases.
+    A node is only pushed again when one of its creases becomes known, and
+    entries whose count is out of date are skipped when popped.
+
+    Where solve_node returns two solutions, branch picks which one to use
+    (see search_pattern for choosing between them).  Returns known_creases,
+    updated in place, or the error code from solve_node if some node cannot
+    be solved.  Creases at nodes that never get down to three unknowns are
+    left unknown.
+
+    If record is a list, the order of the solution is recorded in it for
+    resolve_pattern: one tuple (node, solved) per node solved, where solved
+    lists the neighbors whose creases were unknown and solved at that node.
+
+    If reference is given (crease angles keyed like known_creases, such as
+    the solution of a previous animation frame), the branch nearest to it is
+    used at each node instead of branch.  If margins is a list, the largest
+    difference in crease angle between the two solutions is appended to it
+    for each node solved (inf where there is only one); small margins mean
+    the pattern is close to a configuration where the branches meet.
+
+    cache may be a VertexSolutionCache to solve nodes with instead of
+    solve_node.
+    """
+    if neighbors is None or neighbor_angles is None:
+        neighbors, neighbor_angles = get_neighbors(node_list, crease_list,
+            check=True)
+    interior = ~get_boundary_nodes(node_list)
+
+    unknown = np.zeros(len(neighbors), dtype='int32')
+    for i in range(len(neighbors)):
+        for j in neighbors[i]:
+            if (i, j) not in known_creases:
+                unknown[i] += 1
+    worklist = [(unknown[i], i) for i in np.nonzero(interior)[0]]
+    heapq.heapify(worklist)
+
+    while len(worklist) > 0:
+        count, i = heapq.heappop(worklist)
+        if count != unknown[i] or count == 0:
+            continue  # Out of date, or nothing left to solve
+        if count > 3:
+            break  # Every node left is underconstrained
+        crease_angles = [known_creases.get((i, j)) for j in neighbors[i]]
+        if cache is None:
+            ans = solve_node(neighbor_angles[i], crease_angles)
+        else:
+            ans = cache.solve(neighbor_angles[i], crease_angles)
+        if isinstance(ans, numbers.Number):
+            return ans
+        if _profiler is not None:
+            _profiler.count('node_solves')
+            if len(ans) > 1:
+                _profiler.count('branch_points')
+        if reference is not None:
+            choice = _nearest_branch(ans,
+                [reference.get((i, j)) for j in neighbors[i]])
+        else:
+            choice = min(branch, len(ans) - 1)
+        if margins is not None:
+            margins.append(np.inf if len(ans) == 1 else float(np.amax(np.fabs(
+                _angle_difference(ans[0], ans[1])))))
+        add_node_creases(known_creases, i, neighbors[i], ans[choice])
+        unknown[i] = 0
+        for j, angle in zip(neighbors[i], crease_angles):
+            if angle is None:
+                unknown[j] -= 1
+                if interior[j]:
+                    heapq.heappush(worklist, (unknown[j], j))
+        if record is not None:
+            record.append((i, [j for j, angle in zip(neighbors[i], crease_angles)
+                if angle is None]))
+
+    return known_creases
+
+
+def resolve_pattern(known_creases, record, neighbors, neighbor_angles,
+        changed_edges, branch=0):
+    """
+    Redo solve_pattern after some driving crease angles have changed.  The
+    new angles must already be in known_creases, and changed_edges is a set
+    of the changed creases (pairs of node indices, in either order).  record
+    is the order of solution recorded by solve_pattern.  Nodes are solved
+    again in the same order, but only if one of the creases they used as
+    input has changed; their solved creases then count as changed for the
+    nodes downstream of them.
+
+    Returns the set of all changed creases, in both orders (to pass on to
+    update_frames), or the error code from solve_node.
+    """
+    changed = set()
+    for edge in changed_edges:
+        changed.add((edge[0], edge[1]))
+        changed.add((edge[1], edge[0]))
+    for i, solved in record:
+        inputs = [(i, j) for j in neighbors[i] if j not in solved]
+        if not any(edge in changed for edge in inputs):
+            continue
+        crease_angles = [None if j in solved else known_creases[(i, j)]
+            for j in neighbors[i]]
+        ans = solve_node(neighbor_angles[i], crease_angles)
+        if isinstance(ans, numbers.Number):
+            return ans
+        add_node_creases(known_creases, i, neighbors[i], ans[min(branch, len(ans) - 1)])
+        for j in solved:
+            changed.add((i, j))
+            changed.add((j, i))
+    return changed
+
+
+class TwoNodeTestCase(unittest.TestCase):
+    """
+    A small crease pattern with two interior nodes, 4 and 5, joined by a
+    crease, and its triangulation.  Node 4 is driven by the crease to node 7.
+    """
+    eps = 1e-6
+
+    def setUp(self):
+        self.nodes = np.array([[0, 0], [1, 0], [1, 1], [0, 1], [0.4, 0.45],
+            [0.65, 0.55], [0.3, 0], [0, 0.6], [0.35, 1], [0.8, 0], [1, 0.5],
+            [0.7, 1]])
+        self.creases = np.array([[0, 6], [6, 9], [9, 1], [1, 10], [10, 2],
+            [2, 11], [11, 8], [8, 3], [3, 7], [7, 0], [4, 6], [4, 7], [4, 8],
+            [4, 5], [5, 9], [5, 10], [5, 11]])
+        self.triangles = np.array([[0, 6, 4], [4, 6, 9], [0, 4, 7], [7, 8, 3],
+            [8, 7, 4], [4, 5, 8], [9, 1, 10], [9, 10, 5], [5, 2, 11],
+            [2, 5, 10], [5, 11, 8], [9, 5, 4]])
+        self.neighbors, self.neighbor_angles = get_neighbors(self.nodes,
+            self.creases)
+
+    def solve(self, angle, record=None):
+        known_creases = add_node_creases({}, 4, [7], [angle])
+        known_creases = solve_pattern(self.nodes, self.creases, known_creases,
+            self.neighbors, self.neighbor_angles, record=record)
+        return add_flat_creases(known_creases, self.triangles)
+
+
+class TestSolvePattern(TwoNodeTestCase):
+    def test1(self):
+        boundary = get_boundary_nodes(self.nodes)
+        self.assertEqual(list(np.nonzero(~boundary)[0]), [4, 5])
+
+    def test2(self):
+        neighbors, neighbor_angles = get_neighbors(self.nodes, self.creases)
+        for branch in (0, 1):
+            known_creases = add_node_creases({}, 4, [7], [160])
+            known_creases = solve_pattern(self.nodes, self.creases,
+                known_creases, branch=branch)
+            self.assertEqual(known_creases[(4, 7)], 160)
+            for i in (4, 5):
+                crease_angles = [known_creases[(i, j)] for j in neighbors[i]]
+                error = node_closure_error(neighbor_angles[i], crease_angles)
+                self.assertTrue(error < self.eps)
+
+    def test3(self):
+        # Not enough driving creases: nothing can be solved
+        known_creases = solve_pattern(self.nodes, self.creases, {})
+        self.assertEqual(known_creases, {})
+
+
+def get_crease_type_map(crease_list, crease_types):
+    """
+    Build a hash from edges (pairs of node indices, in both orders) to the
+    upper-cased mountain/valley label of the crease, 'M' or 'V'.  Creases with
+    any other label are left out.
+    """
+    type_map = {}
+    for i in range(crease_list.shape[0]):
+        t = crease_types[i].strip().upper()
+        if t in ('M', 'V'):
+            type_map[(crease_list[i,0], crease_list[i,1])] = t
+            type_map[(crease_list[i,1], crease_list[i,0])] = t
+    return type_map
+
+
+def _check_crease_types(inode, neighbors, old_angles, new_angles, type_map):
+    """
+    Score a solve_node solution against the mountain/valley labels, looking
+    only at the creases it solved.  Returns None if a mountain fold came out
+    below 180 degrees or a valley fold above it.  Otherwise returns a tuple
+    that sorts higher for better solutions: first the number of labeled
+    creases folded the right way, then how close unlabeled creases stay to
+    flat.
+    """
+    eps = 1e-6
+    agree = 0
+    bend = 0.0
+    for j, old, new in zip(neighbors, old_angles, new_angles):
+        if old is not None:
+            continue
+        t = type_map.get((inode, j))
+        if t == 'M':
+            if new < 180 - eps:
+                return None
+            agree += new > 180 + eps
+        elif t == 'V':
+            if new > 180 + eps:
+                return None
+            agree += new < 180 - eps
+        else:
+            bend += np.fabs(new - 180)
+    return (agree, -bend)
+
+
+@_timed('solve')
+def search_pattern(node_list, crease_list, known_creases, crease_types=None,
+        neighbors=None, neighbor_angles=None, max_solutions=1):
+    """
+    Like solve_pattern, but instead of always taking the same branch where
+    solve_node returns two solutions, search the tree of branch choices
+    depth-first for crease angle assignments that are consistent everywhere.
+
+    A subtree is pruned as soon as some node's creases cannot all be
+    satisfied (solve_node returns an error, e.g. -2 once a node is
+    overconstrained by values fixed at other nodes), or a solved crease
+    disagrees with its mountain/valley label from crease_types.  Nodes whose
+    creases are all known are still passed through solve_node, as a
+    consistency check.  Of two branches, the one that better matches the
+    labels is explored first.  Partial assignments already seen at a branch
+    point are not explored again.
+
+    Returns a list of at most max_solutions copies of known_creases (the
+    input is not changed).  The list is empty if every branch was pruned.
+    """
+    if neighbors is None or neighbor_angles is None:
+        neighbors, neighbor_angles = get_neighbors(node_list, crease_list,
+            check=True)
+    if crease_types is None:
+        crease_types = ['' for i in range(crease_list.shape[0])]
+    type_map = get_crease_type_map(crease_list, crease_types)
+    interior = ~get_boundary_nodes(node_list)
+
+    unknown = np.zeros(len(neighbors), dtype='int32')
+    for i in range(len(neighbors)):
+        for j in neighbors[i]:
+            if (i, j) not in known_creases:
+                unknown[i] += 1
+    worklist = [(unknown[i], i) for i in np.nonzero(interior)[0]]
+    heapq.heapify(worklist)
+
+    def apply(known, unknown, worklist, i, crease_angles, answer):
+        add_node_creases(known, i, neighbors[i], answer)
+        unknown[i] = 0
+        for j, angle in zip(neighbors[i], crease_angles):
+            if angle is None:
+                unknown[j] -= 1
+                if interior[j]:
+                    heapq.heappush(worklist, (unknown[j], j))
+
+    stack = [(known_creases.copy(), unknown, worklist)]
+    seen = set()
+    solutions = []
+    while len(stack) > 0 and len(solutions) < max_solutions:
+        known, unknown, worklist = stack.pop()
+        choices = None
+        while len(worklist) > 0:
+            count, i = heapq.heappop(worklist)
+            if count != unknown[i]:
+                continue  # Out of date
+            if count > 3:
+                break  # Every node left is underconstrained
+            crease_angles = [known.get((i, j)) for j in neighbors[i]]
+            ans = solve_node(neighbor_angles[i], crease_angles)
+            if _profiler is not None:
+                _profiler.count('node_solves')
+            if isinstance(ans, numbers.Number):
+                choices = []
+                break
+            if count == 0:
+                continue  # Consistent, and nothing to add
+            scored = []
+            for answer in ans:
+                score = _check_crease_types(i, neighbors[i], crease_angles,
+                    answer, type_map)
+                if score is not None:
+                    scored.append((score, answer))
+            if len(scored) == 1:
+                apply(known, unknown, worklist, i, crease_angles, scored[0][1])
+                continue
+            # Worst first, so the best choice ends up on top of the stack
+            scored.sort(key=lambda x: x[0])
+            choices = [answer for score, answer in scored]
+            break
+
+        if choices is None:
+            solutions.append(known)
+            continue
+        for answer in choices:
+            known2 = known.copy()
+            unknown2 = unknown.copy()
+            worklist2 = list(worklist)
+            apply(known2, unknown2, worklist2, i, crease_angles, answer)
+            key = frozenset((e, round(a, 9)) for e, a in known2.items()
+                if e[0] < e[1])
+            if key in seen:
+                continue
+            seen.add(key)
+            stack.append((known2, unknown2, worklist2))
+        if _profiler is not None:
+            _profiler.count('branches', len(choices))
+            _profiler.peak('search_stack', len(stack))
+
+    return solutions
+
+
+class TestSearchPattern(TwoNodeTestCase):
+    def test1(self):
+        known_creases = add_node_creases({}, 4, [7], [160])
+        crease_types = [''] * 10 + ['M', '', 'V', '', '', '', '']
+        solutions = search_pattern(self.nodes, self.creases, known_creases,
+            crease_types)
+        self.assertEqual(solutions, [])
+
+        # Inconsistent driving creases
+        known_creases = add_node_creases(known_creases, 4, [6], [100])
+        known_creases = add_node_creases(known_creases, 5, [9], [100])
+        solutions = search_pattern(self.nodes, self.creases, known_creases)
+        self.assertEqual(solutions, [])
+
+    def test2(self):
+        neighbors, neighbor_angles = get_neighbors(self.nodes, self.creases)
+        known_creases = add_node_creases({}, 4, [7], [160])
+        solutions = search_pattern(self.nodes, self.creases, known_creases,
+            max_solutions=10)
+        self.assertEqual(len(solutions), 4)
+        for known_creases in solutions:
+            for i in (4, 5):
+                crease_angles = [known_creases[(i, j)] for j in neighbors[i]]
+                error = node_closure_error(neighbor_angles[i], crease_angles)
+                self.assertTrue(error < self.eps)
+
+    def test3(self):
+        known_creases = add_node_creases({}, 4, [7], [160])
+        crease_types = [''] * 10 + ['M', 'V', 'M', 'M', '', '', '']
+        solutions = search_pattern(self.nodes, self.creases, known_creases,
+            crease_types, max_solutions=10)
+        self.assertEqual(len(solutions), 2)
+        for solution in solutions:
+            self.assertTrue(solution[(4, 6)] > 180)
+            self.assertTrue(solution[(4, 8)] > 180)
+            self.assertTrue(solution[(4, 5)] > 180)
+
+        # Labeled creases come first, then unlabeled creases near flat
+        solutions = search_pattern(self.nodes, self.creases, known_creases,
+            crease_types)
+        self.assertEqual(len(solutions), 1)
+        self.assertTrue(np.fabs(solutions[0][(5, 9)] - 180) < 10)
+
+
+def _solve_degree4(neighbor_angles, known_index, angles):
+    """
+    solve_node for a node with four creases, one of them known, for many
+    values of the known crease angle at once.  Follows solve_node step by
+    step on arrays.  Returns (values, count): values has shape (k, 2, 4),
+    holding both branches, and count holds the number of solutions, or the
+    error code from solve_node, or 0 where a zero length side calls for the
+    special cases of solve_node (solve those with solve_node itself).
+    """
+    sides = np.array(neighbor_angles, dtype='float64')
+    angles = np.asarray(angles, dtype='float64')
+    nk = angles.shape[0]
+    if np.any(sides > 180.0) or np.any(sides < 0):
+        return np.zeros((nk, 2, 4)), np.full(nk, -4 if np.any(sides > 180.0)
+            else -5, dtype='int32')
+    d2r = np.pi / 180
+    i = known_index
+    p = (i - 1) % 4
+    q = (i + 1) % 4
+    b = sides[p]
+    c = sides[i]
+    angle = np.mod(angles, 360)
+    sign = np.where(angle > 180, -1.0, 1.0)
+    angle = np.where(angle > 180, 360 - angle, angle)
+    new_side = find_opposite_side(angle, b, c)
+    A, B, C = _spherical_triangle_angles(new_side * d2r, b * d2r, c * d2r)
+    offsets = np.zeros((nk, 4))
+    offsets[:,p] = sign * C / d2r
+    offsets[:,q] = sign * B / d2r
+
+    live = [k for k in range(4) if k != i]
+    triangle = np.empty((nk, 3))
+    for n, k in enumerate(live):
+        triangle[:,n] = new_side if k == p else sides[k]
+    solutions, opposites, count = solve_triangles(triangle)
+    eps = 1e-13
+    special = (new_side < eps) | (b < eps) | (c < eps) | \
+        np.any(triangle < 1e-7 * 180 / np.pi, axis=1)
+    count[special & (count > 0)] = 0
+
+    values = np.empty((nk, 2, 4))
+    for n, branch in enumerate((solutions, opposites)):
+        v = branch + offsets[:,live]
+        with np.errstate(invalid='ignore'):
+            v = np.where(v > 360, np.mod(v, 360), v)
+            v = np.where(v < 0, np.mod(v, 360), v)
+        values[:,n,live] = v
+        values[:,n,i] = angles
+    return values, count
+
+
+class VertexSolutionCache(object):
+    """
+    Solutions of solve_node, cached for nodes that share the same geometry,
+    as the nodes of a regular tessellation do.
+
+    Entries are keyed by the sector angles (neighbor_angles, rounded to
+    multiples of quantum degrees) and by which creases are known.  For a
+    node with four creases, one of them known, the solution depends on just
+    the one known angle, so the first lookup tabulates both branches at
+    every multiple of resolution degrees around the circle; later lookups
+    interpolate the table with cubic (Catmull-Rom) splines, and solve_many
+    does this for many angles at once.  When the table is made, each
+    interval is checked against exact solutions at its quarter points, and
+    intervals where interpolation is off by more than tolerance degrees, or
+    where the number of solutions changes, are solved exactly instead.
+    Other nodes are always solved with solve_node.
+
+    At most max_entries tables are kept, and the least recently used is
+    dropped to make room for a new one.
+    """
+    def __init__(self, resolution=0.1, tolerance=1e-7, max_entries=64,
+            quantum=1e-9):
+        self.resolution = resolution
+        self.tolerance = tolerance
+        self.max_entries = max_entries
+        self.quantum = quantum
+        self.tables = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.tables)
+
+    def _interpolate(self, table, x):
+        # Catmull-Rom spline through the periodic table, at angles x
+        g = table['values'].shape[0]
+        u = np.mod(x, 360) / self.resolution
+        k = np.floor(u).astype('int64') % g
+        t = (u - np.floor(u))[:,np.newaxis,np.newaxis]
+        values = table['values']
+        p1 = values[k]
+        p0 = p1 + _angle_difference(values[(k - 1) % g], p1)
+        p2 = p1 + _angle_difference(values[(k + 1) % g], p1)
+        p3 = p1 + _angle_difference(values[(k + 2) % g], p1)
+        result = 0.5 * (2 * p1 + (p2 - p0) * t +
+            (2 * p0 - 5 * p1 + 4 * p2 - p3) * t**2 +
+            (3 * p1 - p0 - 3 * p2 + p3) * t**3)
+        return np.mod(result, 360), k
+
+    def _make_table(self, neighbor_angles, known_index):
+        g = int(round(360.0 / self.resolution))
+        x = np.arange(g) * self.resolution
+        values, count = _solve_degree4(neighbor_angles, known_index, x)
+        table = {'values': values, 'count': count}
+        # An interval is good if the four points the spline uses all have
+        # the same number of solutions, and it is accurate in between.
+        ok = count > 0
+        for d in (-1, 1, 2):
+            ok &= np.roll(count, -d) == count
+        for t in (0.25, 0.75):
+            interpolated, k = self._interpolate(table, x + t * self.resolution)
+            exact, exact_count = _solve_degree4(neighbor_angles, known_index,
+                x + t * self.resolution)
+            error = np.amax(np.fabs(_angle_difference(interpolated, exact)),
+                axis=(1, 2))
+            with np.errstate(invalid='ignore'):
+                ok &= (exact_count == count) & (error <= self.tolerance)
+        table['ok'] = ok
+        return table
+
+    def _table(self, neighbor_angles, known_index):
+        sectors = np.round(np.asarray(neighbor_angles, dtype='float64') /
+            self.quantum).astype('int64')
+        key = (tuple(sectors.tolist()), known_index)
+        if key in self.tables:
+            table = self.tables.pop(key)
+            self.hits += 1
+            if _profiler is not None:
+                _profiler.count('vertex_cache_hits')
+        else:
+            self.misses += 1
+            table = self._make_table(neighbor_angles, known_index)
+        self.tables[key] = table
+        while len(self.tables) > self.max_entries:
+            self.tables.popitem(last=False)
+        return table
+
+    def solve(self, neighbor_angles, crease_angles):
+        """Same as solve_node(neighbor_angles, crease_angles)."""
+        known = [isinstance(x, numbers.Number) for x in crease_angles]
+        if len(known) != 4 or sum(known) != 1:
+            return solve_node(neighbor_angles, crease_angles)
+        i = known.index(True)
+        return self.solve_many(neighbor_angles, i, [crease_angles[i]])[0]
+
+    def solve_many(self, neighbor_angles, known_index, angles):
+        """
+        Solve a node with four creases for many values of the one known
+        crease angle (crease known_index) at once.  Returns a list with the
+        solutions (as from solve_node) for each angle.
+        """
+        table = self._table(neighbor_angles, known_index)
+        angles = np.asarray(angles, dtype='float64')
+        values, k = self._interpolate(table, angles)
+        values[:,:,known_index] = angles[:,np.newaxis]
+        count = table['count'][k]
+        redo = np.nonzero(~table['ok'][k])[0]
+        if len(redo) > 0:
+            values[redo], count[redo] = _solve_degree4(neighbor_angles,
+                known_index, angles[redo])
+        answers = []
+        for i in range(angles.shape[0]):
+            if count[i] < 0:
+                answers.append(int(count[i]))
+            elif count[i] == 0:
+                crease_angles = [None] * 4
+                crease_angles[known_index] = angles[i]
+                answers.append(solve_node(neighbor_angles, crease_angles))
+            else:
+                answers.append(tuple(values[i,:count[i]].tolist()))
+        return answers
+
+
+class TestVertexSolutionCache(TwoNodeTestCase):
+    def test1(self):
+        cache = VertexSolutionCache()
+        rng = np.random.RandomState(0)
+        worst = 0
+        fallback = 0
+        for i in (4, 5):
+            for x in rng.uniform(0, 360, 50).tolist() + [180.0, 0.0, 359.9]:
+                for index in range(4):
+                    crease_angles = [None] * 4
+                    crease_angles[index] = x
+                    expected = solve_node(self.neighbor_angles[i], crease_angles)
+                    actual = cache.solve(self.neighbor_angles[i], crease_angles)
+                    if isinstance(expected, numbers.Number):
+                        self.assertEqual(actual, expected)
+                        continue
+                    self.assertEqual(len(actual), len(expected))
+                    self.assertEqual([a[index] for a in actual], [x] * len(actual))
+                    worst = max(worst, np.amax(np.fabs(_angle_difference(
+                        actual, expected))))
+        self.assertTrue(worst < 1e-7)
+        self.assertEqual(len(cache), 8)
+        self.assertEqual(cache.misses, 8)
+
+    def test2(self):
+        # Least recently used tables are dropped
+        cache = VertexSolutionCache(resolution=5, max_entries=2)
+        cache.solve(self.neighbor_angles[4], [100, None, None, None])
+        cache.solve(self.neighbor_angles[5], [100, None, None, None])
+        cache.solve(self.neighbor_angles[4], [120, None, None, None])
+        cache.solve(self.neighbor_angles[4], [None, 120, None, None])
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.hits, 1)
+        cache.solve(self.neighbor_angles[5], [100, None, None, None])
+        self.assertEqual(cache.misses, 4)
+        # Other nodes are solved exactly
+        sectors = [60, 80, 70, 90, 60]
+        crease_angles = [170, None, 190, None, None]
+        self.assertEqual(cache.solve(sectors, crease_angles),
+            solve_node(sectors, crease_angles))
+
+    def test3(self):
+        cache = VertexSolutionCache()
+        for angle in (170, 120):
+            known_creases = add_node_creases({}, 4, [7], [angle])
+            expected = solve_pattern(self.nodes, self.creases,
+                dict(known_creases), self.neighbors, self.neighbor_angles)
+            actual = solve_pattern(self.nodes, self.creases, known_creases,
+                self.neighbors, self.neighbor_angles, cache=cache)
+            for edge in expected:
+                self.assertTrue(np.fabs(_angle_difference(actual[edge],
+                    expected[edge])) < 1e-7)
+
+
+def plan_drivers(node_list, crease_list, crease_types=None, neighbors=None,
+        neighbor_angles=None):
+    """
+    Choose driving creases for a crease pattern, and the order to solve its
+    nodes in, so that solving needs no search at run time.
+
+    solve_pattern is simulated without any angles: whenever no interior node
+    is left with three or fewer unknown creases, one more crease is made a
+    driver, at the node with the fewest unknowns.  Of that node's unknown
+    creases, labeled (mountain or valley) ones are preferred, then ones
+    whose other end becomes solvable, then ones going to another interior
+    node.  As the README suggests, drivers at the same node share free
+    parameters where they can: labeled drivers are set equal to the node's
+    first driver with the same label, and unlabeled drivers after the
+    node's first one are held flat.  Since each node is still solved with
+    at most three unknowns, these ties never make a node overconstrained.
+
+    Returns a hash with:
+
+    drivers      list of driving creases (pairs of node indices)
+    parameter    for each driver, the free parameter it follows, or -1 if it
+                 is held flat at 180 degrees
+    dof          number of free parameters
+    generic_dof  creases at interior nodes minus 3 per interior node: the
+                 degrees of freedom of the pattern for generic geometry (loops
+                 of creases make this smaller than dof; special geometry, such
+                 as Miura-ori, can fold anyway)
+    schedule     the order of solution, in the form recorded by solve_pattern:
+                 one tuple (node, solved) per call of solve_node
+    """
+    if neighbors is None or neighbor_angles is None:
+        neighbors, neighbor_angles = get_neighbors(node_list, crease_list,
+            check=True)
+    if crease_types is None:
+        crease_types = ['' for i in range(crease_list.shape[0])]
+    type_map = get_crease_type_map(crease_list, crease_types)
+    interior = ~get_boundary_nodes(node_list)
+
+    known = set()
+    unknown = np.array([len(n) for n in neighbors], dtype='int32')
+    drivers = []
+    parameter = []
+    groups = {}  # (node, label) -> free parameter of drivers there
+    dof = 0
+    schedule = []
+
+    def make_known(i, j):
+        known.add((i, j))
+        known.add((j, i))
+        unknown[i] -= 1
+        unknown[j] -= 1
+
+    while True:
+        # Solve everything that can be solved
+        worklist = [(unknown[i], i) for i in np.nonzero(interior)[0]
+            if unknown[i] > 0]
+        heapq.heapify(worklist)
+        while len(worklist) > 0:
+            count, i = heapq.heappop(worklist)
+            if count != unknown[i] or count == 0:
+                continue
+            if count > 3:
+                break
+            solved = [j for j in neighbors[i] if (i, j) not in known]
+            for j in solved:
+                make_known(i, j)
+                if interior[j] and unknown[j] > 0:
+                    heapq.heappush(worklist, (unknown[j], j))
+            schedule.append((i, solved))
+
+        stuck = [(unknown[i], i) for i in np.nonzero(interior)[0]
+            if unknown[i] > 3]
+        if len(stuck) == 0:
+            break
+        count, i = min(stuck)
+
+        def score(j):
+            return (i, j) in type_map, interior[j] and unknown[j] - 1 <= 3, \
+                bool(interior[j])
+        candidates = [j for j in neighbors[i] if (i, j) not in known]
+        j = max(candidates, key=score)  # First of the best
+        make_known(i, j)
+        label = type_map.get((i, j))
+        if (i, label) in groups:
+            parameter.append(groups[(i, label)])
+        elif label is None and any(key[0] == i for key in groups):
+            parameter.append(-1)
+        else:
+            groups[(i, label)] = dof
+            parameter.append(dof)
+            dof += 1
+        drivers.append((int(i), int(j)))
+
+    creases_at_interior = set()
+    for i in np.nonzero(interior)[0]:
+        for j in neighbors[i]:
+            creases_at_interior.add((min(i, j), max(i, j)))
+    return {
+        'drivers': drivers,
+        'parameter': parameter,
+        'dof': dof,
+        'generic_dof': len(creases_at_interior) - 3 * int(np.sum(interior)),
+        'schedule': schedule,
+    }
+
+
+def solve_planned(plan, parameters, neighbors, neighbor_angles,
+        known_creases=None, branch=0):
+    """
+    Solve a crease pattern by following a plan from plan_drivers: set the
+    driving creases from the free parameters (angles in degrees, one per
+    plan['dof']), and call solve_node on the nodes in the order of
+    plan['schedule'].  known_creases may be a CreaseTable (or hash) to fill
+    in; a new hash is used by default.  Returns known_creases, or the error
+    code from solve_node.
+    """
+    if known_creases is None:
+        known_creases = {}
+    for edge, p in zip(plan['drivers'], plan['parameter']):
+        angle = 180.0 if p < 0 else parameters[p]
+        add_node_creases(known_creases, edge[0], [edge[1]], [angle])
+    for i, solved in plan['schedule']:
+        crease_angles = [None if j in solved else known_creases[(i, j)]
+            for j in neighbors[i]]
+        ans = solve_node(neighbor_angles[i], crease_angles)
+        if isinstance(ans, numbers.Number):
+            return ans
+        add_node_creases(known_creases, i, neighbors[i], ans[min(branch, len(ans) - 1)])
+    return known_creases
+
+
+class TestPlanDrivers(TwoNodeTestCase):
+    def test1(self):
+        plan = plan_drivers(self.nodes, self.creases)
+        self.assertEqual(plan['dof'], 1)
+        self.assertEqual(plan['generic_dof'], 1)
+        self.assertEqual(len(plan['drivers']), 1)
+        self.assertEqual([i for i, solved in plan['schedule']], [4, 5])
+        for angle in (170, 130):
+            known_creases = solve_planned(plan, [angle], self.neighbors,
+                self.neighbor_angles)
+            expected = add_node_creases({}, 4, [plan['drivers'][0][1]],
+                [angle])
+            expected = solve_pattern(self.nodes, self.creases, expected,
+                self.neighbors, self.neighbor_angles)
+            self.assertEqual(sorted(known_creases), sorted(expected))
+            for edge in expected:
+                self.assertTrue(np.fabs(known_creases[edge] - expected[edge]) < 1e-12)
+
+    def test2(self):
+        # The waterbomb needs five drivers at its center, tied to one
+        # parameter for the valleys and one for the mountains
+        node_list, crease_list, crease_types = load_creasepattern(
+            'test.creasepattern')
+        neighbors, neighbor_angles = get_neighbors(node_list, crease_list)
+        plan = plan_drivers(node_list, crease_list, crease_types)
+        self.assertEqual(plan['dof'], 2)
+        self.assertEqual(plan['generic_dof'], 5)
+        self.assertEqual(len(plan['drivers']), 5)
+        type_map = get_crease_type_map(crease_list, crease_types)
+        for edge, p in zip(plan['drivers'], plan['parameter']):
+            self.assertEqual(p, plan['parameter'][0] if
+                type_map[edge] == type_map[plan['drivers'][0]] else 1 - plan['parameter'][0])
+        self.assertEqual(plan['schedule'], [(4, [j for j in neighbors[4]
+            if (4, j) not in plan['drivers']])])
+        known_creases = solve_planned(plan, [160, 190], neighbors,
+            neighbor_angles)
+        crease_angles = [known_creases[(4, j)] for j in neighbors[4]]
+        self.assertTrue(node_closure_error(neighbor_angles[4],
+            crease_angles) < self.eps)
+
+    def test3(self):
+        # A loop of four nodes: one driver, and the last node is
+        # overconstrained, so generic_dof is lower than dof
+        nodes = np.array([(i, j) for j in range(4) for i in range(4)],
+            dtype='float64')
+        creases = [(4 * j + i, 4 * j + i + 1) for j in range(4) for i in range(3)]
+        creases += [(4 * j + i, 4 * j + i + 4) for j in range(3) for i in range(4)]
+        plan = plan_drivers(nodes, np.array(creases))
+        self.assertEqual(plan['dof'], 1)
+        self.assertEqual(plan['generic_dof'], 0)
+        self.assertEqual(sorted(i for i, solved in plan['schedule']),
+            [5, 6, 9, 10])
+        self.assertEqual(len(plan['schedule'][-1][1]), 2)
+
+
+def _cross_matrices(axes):
+    """Cross product matrices [a]x of a stack of vectors of shape (k, 3)."""
+    k = np.zeros((axes.shape[0], 3, 3))
+    k[:,0,1] = -axes[:,2]
+    k[:,0,2] = axes[:,1]
+    k[:,1,0] = axes[:,2]
+    k[:,1,2] = -axes[:,0]
+    k[:,2,0] = -axes[:,1]
+    k[:,2,1] = axes[:,0]
+    return k
+
+
+@_timed('solve')
+def solve_closure(node_list, crease_list, known_creases, initial=None,
+        neighbors=None, neighbor_angles=None, iterations=50, tol=1e-10,
+        damping=1e-3):
+    """
+    Solve all interior nodes of a crease pattern together, for patterns
+    whose creases form loops (like Miura-ori), where solving one node at a
+    time as solve_pattern does gets stuck or is overconstrained.
+
+    At each interior node, rotating by (crease angle - 180) about each crease
+    in turn must give the identity, as in node_closure_error.  The 9 entries
+    of (product - I) at every node are driven to zero by Levenberg-Marquardt
+    steps on the crease angles not given in known_creases, using the sparse
+    Jacobian: the derivative of the product with respect to crease k is
+    A K B, where A is the product of the rotations before crease k, B is the
+    product from crease k on, and K is the cross product matrix of the
+    crease direction.  damping is the starting Levenberg-Marquardt
+    parameter.
+
+    initial gives starting values (keyed like known_creases) for the unknown
+    crease angles, typically the solution of the previous animation frame;
+    the rest start flat, at 180 degrees.  Flat paper is where the branches
+    of the solution meet, so a warm start picks the branch much more
+    reliably than starting flat.
+
+    Returns a copy of known_creases with every crease at an interior node
+    added, or -6 if the largest closure error is still over tol after the
+    given number of iterations.
+    """
+    from scipy.sparse import coo_matrix, diags
+    from scipy.sparse.linalg import spsolve
+
+    if neighbors is None or neighbor_angles is None:
+        neighbors, neighbor_angles = get_neighbors(node_list, crease_list,
+            check=True)
+    interior = np.nonzero(~get_boundary_nodes(node_list))[0]
+    d2r = np.pi / 180
+
+    column = {}
+    x = []
+    vertices = []
+    for i in interior:
+        cols = []
+        fixed = []
+        for j in neighbors[i]:
+            key = (min(i, j), max(i, j))
+            if (i, j) in known_creases:
+                cols.append(-1)
+                fixed.append(known_creases[(i, j)])
+                continue
+            if key not in column:
+                column[key] = len(x)
+                guess = None if initial is None else initial.get((i, j))
+                x.append(180.0 if guess is None else guess)
+            cols.append(column[key])
+            fixed.append(0.0)
+        directions = np.concatenate([[0], np.cumsum(neighbor_angles[i])[:-1]])
+        axes = np.zeros((len(cols), 3))
+        axes[:,0] = np.cos(directions * d2r)
+        axes[:,1] = np.sin(directions * d2r)
+        vertices.append((axes, _cross_matrices(axes) * d2r,
+            np.array(cols, dtype='int32'), np.array(fixed, dtype='float64')))
+    x = np.array(x, dtype='float64')
+    nx = x.shape[0]
+
+    def evaluate(x):
+        residual = np.empty((len(vertices), 9))
+        data = []
+        rows = []
+        cols = []
+        for v, (axes, cross, index, fixed) in enumerate(vertices):
+            angles = np.where(index >= 0, x[index], fixed)
+            R = axis_angle_rotations(axes, angles - 180)
+            n = R.shape[0]
+            before = np.empty((n + 1, 3, 3))
+            after = np.empty((n + 1, 3, 3))
+            before[0] = np.eye(3)
+            after[n] = np.eye(3)
+            for k in range(n):
+                before[k + 1] = np.dot(before[k], R[k])
+                after[n - 1 - k] = np.dot(R[n - 1 - k], after[n - k])
+            residual[v] = (before[n] - np.eye(3)).ravel()
+            free = np.nonzero(index >= 0)[0]
+            dP = np.einsum('kij,kjl,klm->kim', before[free], cross[free],
+                after[free])
+            data.append(dP.reshape((-1, 9)).ravel())
+            rows.append(np.tile(9 * v + np.arange(9), len(free)))
+            cols.append(np.repeat(index[free], 9))
+        J = coo_matrix((np.concatenate(data + [[]]),
+            (np.concatenate(rows + [[]]).astype('int64'),
+            np.concatenate(cols + [[]]).astype('int64'))),
+            shape=(9 * len(vertices), nx)).tocsr()
+        return residual.ravel(), J
+
+    residual, J = evaluate(x)
+    cost = np.dot(residual, residual)
+    lam = damping
+    for iteration in range(iterations):
+        if nx == 0 or np.amax(np.fabs(residual)) <= tol:
+            break
+        JtJ = (J.T * J).tocsc()
+        g = J.T * residual
+        step = spsolve(JtJ + diags(lam * (JtJ.diagonal() + 1e-12)), -g)
+        x_new = x + step
+        residual_new, J_new = evaluate(x_new)
+        cost_new = np.dot(residual_new, residual_new)
+        if cost_new < cost:
+            x, residual, J, cost = x_new, residual_new, J_new, cost_new
+            lam = lam / 10
+        else:
+            lam = lam * 10
+    if len(vertices) > 0 and np.amax(np.fabs(residual)) > tol:
+        return -6
+
+    result = known_creases.copy()
+    x = np.mod(x, 360)
+    for (a, b), k in column.items():
+        result[(a, b)] = x[k]
+        result[(b, a)] = x[k]
+    return result
+
+
+class TestClosure(unittest.TestCase):
+    """
+    A 3 by 3 Miura-ori: four interior nodes joined in a loop of creases.
+    """
+    eps = 1e-8
+
+    def setUp(self):
+        shift = np.tan(20 * np.pi / 180)
+        self.nodes = np.array([(i + (shift if j % 2 == 1 and 0 < i < 3 else 0),
+            j) for j in range(4) for i in range(4)], dtype='float64')
+        creases = []
+        self.crease_types = []
+        for j in range(4):
+            for i in range(4):
+                if i < 3:
+                    creases.append((4 * j + i, 4 * j + i + 1))
+                    self.crease_types.append(
+                        '' if j in (0, 3) else 'MV'[(i + j + 1) % 2])
+                if j < 3:
+                    creases.append((4 * j + i, 4 * j + i + 4))
+                    self.crease_types.append('' if i in (0, 3) else 'MV'[i % 2])
+        self.creases = np.array(creases)
+        self.neighbors, self.neighbor_angles = get_neighbors(self.nodes,
+            self.creases)
+
+    def search(self, angle):
+        return search_pattern(self.nodes, self.creases, {(5, 6): angle,
+            (6, 5): angle}, self.crease_types, self.neighbors,
+            self.neighbor_angles)[0]
+
+    def check(self, known_creases, expected):
+        for i in (5, 6, 9, 10):
+            crease_angles = [known_creases[(i, j)] for j in self.neighbors[i]]
+            self.assertTrue(node_closure_error(self.neighbor_angles[i],
+                crease_angles) < self.eps)
+            for j in self.neighbors[i]:
+                self.assertTrue(np.fabs(_angle_difference(known_creases[(i, j)],
+                    expected[(i, j)])) < 1e-6)
+
+    def test1(self):
+        # From a perturbed solution, converge back to it
+        expected = self.search(150)
+        rng = np.random.RandomState(1)
+        initial = dict((e, a + rng.uniform(-3, 3)) for e, a in expected.items())
+        known_creases = solve_closure(self.nodes, self.creases,
+            {(5, 6): 150, (6, 5): 150}, initial, self.neighbors,
+            self.neighbor_angles)
+        self.check(known_creases, expected)
+
+    def test2(self):
+        # Warm started from the previous frame, follow the fold
+        known_creases = self.search(170)
+        for angle in (160, 150, 140, 130):
+            drivers = {(5, 6): angle, (6, 5): angle}
+            known_creases = solve_closure(self.nodes, self.creases, drivers,
+                known_creases, self.neighbors, self.neighbor_angles)
+            self.check(known_creases, self.search(angle))
+
+    def test3(self):
+        expected = self.search(150)
+        initial = dict((e, a + 5) for e, a in expected.items())
+        ans = solve_closure(self.nodes, self.creases, {(5, 6): 150, (6, 5): 150},
+            initial, self.neighbors, self.neighbor_angles, iterations=1)
+        self.assertEqual(ans, -6)
+
+
 def add_flat_creases(known_creases, triangles):
+    if isinstance(known_creases, CreaseTable):
+        pos = known_creases.index(np.concatenate([triangles[:,[0,1]],
+            triangles[:,[1,2]], triangles[:,[2,0]]]))
+        if np.any(pos < 0):
+            raise KeyError('triangle edge not in crease table')
+        unknown = pos[~known_creases.known[pos]]
+        known_creases.angles[unknown] = 180
+        known_creases.known[unknown] = True
+        return known_creases
     for i in range(triangles.shape[0]):
         edges = [
             (triangles[i,0], triangles[i,1]),
@@ -503,6 +2068,176 @@ def add_flat_creases(known_creases, triangles):
     return known_creases
 
 
+class CreaseTable(object):
+    """
+    Crease angles for a fixed set of edges, stored in arrays rather than in a
+    hash keyed by both (a, b) and (b, a).  Each edge is stored once, as a
+    canonical key a * num_nodes + b with a < b, in the sorted array
+    edge_keys (edges holds the same pairs of node indices);
+    angles holds the crease angle of each edge and known says whether it has
+    been set.  Lookups use a binary search of keys.
+
+    A CreaseTable can be used anywhere a known_creases hash is expected:
+    table[(a, b)] and table[(b, a)] are the same crease, reading an unknown
+    crease raises KeyError, and "in" tests whether a crease is known.  Only
+    edges given when the table was made can be set.  For many edges at once,
+    use lookup and index instead.
+    """
+    def __init__(self, num_nodes, edges):
+        edges = np.sort(np.asarray(edges, dtype='int64').reshape((-1, 2)), axis=1)
+        self.num_nodes = num_nodes
+        self.edge_keys = np.unique(edges[:,0] * num_nodes + edges[:,1])
+        self.edges = np.array([self.edge_keys // num_nodes, self.edge_keys % num_nodes]).T
+        self.angles = np.zeros(self.edge_keys.shape[0])
+        self.known = np.zeros(self.edge_keys.shape[0], dtype='bool')
+
+    def index(self, edges):
+        """
+        Return the positions in the table of an array of edges of shape (k,
+        2), in either order, or -1 for edges not in the table.
+        """
+        edges = np.asarray(edges, dtype='int64').reshape((-1, 2))
+        keys = np.minimum(edges[:,0], edges[:,1]) * self.num_nodes + \
+            np.maximum(edges[:,0], edges[:,1])
+        pos = np.searchsorted(self.edge_keys, keys)
+        pos[pos == self.edge_keys.shape[0]] = 0
+        pos[self.edge_keys[pos] != keys] = -1
+        return pos
+
+    def lookup(self, edges):
+        """
+        Return the crease angles of an array of edges of shape (k, 2).
+        Raises KeyError if any of them is not known.
+        """
+        pos = self.index(edges)
+        if np.any(pos < 0) or not np.all(self.known[pos]):
+            raise KeyError('unknown crease')
+        return self.angles[pos]
+
+    def _position(self, edge):
+        a, b = int(edge[0]), int(edge[1])
+        if a > b:
+            a, b = b, a
+        key = a * self.num_nodes + b
+        pos = np.searchsorted(self.edge_keys, key)
+        if pos == self.edge_keys.shape[0] or self.edge_keys[pos] != key:
+            return -1
+        return pos
+
+    def __getitem__(self, edge):
+        pos = self._position(edge)
+        if pos < 0 or not self.known[pos]:
+            raise KeyError(edge)
+        return self.angles[pos]
+
+    def __setitem__(self, edge, angle):
+        pos = self._position(edge)
+        if pos < 0:
+            raise KeyError(edge)
+        self.angles[pos] = angle
+        self.known[pos] = True
+
+    def __delitem__(self, edge):
+        pos = self._position(edge)
+        if pos < 0 or not self.known[pos]:
+            raise KeyError(edge)
+        self.known[pos] = False
+
+    def __contains__(self, edge):
+        pos = self._position(edge)
+        return pos >= 0 and self.known[pos]
+
+    def __len__(self):
+        # Like the hash, count each known crease in both orders
+        return 2 * int(np.sum(self.known))
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def get(self, edge, default=None):
+        pos = self._position(edge)
+        if pos < 0 or not self.known[pos]:
+            return default
+        return self.angles[pos]
+
+    def keys(self):
+        edges = self.edges[self.known].tolist()
+        return [(a, b) for a, b in edges] + [(b, a) for a, b in edges]
+
+    def items(self):
+        return [(e, self[e]) for e in self.keys()]
+
+    def copy(self):
+        table = CreaseTable.__new__(CreaseTable)
+        table.num_nodes = self.num_nodes
+        table.edge_keys = self.edge_keys  # never changed, so can be shared
+        table.edges = self.edges
+        table.angles = self.angles.copy()
+        table.known = self.known.copy()
+        return table
+
+
+def make_crease_table(node_list, crease_list, triangles=None):
+    """
+    Make an empty CreaseTable for the creases of a crease pattern, and for
+    the extra edges of its triangulation if triangles is given.
+    """
+    edges = [crease_list]
+    if triangles is not None:
+        edges += [triangles[:,[0,1]], triangles[:,[1,2]], triangles[:,[2,0]]]
+    return CreaseTable(node_list.shape[0], np.concatenate(edges))
+
+
+class TestCreaseTable(TwoNodeTestCase):
+    eps = 1e-12
+
+    def test1(self):
+        table = make_crease_table(self.nodes, self.creases, self.triangles)
+        self.assertEqual(table.edge_keys.shape[0], 23)
+        self.assertEqual(len(table), 0)
+        self.assertFalse((4, 7) in table)
+        self.assertRaises(KeyError, lambda: table[(4, 7)])
+        table[(7, 4)] = 160
+        self.assertTrue((4, 7) in table)
+        self.assertEqual(table[(4, 7)], 160)
+        self.assertEqual(table.get((4, 6)), None)
+        self.assertEqual(sorted(table.keys()), [(4, 7), (7, 4)])
+        # Not an edge of the pattern
+        self.assertRaises(KeyError, table.__setitem__, (0, 2), 180)
+        self.assertFalse((0, 2) in table)
+        self.assertEqual(list(table.index([[4, 7], [7, 4], [0, 2]])),
+            [table.index([[4, 7]])[0]] * 2 + [-1])
+        copy = table.copy()
+        copy[(4, 6)] = 170
+        self.assertFalse((4, 6) in table)
+
+    def test2(self):
+        known_creases = self.solve(130)
+        table = make_crease_table(self.nodes, self.creases, self.triangles)
+        table[(4, 7)] = 130
+        table = solve_pattern(self.nodes, self.creases, table, self.neighbors,
+            self.neighbor_angles)
+        table = add_flat_creases(table, self.triangles)
+        self.assertEqual(len(table), len(known_creases))
+        for edge in known_creases:
+            self.assertEqual(table[edge], known_creases[edge])
+
+        frames, nodes3d = propagate_frames(self.nodes, self.triangles,
+            known_creases)
+        for by_level in (False, True):
+            frames2, nodes3d2 = propagate_frames(self.nodes, self.triangles,
+                table, by_level=by_level)
+            self.assertTrue(np.amax(np.fabs(frames - frames2)) < self.eps)
+            self.assertTrue(np.amax(np.fabs(nodes3d - nodes3d2)) < self.eps)
+
+        table = make_crease_table(self.nodes, self.creases)
+        table[(4, 7)] = 130
+        solutions = search_pattern(self.nodes, self.creases, table,
+            max_solutions=10)
+        self.assertEqual(len(solutions), 4)
+        self.assertFalse((4, 6) in table)
+
+
 def get_edge2triangle(triangles):
     """
     Build a hash that returns the triangle index corresponding to the given
@@ -519,6 +2254,327 @@ def get_edge2triangle(triangles):
     return edge2triangle
 
 
+def get_triangle_adjacency(triangles):
+    """
+    For each triangle and each of its edges (from node k to node k+1, for k
+    = 0, 1, 2), find the triangle on the other side of that edge.  Returns an
+    array of shape (triangles, 3), with -1 for edges on the edge of the
+    paper.
+    """
+    nt = triangles.shape[0]
+    nn = np.amax(triangles) + 1 if nt > 0 else 0
+    edges = np.concatenate([triangles[:,[0,1]], triangles[:,[1,2]],
+        triangles[:,[2,0]]]).astype('int64')
+    keys = edges[:,0] * nn + edges[:,1]
+    twin_keys = edges[:,1] * nn + edges[:,0]
+    order = np.argsort(keys)
+    pos = np.searchsorted(keys[order], twin_keys)
+    pos = np.minimum(pos, max(keys.shape[0] - 1, 0))
+    found = keys[order][pos] == twin_keys
+    adjacency = np.where(found, np.tile(np.arange(nt), 3)[order][pos], -1)
+    return adjacency.reshape((3, nt)).T
+
+
+def _ear_clip(points, polygon):
+    """
+    Triangulate a simple polygon, given as a list of node indices in
+    counter-clockwise order, by ear clipping.  Returns a list of triangles
+    (triples of node indices), counter-clockwise.
+    """
+    eps = 1e-12
+    polygon = list(polygon)
+    triangles = []
+    while len(polygon) > 3:
+        n = len(polygon)
+        corners = points[polygon]
+        for i in range(n):
+            a, b, c = corners[i-1], corners[i], corners[(i+1) % n]
+            ab = b - a
+            bc = c - b
+            if ab[0] * bc[1] - ab[1] * bc[0] <= eps:
+                continue  # Reflex or straight corner
+            # No other corner may be inside (or on the edge of) the ear
+            others = np.delete(corners, [(i-1) % n, i, (i+1) % n], axis=0)
+            inside = np.ones(others.shape[0], dtype='bool')
+            for p, q in ((a, b), (b, c), (c, a)):
+                inside &= (q[0] - p[0]) * (others[:,1] - p[1]) - \
+                    (q[1] - p[1]) * (others[:,0] - p[0]) >= -eps
+            if not np.any(inside):
+                break
+        else:
+            raise ValueError('could not triangulate face %r' % (polygon,))
+        triangles.append((polygon[i-1], polygon[i], polygon[(i+1) % n]))
+        del polygon[i]
+    triangles.append(tuple(polygon))
+    return triangles
+
+
+def triangulate_faces(node_list, crease_list):
+    """
+    Triangulate the paper without the "triangle" package.  The creases split
+    the paper into faces; these are found by walking around each face,
+    turning at each node onto the next crease clockwise from the one we
+    arrived on.  Faces traced counter-clockwise (positive area) are inside
+    the paper, and each one is triangulated by ear clipping.  No nodes are
+    added, so the creases are kept as triangle edges, as with a constrained
+    triangulation.
+
+    The paper edge must be made of creases, and every crease must separate
+    two faces (no loose ends).  Returns an array of triangles of shape
+    (triangles, 3), counter-clockwise.
+    """
+    nn = node_list.shape[0]
+    indptr, indices, sector_angles = get_neighbors_csr(node_list, crease_list,
+        check=False)
+    degree = np.diff(indptr)
+    src = np.repeat(np.arange(nn), degree)
+    # Position of the reverse of each directed crease
+    keys = src * nn + indices
+    order = np.argsort(keys)
+    twin = order[np.searchsorted(keys[order], indices * nn + src)]
+    # Next directed crease around the face to the left of each one
+    position = twin - indptr[indices]
+    following = indptr[indices] + np.mod(position - 1, degree[indices])
+
+    visited = np.zeros(keys.shape[0], dtype='bool')
+    triangles = []
+    for start in range(keys.shape[0]):
+        if visited[start]:
+            continue
+        face = []
+        h = start
+        while not visited[h]:
+            visited[h] = True
+            face.append(src[h])
+            h = following[h]
+        corners = node_list[face]
+        area = np.sum(corners[:,0] * np.roll(corners[:,1], -1) -
+            np.roll(corners[:,0], -1) * corners[:,1])
+        if area > 0:
+            triangles.extend(_ear_clip(node_list, face))
+    return np.array(triangles, dtype='int32').reshape((-1, 3))
+
+
+_triangulations = collections.OrderedDict()
+
+
+def pattern_hash(node_list, crease_list):
+    """
+    A hash of the topology of a crease pattern (node locations and creases),
+    for caching results that only depend on it.
+    """
+    h = hashlib.sha1()
+    for a in (np.asarray(node_list, dtype='float64'),
+            np.asarray(crease_list, dtype='int64')):
+        h.update(str(a.shape).encode('ascii'))
+        h.update(np.ascontiguousarray(a).tobytes())
+    return h.hexdigest()
+
+
+def _save_triangulation(cache_dir, filename, max_entries, **arrays):
+    # Written under a temporary name and renamed into place, so that other
+    # processes never see a partly written file, then the least recently
+    # used files beyond max_entries are removed.  Files may be removed by
+    # other processes at any time.
+    if not os.path.isdir(cache_dir):
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            if not os.path.isdir(cache_dir):
+                raise
+    fd, tempname = tempfile.mkstemp(suffix='.tmp', dir=cache_dir)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, **arrays)
+        os.rename(tempname, filename)
+    except Exception:
+        os.remove(tempname)
+        raise
+    cached = []
+    for name in os.listdir(cache_dir):
+        if name.endswith('.npz'):
+            name = os.path.join(cache_dir, name)
+            try:
+                cached.append((os.path.getmtime(name), name))
+            except OSError:
+                pass
+    cached.sort()
+    for mtime, name in cached[:-max_entries]:
+        try:
+            os.remove(name)
+        except OSError:
+            pass
+
+
+@_timed('triangulate')
+def triangulate_pattern(node_list, crease_list, cache_dir=None,
+        max_entries=64, memory_entries=16):
+    """
+    Triangulate the paper, keeping the creases as triangle edges, with a
+    constrained Delaunay triangulation from the "triangle" package, or with
+    triangulate_faces if that package is not installed.  The topology never
+    changes during a fold, so results are cached, keyed by pattern_hash: the
+    last memory_entries patterns in memory, and, if cache_dir is given, the
+    last max_entries patterns on disk (one .npz file each, so other processes
+    and later runs can share them).  Both caches evict the least recently
+    used pattern.
+
+    Returns a dict with 'vertices', 'triangles', 'adjacency' (from
+    get_triangle_adjacency), and 'edge2triangle' (as from
+    get_edge2triangle).  The dict may be shared with other callers, so it
+    must not be changed; its arrays are read-only.
+    """
+    key = pattern_hash(node_list, crease_list)
+    if key in _triangulations:
+        if _profiler is not None:
+            _profiler.count('triangulation_hits')
+        result = _triangulations.pop(key)
+        _triangulations[key] = result
+        return result
+
+    filename = None
+    loaded = False
+    if cache_dir is not None:
+        filename = os.path.join(cache_dir, key + '.npz')
+    if filename is not None and os.path.exists(filename):
+        # Another process may be evicting the file; if it cannot be read,
+        # triangulate again
+        try:
+            with np.load(filename) as data:
+                vertices = data['vertices']
+                triangles = data['triangles']
+                adjacency = data['adjacency']
+                edges = data['edges']
+                edge_triangles = data['edge_triangles']
+            loaded = True
+        except Exception:
+            pass
+    if loaded:
+        if _profiler is not None:
+            _profiler.count('triangulation_hits')
+        try:
+            os.utime(filename, None)  # Mark as recently used
+        except OSError:
+            pass
+    else:
+        try:
+            import triangle
+            t = triangle.triangulate({'vertices': node_list,
+                'segments': crease_list}, 'p')
+            vertices = t['vertices']
+            triangles = t['triangles']
+        except ImportError:
+            vertices = np.array(node_list, dtype='float64')
+            triangles = triangulate_faces(node_list, crease_list)
+        adjacency = get_triangle_adjacency(triangles)
+        edges = np.concatenate([triangles[:,[0,1]], triangles[:,[1,2]],
+            triangles[:,[2,0]]])
+        edge_triangles = np.tile(np.arange(triangles.shape[0]), 3)
+        if filename is not None:
+            _save_triangulation(cache_dir, filename, max_entries,
+                vertices=vertices, triangles=triangles, adjacency=adjacency,
+                edges=edges, edge_triangles=edge_triangles)
+
+    for a in (vertices, triangles, adjacency):
+        a.flags.writeable = False
+    result = {}
+    result['vertices'] = vertices
+    result['triangles'] = triangles
+    result['adjacency'] = adjacency
+    result['edge2triangle'] = dict(zip(
+        [tuple(e) for e in edges.tolist()], edge_triangles.tolist()))
+    _triangulations[key] = result
+    while len(_triangulations) > memory_entries:
+        _triangulations.popitem(last=False)
+    return result
+
+
+class TestTriangulation(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.node_list, self.crease_list, crease_types = \
+            load_creasepattern('test.creasepattern')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        _triangulations.clear()
+
+    def check(self, node_list, triangles):
+        # Counter-clockwise triangles that exactly cover the unit square
+        corners = node_list[triangles]
+        ab = corners[:,1] - corners[:,0]
+        ac = corners[:,2] - corners[:,0]
+        area = (ab[:,0] * ac[:,1] - ab[:,1] * ac[:,0]) / 2
+        self.assertTrue(np.all(area > 0))
+        self.assertTrue(np.fabs(np.sum(area) - 1) < 1e-12)
+
+    def test1(self):
+        triangles = triangulate_faces(self.node_list, self.crease_list)
+        self.assertEqual(triangles.shape, (8, 3))
+        self.check(self.node_list, triangles)
+        adjacency = get_triangle_adjacency(triangles)
+        self.assertEqual(np.sum(adjacency >= 0), 16)
+        for t in range(triangles.shape[0]):
+            for k in range(3):
+                t2 = adjacency[t,k]
+                if t2 >= 0:
+                    self.assertTrue(t in adjacency[t2])
+
+    def test2(self):
+        # Faces that are not triangles, including a concave one
+        node_list = np.array([[0, 0], [1, 0], [1, 1], [0, 1], [0.5, 0.2],
+            [0.5, 1]])
+        crease_list = np.array([[0, 1], [1, 2], [2, 5], [5, 3], [3, 0],
+            [0, 4], [4, 1]])
+        triangles = triangulate_faces(node_list, crease_list)
+        self.assertEqual(triangles.shape, (5, 3))
+        self.check(node_list, triangles)
+        edges = set(tuple(sorted(e)) for t in triangles.tolist()
+            for e in [(t[0], t[1]), (t[1], t[2]), (t[2], t[0])])
+        for e in crease_list.tolist():
+            self.assertTrue(tuple(sorted(e)) in edges)
+
+    def test3(self):
+        t = triangulate_pattern(self.node_list, self.crease_list,
+            cache_dir=self.directory, max_entries=1)
+        self.check(t['vertices'], t['triangles'])
+        self.assertEqual(t['edge2triangle'], get_edge2triangle(t['triangles']))
+        self.assertTrue(triangulate_pattern(self.node_list, self.crease_list) is t)
+        # Shared, so read-only
+        self.assertRaises(ValueError, t['triangles'].__setitem__, 0, 0)
+        key = pattern_hash(self.node_list, self.crease_list)
+        self.assertEqual(os.listdir(self.directory), [key + '.npz'])
+
+        # From the disk cache
+        _triangulations.clear()
+        t2 = triangulate_pattern(self.node_list, self.crease_list,
+            cache_dir=self.directory)
+        self.assertTrue(np.all(t['triangles'] == t2['triangles']))
+        self.assertTrue(np.all(t['adjacency'] == t2['adjacency']))
+        self.assertEqual(t['edge2triangle'], t2['edge2triangle'])
+
+        # Only max_entries patterns are kept on disk
+        os.utime(os.path.join(self.directory, key + '.npz'), (0, 0))
+        triangulate_pattern(self.node_list[:,::-1], self.crease_list,
+            cache_dir=self.directory, max_entries=1)
+        self.assertEqual(len(os.listdir(self.directory)), 1)
+        self.assertFalse(key + '.npz' in os.listdir(self.directory))
+
+    def test4(self):
+        # A cache file left partly written is triangulated again, and
+        # replaced
+        key = pattern_hash(self.node_list, self.crease_list)
+        filename = os.path.join(self.directory, key + '.npz')
+        with open(filename, 'wb') as f:
+            f.write(b'PK\x03\x04')
+        t = triangulate_pattern(self.node_list, self.crease_list,
+            cache_dir=self.directory)
+        self.check(t['vertices'], t['triangles'])
+        self.assertEqual(os.listdir(self.directory), [key + '.npz'])
+        with np.load(filename) as data:
+            self.assertTrue(np.all(data['triangles'] == t['triangles']))
+
+
 def axis_angle_rotation(axis, theta_degrees):
     """
     From formula available here:
@@ -536,71 +2592,289 @@ def axis_angle_rotation(axis, theta_degrees):
     return matrix
 
 
-def propagate_frame(nodes, known_creases, edge, frame1, renorm=True):
-    x1 = nodes[edge[0],0] 
-    x2 = nodes[edge[1],0] 
-    y1 = nodes[edge[0],1] 
-    y2 = nodes[edge[1],1] 
-    axis = np.array([x2 - x1, y2 - y1, 0])
-    axis = axis / np.sqrt(np.sum(axis**2))
+def axis_angle_rotations(axes, theta_degrees):
+    """
+    Same as axis_angle_rotation, for a stack of axes of shape (k, 3), which
+    must already be unit vectors, and an array of k angles.  Returns an array
+    of shape (k, 3, 3).
+    """
+    s = np.sin(theta_degrees * np.pi / 180)
+    c = np.cos(theta_degrees * np.pi / 180)
+    t = 1 - c
+    x = axes[:,0]
+    y = axes[:,1]
+    z = axes[:,2]
+    matrix = np.empty((axes.shape[0], 3, 3))
+    matrix[:,0,0] = c+x**2*t
+    matrix[:,0,1] = x*y*t-z*s
+    matrix[:,0,2] = x*z*t+y*s
+    matrix[:,1,0] = x*y*t+z*s
+    matrix[:,1,1] = c+y**2*t
+    matrix[:,1,2] = y*z*t-x*s
+    matrix[:,2,0] = z*x*t-y*s
+    matrix[:,2,1] = z*y*t+x*s
+    matrix[:,2,2] = c+z**2*t
+    return matrix
+
+
+def orthonormalize_frame(frame):
+    """
+    Make frame exactly a rotation matrix again, after numerical error has
+    crept in, by Gram-Schmidt on its columns (the unit vectors of the frame).
+    The first column keeps its direction, the second stays in the plane of
+    the first two, and the third is their cross product.
+    """
+    if _profiler is not None:
+        _profiler.count('renorm')
+    u = frame[:,0] / np.sqrt(np.dot(frame[:,0], frame[:,0]))
+    v = frame[:,1] - np.dot(u, frame[:,1]) * u
+    v = v / np.sqrt(np.dot(v, v))
+    w = np.cross(u, v)
+    return np.array([u, v, w]).T
+
+
+def orthonormalize_frames(frames):
+    """
+    Same as orthonormalize_frame, for a stack of frames of shape (k, 3, 3).
+    """
+    if _profiler is not None:
+        _profiler.count('renorm', frames.shape[0])
+    u = frames[:,:,0]
+    u = u / np.sqrt(np.sum(u**2, axis=1))[:,np.newaxis]
+    v = frames[:,:,1]
+    v = v - np.sum(u * v, axis=1)[:,np.newaxis] * u
+    v = v / np.sqrt(np.sum(v**2, axis=1))[:,np.newaxis]
+    result = np.empty(frames.shape)
+    result[:,:,0] = u
+    result[:,:,1] = v
+    result[:,:,2] = np.cross(u, v)
+    return result
+
+
+def propagate_frame(nodes, known_creases, edge, frame1, renorm=True, axis=None):
+    """
+    Find the reference frame of the triangle across edge from a triangle
+    with reference frame frame1.  edge is directed counter-clockwise around
+    the known triangle.  The new frame is frame1 followed by a rotation of
+    (crease angle - 180) about the edge, in the coordinates of the unfolded
+    paper.  axis may give the unit vector along the edge, if already known.
+    With renorm, the result is made exactly orthonormal.
+    """
+    if axis is None:
+        x1 = nodes[edge[0],0] 
+        x2 = nodes[edge[1],0] 
+        y1 = nodes[edge[0],1] 
+        y2 = nodes[edge[1],1] 
+        axis = np.array([x2 - x1, y2 - y1, 0])
+        axis = axis / np.sqrt(np.sum(axis**2))
     crease_angle = known_creases[edge]
     matrix = axis_angle_rotation(axis, crease_angle - 180)
-    frame2 = np.dot(np.dot(frame1, matrix), frame1.T)
+    frame2 = np.dot(frame1, matrix)
     if renorm:
         # Renormalize the frame2 matrix so it is exactly a rotation matrix
-        # Do this to reduce numerical error?
-        u, s, v = np.linalg.svd(frame2)
-        #print 's = ', s
-        s = np.diag(np.array([1, 1, 1]))
-        frame2 = np.dot(u, np.dot(s, v))
+        frame2 = orthonormalize_frame(frame2)
     return frame2
 
 
-def propagate_frames(nodes, triangles, known_creases, triangle_index=0):
+def build_traversal_plan(nodes, triangles, triangle_index=0):
+    """
+    Work out once, for a given mesh, the order in which propagate_frames
+    visits the triangles: a breadth-first search outward from triangle_index.
+    The topology never changes during a fold, so the plan can be reused for
+    every set of crease angles.
+
+    Returns a dict of flat arrays, with one entry per triangle reached (the
+    fixed triangle not included), in the order reached:
+
+    'order'     the triangle reached
+    'parent'    the triangle it was reached from
+    'edge'      the shared edge (pair of node indices), directed
+                counter-clockwise around the parent
+    'new_node'  the node to locate from this triangle, or -1 if an earlier
+                triangle already located it
+    'anchor'    the node (on the shared edge) new_node is located from
+    'offset'    vector from anchor to new_node in the unfolded paper, with Z=0
+    'axis'      unit vector along the shared edge in the unfolded paper
+    'levels'    start of each breadth-first level in the arrays above, plus
+                one entry for the end
+
+    plus 'root' (triangle_index), 'root_nodes' (its three nodes), and the
+    number of nodes and triangles, 'num_nodes' and 'num_triangles'.
+    """
     edge2triangle = get_edge2triangle(triangles)
+    tri = triangles.tolist()
     nt = triangles.shape[0]
     nn = nodes.shape[0]
 
-    next_triangles = [triangle_index] 
-    frames = [None for i in range(nt)]
-    frames[triangle_index] = np.eye(3)
-    nodes3d = [None for i in range(nn)]
-    # nodes3d for triangle_index remain in the original plane
-    indices = triangles[triangle_index,:]
-    for i in range(3):
-        nodes3d[indices[i]] = np.array([nodes[indices[i],0], nodes[indices[i],1], 0])
-
+    reached = np.zeros(nt, dtype='bool')
+    reached[triangle_index] = True
+    located = np.zeros(nn, dtype='bool')
+    located[triangles[triangle_index,:]] = True
+    order = []
+    parent = []
+    edges = []
+    new_nodes = []
+    levels = [0]
+
+    next_triangles = [triangle_index]
     while len(next_triangles) > 0:
         new_triangles = []
         for t in next_triangles:
-            edges = [
-                (triangles[t,1], triangles[t,0]),
-                (triangles[t,2], triangles[t,1]),
-                (triangles[t,0], triangles[t,2])]
-            for edge in edges:
+            a, b, c = tri[t]
+            for edge in [(b, a), (c, b), (a, c)]:
                 if edge not in edge2triangle: continue
                 t2 = edge2triangle[edge]
-                if frames[t2] is None:
-                    # Get the frame for the triangle
-                    orig_edge = (edge[1], edge[0])  # Direction in original triangle
-                    frames[t2] = propagate_frame(nodes, known_creases, orig_edge, frames[t], renorm=True)
-                    # Get the location of the new node in the triangle
-                    new_triangles.append(t2)
-                    new_node = list(triangles[t2,:])
-                    new_node.remove(edge[0])
-                    new_node.remove(edge[1])
-                    assert(len(new_node) == 1)
-                    new_node = new_node[0]
-                    x1 = nodes[edge[0],0] 
-                    x2 = nodes[new_node,0] 
-                    y1 = nodes[edge[0],1] 
-                    y2 = nodes[new_node,1] 
-                    vec2d = np.array([x2 - x1, y2 - y1, 0])
-                    vec3d = np.dot(frames[t2], vec2d)
-                    nodes3d[new_node] = nodes3d[edge[0]] + vec3d
-        next_triangles = new_triangles 
+                if reached[t2]: continue
+                reached[t2] = True
+                new_triangles.append(t2)
+                # The node of t2 that is not on the shared edge
+                new_node = sum(tri[t2]) - edge[0] - edge[1]
+                if located[new_node]:
+                    new_node = -1
+                else:
+                    located[new_node] = True
+                order.append(t2)
+                parent.append(t)
+                edges.append((edge[1], edge[0]))  # Direction in parent
+                new_nodes.append(new_node)
+        levels.append(len(order))
+        next_triangles = new_triangles
+
+    plan = {}
+    plan['root'] = triangle_index
+    plan['root_nodes'] = np.array(tri[triangle_index])
+    plan['num_nodes'] = nn
+    plan['num_triangles'] = nt
+    plan['order'] = np.array(order, dtype='int64')
+    plan['parent'] = np.array(parent, dtype='int64')
+    plan['edge'] = np.array(edges, dtype='int64').reshape((-1, 2))
+    plan['new_node'] = np.array(new_nodes, dtype='int64')
+    plan['anchor'] = plan['edge'][:,1]
+    levels.pop()  # The last pass reached nothing
+    plan['levels'] = np.array(levels, dtype='int64')
+
+    offset = np.zeros((len(order), 3))
+    has_node = plan['new_node'] >= 0
+    offset[has_node,:2] = nodes[plan['new_node'][has_node],:2] - \
+        nodes[plan['anchor'][has_node],:2]
+    plan['offset'] = offset
+    axis = np.zeros((len(order), 3))
+    axis[:,:2] = nodes[plan['edge'][:,1],:2] - nodes[plan['edge'][:,0],:2]
+    axis = axis / np.sqrt(np.sum(axis**2, axis=1))[:,np.newaxis]
+    plan['axis'] = axis
+    return plan
+
+
+def gather_crease_angles(known_creases, edges):
+    """
+    Look up the crease angles of an array of edges of shape (k, 2), such as
+    plan['edge'] from build_traversal_plan, and return them as an array.
+    """
+    if isinstance(known_creases, CreaseTable):
+        return known_creases.lookup(edges)
+    return np.array([known_creases[(a, b)] for a, b in edges.tolist()],
+        dtype='float64')
+
+
+@_timed('frames')
+def propagate_frames(nodes, triangles, known_creases, triangle_index=0,
+        plan=None, frames=None, nodes3d=None, by_level=False):
+    """
+    Find the reference frame of every triangle and the 3D location of every
+    node, by a breadth-first search outward from triangle_index, which stays
+    in the original plane.  Each node is located from the first triangle
+    that reaches it.
+
+    plan is the result of build_traversal_plan, if already built (and then
+    triangles and triangle_index are not used).  Returns frames, an array of
+    shape (triangles, 3, 3), and nodes3d, an array of shape (nodes, 3).
+    Triangles and nodes that cannot be reached are nan.  Arrays of those
+    shapes may be passed in as frames and nodes3d to be filled in, instead
+    of allocating new ones.
+
+    With by_level, all the triangles in one level of the breadth-first
+    search are done together with array operations, which is much faster on
+    large meshes (one set of numpy calls per level rather than per triangle).
+    """
+    if plan is None:
+        plan = build_traversal_plan(nodes, triangles, triangle_index)
+    if frames is None:
+        frames = np.empty((plan['num_triangles'], 3, 3))
+    if nodes3d is None:
+        nodes3d = np.empty((plan['num_nodes'], 3))
+    frames.fill(np.nan)
+    nodes3d.fill(np.nan)
+
+    frames[plan['root']] = np.eye(3)
+    # nodes3d for the fixed triangle remain in the original plane
+    indices = plan['root_nodes']
+    nodes3d[indices,:2] = nodes[indices,:2]
+    nodes3d[indices,2] = 0
+
+    order = plan['order']
+    parent = plan['parent']
+    new_node = plan['new_node']
+    anchor = plan['anchor']
+    offset = plan['offset']
+    axis = plan['axis']
+    if by_level:
+        angles = gather_crease_angles(known_creases, plan['edge'])
+        matrices = axis_angle_rotations(axis, angles - 180)
+        levels = plan['levels']
+        for i in range(len(levels) - 1):
+            k = slice(levels[i], levels[i+1])
+            t2 = order[k]
+            frames[t2] = orthonormalize_frames(np.einsum('kij,kjl->kil',
+                frames[parent[k]], matrices[k]))
+            has_node = new_node[k] >= 0
+            vec3d = np.einsum('kij,kj->ki', frames[t2[has_node]],
+                offset[k][has_node])
+            nodes3d[new_node[k][has_node]] = nodes3d[anchor[k][has_node]] + vec3d
+        return frames, nodes3d
+
+    edges = plan['edge'].tolist()
+    for k in range(order.shape[0]):
+        t2 = order[k]
+        frames[t2] = propagate_frame(nodes, known_creases, tuple(edges[k]),
+            frames[parent[k]], renorm=True, axis=axis[k])
+        if new_node[k] >= 0:
+            nodes3d[new_node[k]] = nodes3d[anchor[k]] + np.dot(frames[t2], offset[k])
+    return frames, nodes3d
+
+
+@_timed('frames')
+def update_frames(nodes, known_creases, frames, nodes3d, plan, changed_edges):
+    """
+    Redo propagate_frames after the crease angles in changed_edges (pairs of
+    node indices, in either order) have been changed in known_creases.  plan
+    is the traversal plan that frames and nodes3d were found with.  Only
+    triangles on the far side of a changed crease get new frames, and only
+    nodes located from those triangles, or from nodes that moved, get new
+    locations.  frames and nodes3d are updated in place and returned.
+    """
+    moved_triangles = np.zeros(plan['num_triangles'], dtype='bool')
+    moved_nodes = np.zeros(plan['num_nodes'], dtype='bool')
+    order = plan['order']
+    parent = plan['parent']
+    edges = plan['edge'].tolist()
+    new_node = plan['new_node']
+    anchor = plan['anchor']
+    offset = plan['offset']
+    axis = plan['axis']
+    for k in range(order.shape[0]):
+        t2 = order[k]
+        edge = tuple(edges[k])
+        if moved_triangles[parent[k]] or edge in changed_edges or \
+                (edge[1], edge[0]) in changed_edges:
+            frames[t2] = propagate_frame(nodes, known_creases, edge,
+                frames[parent[k]], renorm=True, axis=axis[k])
+            moved_triangles[t2] = True
+        n = new_node[k]
+        if n >= 0 and (moved_triangles[t2] or moved_nodes[anchor[k]]):
+            nodes3d[n] = nodes3d[anchor[k]] + np.dot(frames[t2], offset[k])
+            moved_nodes[n] = True
     return frames, nodes3d
-    
+
 
 class TestFrames(unittest.TestCase):
     def setUp(self):
@@ -649,112 +2923,1272 @@ class TestFrames(unittest.TestCase):
             diff = np.dot(frame2, frame2.T) - np.eye(3) 
             self.assertTrue(np.amax(np.abs(diff)) < self.eps)
 
+    def test3(self):
+        # Folding the waterbomb base must not stretch the paper
+        node_list, crease_list, crease_types = load_creasepattern('test.creasepattern')
+        triangles = np.array([[7, 4, 0], [4, 1, 5], [0, 4, 5], [4, 2, 6],
+            [2, 4, 7], [4, 3, 8], [3, 4, 6], [4, 8, 1]])
+        neighbors, neighbor_angles = get_neighbors(node_list, crease_list)
+        known_creases = {}
+        for j, angle in zip(neighbors[4], [15, 180, 15, None, 15, 180, 15, None]):
+            if angle is not None:
+                add_node_creases(known_creases, 4, [j], [angle])
+        known_creases = solve_pattern(node_list, crease_list, known_creases)
+        known_creases = add_flat_creases(known_creases, triangles)
+        frames, nodes3d = propagate_frames(node_list, triangles, known_creases)
+        for t in range(triangles.shape[0]):
+            diff = np.dot(frames[t], frames[t].T) - np.eye(3)
+            self.assertTrue(np.amax(np.abs(diff)) < self.eps)
+            for i in range(3):
+                a = triangles[t,i]
+                b = triangles[t,(i+1) % 3]
+                length2d = np.sqrt(np.sum((node_list[a] - node_list[b])**2))
+                length3d = np.sqrt(np.sum((nodes3d[a] - nodes3d[b])**2))
+                self.assertTrue(np.fabs(length2d - length3d) < self.eps)
+
 
-def foo():
-    node_list, crease_list, crease_types = load_creasepattern('test.creasepattern')
-    #print node_list
-    #print crease_list
+class TestIncremental(TwoNodeTestCase):
+    eps = 1e-12
 
-    neighbors, neighbor_angles = get_neighbors(node_list, crease_list) 
-    #for i in range(len(neighbors)):
-    #    print i
-    #    print neighbors[i]
-    #    print neighbor_angles[i]
+    def test1(self):
+        record = []
+        known_creases = self.solve(160, record)
+        self.assertEqual([i for i, solved in record], [4, 5])
+
+        known_creases = add_node_creases(known_creases, 4, [7], [150])
+        changed = resolve_pattern(known_creases, record, self.neighbors,
+            self.neighbor_angles, set([(4, 7)]))
+        expected = self.solve(150)
+        for edge in expected:
+            self.assertTrue(np.fabs(known_creases[edge] - expected[edge]) < self.eps)
+        self.assertEqual(len(changed), 14)
+        self.assertTrue((7, 4) in changed and (11, 5) in changed)
+
+        # Nothing downstream of a crease that no node used as input
+        changed = resolve_pattern(known_creases, record, self.neighbors,
+            self.neighbor_angles, set([(0, 6)]))
+        self.assertEqual(changed, set([(0, 6), (6, 0)]))
+
+    def test2(self):
+        record = []
+        plan = build_traversal_plan(self.nodes, self.triangles)
+        known_creases = self.solve(160, record)
+        frames, nodes3d = propagate_frames(self.nodes, self.triangles,
+            known_creases, plan=plan)
+        self.assertEqual(plan['order'].shape[0], self.triangles.shape[0] - 1)
+        for angle in (150, 120, 90):
+            known_creases = add_node_creases(known_creases, 4, [7], [angle])
+            changed = resolve_pattern(known_creases, record, self.neighbors,
+                self.neighbor_angles, set([(4, 7)]))
+            update_frames(self.nodes, known_creases, frames, nodes3d, plan,
+                changed)
+            frames2, nodes3d2 = propagate_frames(self.nodes, self.triangles,
+                self.solve(angle))
+            for t in range(self.triangles.shape[0]):
+                self.assertTrue(np.amax(np.fabs(frames[t] - frames2[t])) < self.eps)
+            for n in range(self.nodes.shape[0]):
+                self.assertTrue(np.amax(np.fabs(nodes3d[n] - nodes3d2[n])) < self.eps)
 
-    i = 4
-    print neighbors[i]
-    print neighbor_angles[i]
+    def test3(self):
+        known_creases = self.solve(130)
+        for t in range(self.triangles.shape[0]):
+            plan = build_traversal_plan(self.nodes, self.triangles, t)
+            frames, nodes3d = propagate_frames(self.nodes, self.triangles,
+                known_creases, plan=plan)
+            frames2, nodes3d2 = propagate_frames(self.nodes, self.triangles,
+                known_creases, plan=plan, by_level=True)
+            self.assertTrue(np.amax(np.fabs(frames - frames2)) < self.eps)
+            self.assertTrue(np.amax(np.fabs(nodes3d - nodes3d2)) < self.eps)
+
+
+def _interior_edges(triangles, nn):
+    """
+    Find the creases shared by two triangles.  Returns arrays t1, t2 and
+    edges (shape (k, 2)), where edges[i] is directed counter-clockwise around
+    triangle t1[i] (and so clockwise around t2[i]).
+    """
+    nt = triangles.shape[0]
+    edges = np.concatenate([triangles[:,[0,1]], triangles[:,[1,2]],
+        triangles[:,[2,0]]]).astype('int64')
+    owner = np.tile(np.arange(nt), 3)
+    keys = edges[:,0] * nn + edges[:,1]
+    twin_keys = edges[:,1] * nn + edges[:,0]
+    order = np.argsort(keys)
+    pos = np.searchsorted(keys[order], twin_keys)
+    pos = np.minimum(pos, keys.shape[0] - 1)
+    found = (keys[order][pos] == twin_keys) & (edges[:,0] < edges[:,1])
+    return owner[found], owner[order][pos][found], edges[found]
+
+
+@_timed('refine')
+def refine_frames(nodes, triangles, known_creases, frames, triangle_index=0,
+        iterations=2):
+    """
+    Reduce the numerical error in the reference frames from propagate_frames
+    by linear least squares, as described in the README.  Across each crease
+    shared by triangles t1 and t2 we want frame2 = frame1 * R, with R the
+    crease rotation used by propagate_frame.  Each frame gets a small
+    rotation correction, frame * (I + W) with W the cross product matrix of a
+    3-vector w, and the 9 linearized equations per crease are solved for all
+    the w together with scipy's sparse LSQR solver.  The frame of
+    triangle_index is held fixed.  The corrected frames are re-orthogonalized
+    and the procedure repeated for the given number of iterations.
+
+    Triangles that do not share any crease with another triangle are left
+    alone.  The frames from a previous animation frame can be passed in as a
+    warm start instead of those from propagate_frames.  Returns a new array
+    of frames, of shape (triangles, 3, 3).
+    """
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.linalg import lsqr
 
-    angle = 15
-    crease_angles = [angle, 180, angle, None, angle, 180, angle, None]
-    ans = solve_node(neighbor_angles[i], crease_angles)
-    print ans
+    frames = np.array(frames, dtype='float64')
+    nt = triangles.shape[0]
+    t1, t2, edges = _interior_edges(triangles, nodes.shape[0])
+    ne = edges.shape[0]
+    axes = np.zeros((ne, 3))
+    axes[:,:2] = nodes[edges[:,1],:2] - nodes[edges[:,0],:2]
+    axes = axes / np.sqrt(np.sum(axes**2, axis=1))[:,np.newaxis]
+    angles = gather_crease_angles(known_creases, edges)
+    matrices = axis_angle_rotations(axes, angles - 180)
+
+    # Unknowns are numbered 3 per triangle, skipping the fixed one.
+    column = np.arange(nt) - (np.arange(nt) > triangle_index)
+    column[triangle_index] = -1
+    generators = np.array([
+        [[0, 0, 0], [0, 0, -1], [0, 1, 0]],
+        [[0, 0, 1], [0, 0, 0], [-1, 0, 0]],
+        [[0, -1, 0], [1, 0, 0], [0, 0, 0]]], dtype='float64')
+    rows = np.repeat(np.arange(ne * 9), 3).reshape((ne, 9, 3))
+
+    for iteration in range(iterations):
+        f1 = frames[t1]
+        f2 = frames[t2]
+        residual = np.einsum('kij,kjl->kil', f1, matrices) - f2
+        # d/dw2 of frame2 * W2, and d/dw1 of -frame1 * W1 * R
+        coef2 = np.einsum('kij,njl->kiln', f2, generators).reshape((ne, 9, 3))
+        coef1 = -np.einsum('kij,njl,klm->kimn', f1, generators,
+            matrices).reshape((ne, 9, 3))
+        data = []
+        row_list = []
+        col_list = []
+        for coef, t in ((coef1, t1), (coef2, t2)):
+            keep = column[t] >= 0
+            cols = 3 * column[t][:,np.newaxis,np.newaxis] + np.arange(3)
+            cols = np.broadcast_to(cols, (ne, 9, 3))
+            data.append(coef[keep].ravel())
+            row_list.append(rows[keep].ravel())
+            col_list.append(cols[keep].ravel())
+        A = coo_matrix((np.concatenate(data),
+            (np.concatenate(row_list), np.concatenate(col_list))),
+            shape=(ne * 9, 3 * (nt - 1))).tocsr()
+        w = lsqr(A, residual.ravel(), atol=1e-15, btol=1e-15)[0].reshape((-1, 3))
+
+        # Apply the corrections as exact rotations
+        correction = np.zeros((nt, 3))
+        correction[column >= 0] = w[column[column >= 0]]
+        theta = np.sqrt(np.sum(correction**2, axis=1))
+        moved = theta > 0
+        axis = correction[moved] / theta[moved][:,np.newaxis]
+        rotations = axis_angle_rotations(axis, theta[moved] * 180 / np.pi)
+        frames[moved] = orthonormalize_frames(np.einsum('kij,kjl->kil',
+            frames[moved], rotations))
+    return frames
+
+
+def solve_node_positions(nodes, triangles, frames, triangle_index=0, x0=None):
+    """
+    Find the 3D locations of the nodes from the reference frames, by linear
+    least squares, as described in the README.  For each edge from node a
+    to node b of each triangle, we want nodes3d[b] - nodes3d[a] to be the
+    frame of that triangle applied to the same vector in the unfolded paper.
+    One more equation keeps the first node of triangle_index at its original
+    location.  The X, Y, and Z coordinates are solved separately with
+    scipy's sparse LSQR solver, starting from x0 (for instance, the node
+    locations of the previous animation frame) if given.  Returns an array of
+    shape (nodes, 3).
+    """
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.linalg import lsqr
 
-    crease_angles = ans[0]
-    known_creases = {}
-    known_creases = add_node_creases(known_creases, i, neighbors[i], crease_angles)
-    print known_creases
+    nt = triangles.shape[0]
+    nn = nodes.shape[0]
+    edges = np.concatenate([triangles[:,[0,1]], triangles[:,[1,2]],
+        triangles[:,[2,0]]])
+    owner = np.tile(np.arange(nt), 3)
+    ne = edges.shape[0]
+    vec2d = np.zeros((ne, 3))
+    vec2d[:,:2] = nodes[edges[:,1],:2] - nodes[edges[:,0],:2]
+    vec3d = np.einsum('kij,kj->ki', frames[owner], vec2d)
+
+    fixed = triangles[triangle_index,0]
+    rows = np.concatenate([np.arange(ne), np.arange(ne), [ne]])
+    cols = np.concatenate([edges[:,1], edges[:,0], [fixed]])
+    data = np.concatenate([np.ones(ne), -np.ones(ne), [1]])
+    A = coo_matrix((data, (rows, cols)), shape=(ne + 1, nn)).tocsr()
+
+    nodes3d = np.zeros((nn, 3))
+    fixed_location = [nodes[fixed,0], nodes[fixed,1], 0]
+    for axis in range(3):
+        b = np.concatenate([vec3d[:,axis], [fixed_location[axis]]])
+        start = None if x0 is None else x0[:,axis]
+        nodes3d[:,axis] = lsqr(A, b, atol=1e-15, btol=1e-15, x0=start)[0]
+    return nodes3d
+
+
+class TestRefinement(TwoNodeTestCase):
+    def test1(self):
+        known_creases = self.solve(120)
+        frames, nodes3d = propagate_frames(self.nodes, self.triangles,
+            known_creases)
+        frames2 = refine_frames(self.nodes, self.triangles, known_creases, frames)
+        self.assertTrue(np.amax(np.fabs(frames - frames2)) < 1e-10)
+        nodes3d2 = solve_node_positions(self.nodes, self.triangles, frames2)
+        self.assertTrue(np.amax(np.fabs(nodes3d - nodes3d2)) < 1e-10)
+        nodes3d2 = solve_node_positions(self.nodes, self.triangles, frames2,
+            x0=nodes3d)
+        self.assertTrue(np.amax(np.fabs(nodes3d - nodes3d2)) < 1e-10)
 
-    plot_creasepattern(node_list, crease_list, crease_types)
+    def test2(self):
+        # Recover the frames after small errors are added to all but the
+        # fixed one
+        known_creases = self.solve(120)
+        frames, nodes3d = propagate_frames(self.nodes, self.triangles,
+            known_creases)
+        rng = np.random.RandomState(2)
+        noisy = frames.copy()
+        for t in range(1, self.triangles.shape[0]):
+            axis = rng.normal(size=3)
+            matrix = axis_angle_rotation(axis, rng.uniform(-1, 1))
+            noisy[t] = np.dot(noisy[t], matrix)
+        frames2 = refine_frames(self.nodes, self.triangles, known_creases,
+            noisy, iterations=4)
+        self.assertTrue(np.amax(np.fabs(frames - frames2)) < 1e-8)
+
+
+def _morton2d(points):
+    """Morton (Z-order) codes of 2D points, quantized to 16 bits per axis."""
+    lo = np.amin(points, axis=0)
+    span = np.amax(points, axis=0) - lo
+    span[span == 0] = 1
+    q = ((points - lo) / span * 65535).astype('uint64')
+    codes = np.zeros(points.shape[0], dtype='uint64')
+    for bit in range(16):
+        for axis in (0, 1):
+            codes |= ((q[:,axis] >> np.uint64(bit)) & np.uint64(1)) << \
+                np.uint64(2 * bit + axis)
+    return codes
+
+
+def _triangles_cross(p, q, eps):
+    # Triangles with corners p and q, of shape (k, 3, 3), and no node shared:
+    # each is cut by the plane of the other, and the two segments cut out
+    # along the line where the planes meet must overlap by more than eps.
+    n1 = np.cross(p[:,1] - p[:,0], p[:,2] - p[:,0])
+    n2 = np.cross(q[:,1] - q[:,0], q[:,2] - q[:,0])
+    n1 = n1 / np.sqrt(np.sum(n1**2, axis=1))[:,np.newaxis]
+    n2 = n2 / np.sqrt(np.sum(n2**2, axis=1))[:,np.newaxis]
+    # Signed distances of each triangle's corners from the other's plane
+    dp = np.einsum('kij,kj->ki', p - q[:,:1], n2)
+    dq = np.einsum('kij,kj->ki', q - p[:,:1], n1)
+    dp[np.fabs(dp) < eps] = 0
+    dq[np.fabs(dq) < eps] = 0
+    cross = ~(np.all(dp > 0, axis=1) | np.all(dp < 0, axis=1) |
+        np.all(dq > 0, axis=1) | np.all(dq < 0, axis=1) |
+        np.all(dp == 0, axis=1) | np.all(dq == 0, axis=1))
+    direction = np.cross(n1, n2)
+
+    def interval(t, d):
+        # Where the triangle with corners t and plane distances d meets the
+        # other plane, as positions along direction
+        lo = np.full(t.shape[0], np.inf)
+        hi = np.full(t.shape[0], -np.inf)
+        s = np.einsum('kij,kj->ki', t, direction)
+        for i, j in ((0, 1), (1, 2), (2, 0)):
+            on = d[:,i] == 0
+            lo = np.where(on, np.minimum(lo, s[:,i]), lo)
+            hi = np.where(on, np.maximum(hi, s[:,i]), hi)
+            edge = d[:,i] * d[:,j] < 0
+            with np.errstate(divide='ignore', invalid='ignore'):
+                u = d[:,i] / (d[:,i] - d[:,j])
+            x = s[:,i] + u * (s[:,j] - s[:,i])
+            lo = np.where(edge, np.minimum(lo, x), lo)
+            hi = np.where(edge, np.maximum(hi, x), hi)
+        return lo, hi
+
+    lo1, hi1 = interval(p, dp)
+    lo2, hi2 = interval(q, dq)
+    overlap = np.minimum(hi1, hi2) - np.maximum(lo1, lo2)
+    return cross & (overlap > eps)
+
+
+def _segments_cross(a, b, t, eps):
+    # Whether the segments from a to b, of shape (k, 3), pass through the
+    # insides of the triangles with corners t, of shape (k, 3, 3)
+    n = np.cross(t[:,1] - t[:,0], t[:,2] - t[:,0])
+    nn = np.sum(n**2, axis=1)
+    length = np.sqrt(nn)
+    da = np.einsum('kj,kj->k', a - t[:,0], n) / length
+    db = np.einsum('kj,kj->k', b - t[:,0], n) / length
+    da[np.fabs(da) < eps] = 0
+    db[np.fabs(db) < eps] = 0
+    cross = da * db < 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        u = da / (da - db)
+    u[~cross] = 0
+    x = a + u[:,np.newaxis] * (b - a)
+    # Barycentric coordinates of the crossing point must all be positive
+    for i, j in ((0, 1), (1, 2), (2, 0)):
+        w = np.einsum('kj,kj->k', np.cross(t[:,j] - t[:,i], x - t[:,i]), n)
+        cross &= w / nn > eps
+    return cross
+
+
+def triangle_intersections(nodes3d, triangles, pairs, eps=1e-9,
+        known_creases=None):
+    """
+    For each pair of triangles (rows of pairs, indices into triangles), test
+    whether the two triangles cross each other, all pairs at once.  Returns
+    a boolean array.
+
+    Triangles that only touch, and coplanar triangles with no node in common
+    (layers of paper folded flat onto each other), are not counted.  Two
+    triangles that share a node cross when the edge of one opposite that
+    node passes through the other.  Two triangles that share an edge cross
+    when the crease between them is folded all the way over: when its angle
+    in known_creases is at most 0 or at least 360, or, for creases not given
+    there, when the two triangles are folded flat onto each other.
+    """
+    pairs = np.asarray(pairs).reshape((-1, 2))
+    ta = triangles[pairs[:,0]]
+    tb = triangles[pairs[:,1]]
+    match = ta[:,:,np.newaxis] == tb[:,np.newaxis,:]
+    shared = np.sum(match, axis=(1, 2))
+    result = np.zeros(pairs.shape[0], dtype='bool')
+
+    k = shared == 0
+    result[k] = _triangles_cross(nodes3d[ta[k]], nodes3d[tb[k]], eps)
+
+    # Corners of each triangle, those not shared with the other first
+    rows = np.arange(pairs.shape[0])[:,np.newaxis]
+    ca = ta[rows, np.argsort(np.any(match, axis=2), axis=1, kind='mergesort')]
+    cb = tb[rows, np.argsort(np.any(match, axis=1), axis=1, kind='mergesort')]
+
+    k = shared == 1
+    p = nodes3d[ca[k]]
+    q = nodes3d[cb[k]]
+    result[k] = _segments_cross(p[:,0], p[:,1], q, eps) | \
+        _segments_cross(q[:,0], q[:,1], p, eps)
+
+    k = np.nonzero(shared == 2)[0]
+    if len(k) > 0:
+        # The corners off the shared edge, relative to its first end, and
+        # the edge's direction
+        u = nodes3d[ca[k,1]]
+        e = nodes3d[ca[k,2]] - u
+        e = e / np.sqrt(np.sum(e**2, axis=1))[:,np.newaxis]
+        a = nodes3d[ca[k,0]] - u
+        b = nodes3d[cb[k,0]] - u
+        a -= np.sum(a * e, axis=1)[:,np.newaxis] * e
+        b -= np.sum(b * e, axis=1)[:,np.newaxis] * e
+        a = a / np.sqrt(np.sum(a**2, axis=1))[:,np.newaxis]
+        b = b / np.sqrt(np.sum(b**2, axis=1))[:,np.newaxis]
+        folded = np.sum(a * b, axis=1) > 1 - eps
+        if known_creases is not None:
+            for m, (i, j) in enumerate(zip(ca[k,1], ca[k,2])):
+                angle = known_creases.get((i, j))
+                if angle is not None:
+                    folded[m] = angle <= 0 or angle >= 360
+        result[k] = folded
+    return result
+
+
+class CollisionBVH(object):
+    """
+    Bounding volume hierarchy over the triangles of a crease pattern, for
+    finding where a folded state of the paper passes through itself.
+
+    The tree is built once, from the unfolded paper: triangles are sorted
+    along a Z-order curve of their centroids and split into leaves of
+    leaf_size triangles, and the leaves make up a complete binary tree
+    stored heap-style (node k has children 2k+1 and 2k+2).  For each frame
+    the boxes are only refit to the new node locations, a level at a time,
+    rather than rebuilt.  Pairs of subtrees are tested together a level at a
+    time, so all the work is done on arrays.
+
+    lo and hi hold the lower and upper corners of the box of every tree
+    node, leaves last; order lists the triangle in each leaf slot, with -1
+    for padding.
+    """
+    def __init__(self, nodes, triangles, leaf_size=4):
+        self.triangles = np.asarray(triangles)
+        self.leaf_size = leaf_size
+        nt = self.triangles.shape[0]
+        nl = 1
+        while nl * leaf_size < nt:
+            nl *= 2
+        self.num_leaves = nl
+        self.depth = int(np.log2(nl) + 0.5)
+        centroids = np.mean(np.asarray(nodes)[self.triangles][:,:,:2], axis=1)
+        order = np.full(nl * leaf_size, -1, dtype='int64')
+        order[:nt] = np.argsort(_morton2d(centroids), kind='mergesort')
+        self.order = order
+        self.lo = np.full((2 * nl - 1, 3), np.inf)
+        self.hi = np.full((2 * nl - 1, 3), -np.inf)
+        self.tri_lo = None
+        self.tri_hi = None
+
+    def refit(self, nodes3d):
+        """Fit the boxes to new 3D node locations, of shape (nodes, 3)."""
+        corners = nodes3d[self.triangles]
+        self.tri_lo = np.amin(corners, axis=1)
+        self.tri_hi = np.amax(corners, axis=1)
+        nl = self.num_leaves
+        pad = self.order < 0
+        lo = self.tri_lo[self.order]
+        hi = self.tri_hi[self.order]
+        lo[pad] = np.inf
+        hi[pad] = -np.inf
+        self.lo[nl - 1:] = np.amin(lo.reshape((nl, self.leaf_size, 3)), axis=1)
+        self.hi[nl - 1:] = np.amax(hi.reshape((nl, self.leaf_size, 3)), axis=1)
+        for d in range(self.depth - 1, -1, -1):
+            k = np.arange(2**d - 1, 2**(d + 1) - 1)
+            self.lo[k] = np.minimum(self.lo[2 * k + 1], self.lo[2 * k + 2])
+            self.hi[k] = np.maximum(self.hi[2 * k + 1], self.hi[2 * k + 2])
+
+    def candidate_pairs(self):
+        """
+        Pairs of triangles (i < j) whose boxes overlap, as an array of shape
+        (k, 2), from the last refit.
+        """
+        def overlap(a, b, lo, hi):
+            return np.all((lo[a] <= hi[b]) & (lo[b] <= hi[a]), axis=1)
+
+        a = np.array([0])
+        b = np.array([0])
+        for d in range(self.depth):
+            keep = overlap(a, b, self.lo, self.hi)
+            a, b = a[keep], b[keep]
+            same = a == b
+            # Children of a pair of distinct nodes: all four combinations;
+            # of a node with itself: left-left, left-right, right-right
+            ca = np.concatenate([2 * a[~same] + 1, 2 * a[~same] + 1,
+                2 * a[~same] + 2, 2 * a[~same] + 2,
+                2 * a[same] + 1, 2 * a[same] + 1, 2 * a[same] + 2])
+            cb = np.concatenate([2 * b[~same] + 1, 2 * b[~same] + 2,
+                2 * b[~same] + 1, 2 * b[~same] + 2,
+                2 * a[same] + 1, 2 * a[same] + 2, 2 * a[same] + 2])
+            a, b = ca, cb
+        keep = overlap(a, b, self.lo, self.hi)
+        a = a[keep] - (self.num_leaves - 1)
+        b = b[keep] - (self.num_leaves - 1)
+
+        # Every slot of leaf a against every slot of leaf b
+        ls = self.leaf_size
+        i = np.repeat(np.arange(ls), ls)
+        j = np.tile(np.arange(ls), ls)
+        sa = (a[:,np.newaxis] * ls + i).ravel()
+        sb = (b[:,np.newaxis] * ls + j).ravel()
+        keep = (a[:,np.newaxis] != b[:,np.newaxis]) | (i < j)
+        ta = self.order[sa[keep.ravel()]]
+        tb = self.order[sb[keep.ravel()]]
+        keep = (ta >= 0) & (tb >= 0)
+        ta, tb = ta[keep], tb[keep]
+        keep = np.all((self.tri_lo[ta] <= self.tri_hi[tb]) &
+            (self.tri_lo[tb] <= self.tri_hi[ta]), axis=1)
+        ta, tb = ta[keep], tb[keep]
+        return np.array([np.minimum(ta, tb), np.maximum(ta, tb)]).T.reshape(
+            (-1, 2))
+
+    def intersecting_pairs(self, nodes3d, eps=1e-9, known_creases=None):
+        """
+        Refit to nodes3d, and return the pairs of triangles (i < j) that
+        pass through each other (see triangle_intersections, also for
+        known_creases).
+        """
+        self.refit(nodes3d)
+        pairs = self.candidate_pairs()
+        return pairs[triangle_intersections(nodes3d, self.triangles, pairs, eps,
+            known_creases)]
 
 
-def foo2():
-    # From http://dzhelil.info/triangle/delaunay.html
-    # (not my code)
-    import triangle
-    import triangle.plot as plot
+def collision_free(solutions, vertices, triangles, triangle_index=0, bvh=None):
+    """
+    Keep only the solutions (crease angles, as from search_pattern) whose
+    folded paper does not pass through itself.  Creases of the triangulation
+    missing from a solution are taken to be flat.  bvh may give a
+    CollisionBVH for (vertices, triangles) to reuse.
+    """
+    if bvh is None:
+        bvh = CollisionBVH(vertices, triangles)
+    plan = build_traversal_plan(vertices, triangles, triangle_index)
+    result = []
+    for known_creases in solutions:
+        known_creases = add_flat_creases(known_creases.copy(), triangles)
+        frames, nodes3d = propagate_frames(vertices, triangles, known_creases,
+            plan=plan, by_level=True)
+        if len(bvh.intersecting_pairs(nodes3d,
+                known_creases=known_creases)) == 0:
+            result.append(known_creases)
+    return result
+
+
+class TestCollision(unittest.TestCase):
+    def brute_force(self, nodes3d, triangles):
+        nt = triangles.shape[0]
+        pairs = np.array([(i, j) for i in range(nt) for j in range(i + 1, nt)])
+        return pairs[triangle_intersections(nodes3d, triangles, pairs)]
 
-    face = triangle.get_data('face')
-    print face
+    def test1(self):
+        nodes3d = np.array([[0, 0, 0], [1, 0, 0], [0, 1, 0],
+            [0.2, 0.2, -1], [0.2, 0.2, 1], [1, 1, 0],  # crosses the first
+            [5, 0, 0], [6, 0, 0], [5, 1, 0],
+            [5.5, 0, 0], [6.5, 0, 0], [5.5, 1, 0],  # coplanar with the third
+            [1, 0, 0], [1, 0, 1], [2, 0, 1]],  # touches the first at a corner
+            dtype='float64')
+        triangles = np.arange(15).reshape((5, 3))
+        pairs = np.array([[0, 1], [2, 3], [0, 4], [0, 2]])
+        self.assertEqual(triangle_intersections(nodes3d, triangles,
+            pairs).tolist(), [True, False, False, False])
 
-    ax1 = mpl.subplot(121, aspect='equal')
-    plot.plot(ax1, **face)
+    def test2(self):
+        # A crumpled grid of triangles: the tree finds what brute force does
+        rng = np.random.RandomState(0)
+        n = 8
+        nodes = np.array([(i, j) for j in range(n) for i in range(n)],
+            dtype='float64')
+        triangles = []
+        for j in range(n - 1):
+            for i in range(n - 1):
+                k = j * n + i
+                triangles += [[k, k + 1, k + n + 1], [k, k + n + 1, k + n]]
+        triangles = np.array(triangles)
+        bvh = CollisionBVH(nodes, triangles, leaf_size=2)
+        for frame in range(3):
+            nodes3d = np.zeros((n * n, 3))
+            nodes3d[:,:2] = nodes * 0.3
+            nodes3d += rng.normal(scale=0.5, size=nodes3d.shape)
+            expected = self.brute_force(nodes3d, triangles)
+            self.assertTrue(len(expected) > 0)
+            actual = bvh.intersecting_pairs(nodes3d)
+            self.assertEqual(sorted(map(tuple, actual.tolist())),
+                sorted(map(tuple, expected.tolist())))
 
-    t = triangle.triangulate(face, 'p')
+    def test3(self):
+        # A strip of three squares with two valley folds: folded tightly
+        # enough, the third square comes back through the first.
+        vertices = np.array([[0, 0], [1, 0], [2, 0], [3, 0], [0, 1], [1, 1],
+            [2, 1], [3, 1]], dtype='float64')
+        triangles = np.array([[0, 1, 5], [0, 5, 4], [1, 2, 6], [1, 6, 5],
+            [2, 3, 7], [2, 7, 6]])
+        bvh = CollisionBVH(vertices, triangles, leaf_size=1)
+        solutions = []
+        for angle in (160, 20):
+            known_creases = add_node_creases({}, 1, [5], [angle])
+            solutions.append(add_node_creases(known_creases, 2, [6], [angle]))
+        for angle, known_creases in zip((160, 20), solutions):
+            known = add_flat_creases(known_creases.copy(), triangles)
+            frames, nodes3d = propagate_frames(vertices, triangles, known)
+            pairs = bvh.intersecting_pairs(nodes3d)
+            if angle == 160:
+                self.assertEqual(len(pairs), 0)
+            else:
+                self.assertEqual(sorted(set(pairs[:,0])), [0, 1])
+                self.assertEqual(sorted(set(pairs[:,1])), [4, 5])
+        kept = collision_free(solutions, vertices, triangles, bvh=bvh)
+        self.assertEqual(len(kept), 1)
+        self.assertEqual(kept[0][(1, 5)], 160)
 
-    ax2 = mpl.subplot(122, sharex=ax1, sharey=ax1)
-    triangle.plot.plot(ax2, **t)
+    def test4(self):
+        # Triangles sharing a node or an edge with the first
+        nodes3d = np.array([[0, 0, 0], [1, 0, 0], [0, 1, 0],
+            [0.3, 0.2, 1], [0.3, 0.2, -1],  # crosses it at node 0
+            [0.2, 0.3, 1],  # with node 3, only touches it at node 0
+            [-1, 0, 0.5], [-1, 0, -0.5],  # misses it
+            [0.2, 0.2, 0],  # folded all the way over onto it
+            [1, 1, 0]], dtype='float64')  # flat
+        triangles = np.array([[0, 1, 2], [0, 3, 4], [0, 3, 5], [0, 6, 7],
+            [1, 2, 8], [2, 1, 9]])
+        pairs = np.array([[0, 1], [0, 2], [0, 3], [0, 4], [0, 5], [1, 2]])
+        self.assertEqual(triangle_intersections(nodes3d, triangles,
+            pairs).tolist(), [True, False, False, True, False, False])
+        known_creases = add_node_creases({}, 1, [2], [-10])
+        self.assertEqual(triangle_intersections(nodes3d, triangles, pairs,
+            known_creases=known_creases).tolist(),
+            [True, False, False, True, True, False])
+        known_creases = add_node_creases({}, 1, [2], [10])
+        self.assertEqual(triangle_intersections(nodes3d, triangles, pairs,
+            known_creases=known_creases)[3], False)
 
-    mpl.show()
+    def test5(self):
+        # Faces around the center of the waterbomb passing through each
+        # other: the same as brute force on slightly shrunken triangles,
+        # which then share no nodes
+        node_list, crease_list, crease_types = load_creasepattern(
+            'test.creasepattern')
+        neighbors, neighbor_angles = get_neighbors(node_list, crease_list)
+        triangles = triangulate_pattern(node_list, crease_list)['triangles']
+        nt = triangles.shape[0]
+        pairs = np.array([(i, j) for i in range(nt) for j in range(i + 1, nt)])
+        bvh = CollisionBVH(node_list, triangles)
+        rng = np.random.RandomState(1)
+        crossed = 0
+        for trial in range(20):
+            crease_angles = list(rng.uniform(0, 360, 8))
+            for j in rng.choice(8, 3, replace=False):
+                crease_angles[j] = None
+            ans = solve_node(neighbor_angles[4], crease_angles)
+            if isinstance(ans, numbers.Number):
+                continue
+            for crease_angles in ans:
+                known_creases = add_node_creases({}, 4, neighbors[4],
+                    crease_angles)
+                known_creases = add_flat_creases(known_creases, triangles)
+                frames, nodes3d = propagate_frames(node_list, triangles,
+                    known_creases)
+                corners = nodes3d[triangles]
+                center = np.mean(corners, axis=1)[:,np.newaxis,:]
+                corners = center + 0.999 * (corners - center)
+                expected = np.any(triangle_intersections(corners.reshape(
+                    (-1, 3)), np.arange(3 * nt).reshape((nt, 3)), pairs))
+                actual = bvh.intersecting_pairs(nodes3d,
+                    known_creases=known_creases)
+                self.assertEqual(len(actual) > 0, expected)
+                crossed += expected
+        self.assertTrue(crossed > 0)
+
+
+def sweep_pattern(node_list, crease_list, start, end, times,
+        neighbors=None, neighbor_angles=None, branch=0, max_change=5.0,
+        min_step=1e-3, max_step=0.25):
+    """
+    Follow the folding of a crease pattern as its driving creases move from
+    the angles in start to those in end (hashes keyed like known_creases,
+    with the same keys), by continuation: each step is solved with the
+    previous solution as the reference for choosing branches, so that the
+    fold does not jump between branches from one frame to the next.
+
+    The path parameter runs from 0 (start) to 1 (end), and the driving
+    angles move linearly with it.  A step is halved and tried again if any
+    crease moves by more than max_change degrees, or by more than half the
+    margin between the two branches of some node (near the degenerate
+    solutions of solve_node, where the branches meet); otherwise the next
+    step may be twice as long, up to max_step.  Steps are never shorter than
+    min_step.  branch picks the solution at the start.
+
+    times lists parameter values between 0 and 1 at which to report the
+    crease angles, which are interpolated linearly between solved steps.
+
+    Returns (angles, steps): angles has shape (len(times), len(crease_list)),
+    holding the angle of each crease from its first node to its second, nan
+    where unknown or where a solution could not be found, and steps lists
+    the parameter values that were solved.
+    """
+    if neighbors is None or neighbor_angles is None:
+        neighbors, neighbor_angles = get_neighbors(node_list, crease_list,
+            check=True)
+    keys = list(start.keys())
+    a0 = np.array([start[k] for k in keys], dtype='float64')
+    da = _angle_difference([end[k] for k in keys], a0)
+
+    def solve(s, reference):
+        known = dict((k, a) for k, a in zip(keys, a0 + s * da))
+        margins = []
+        known = solve_pattern(node_list, crease_list, known, neighbors,
+            neighbor_angles, branch, reference=reference, margins=margins)
+        if isinstance(known, numbers.Number):
+            return known, 0.0
+        angles = np.array([known.get((a, b), np.nan) for a, b in crease_list])
+        return (known, angles), min(margins) if margins else 360.0
+
+    steps = [0.0]
+    ans, margin = solve(0.0, None)
+    if isinstance(ans, numbers.Number):
+        return np.nan * np.zeros((len(times), len(crease_list))), []
+    known, angles = ans
+    solved = [angles]
+    s = 0.0
+    step = max_step
+    while s < 1.0:
+        step = max(min(step, max_step, 1.0 - s), min(min_step, 1.0 - s))
+        ans, margin = solve(s + step, known)
+        if isinstance(ans, numbers.Number):
+            change = np.inf
+        else:
+            change = np.nanmax(np.fabs(_angle_difference(ans[1], angles)))
+        limit = min(max_change, 0.5 * margin)
+        if change > limit and step > min_step:
+            step = max(0.5 * step, min_step)
+            continue
+        if isinstance(ans, numbers.Number):
+            break  # No solution even with the shortest step
+        s = s + step
+        known, angles = ans
+        steps.append(s)
+        solved.append(angles)
+        if change < 0.25 * limit:
+            step = 2 * step
+
+    # Interpolate, unwrapping angles that pass through 0/360
+    steps = np.array(steps)
+    solved = np.array(solved)
+    times = np.asarray(times, dtype='float64')
+    result = np.nan * np.zeros((len(times), len(crease_list)))
+    k = np.searchsorted(steps, times, side='right') - 1
+    inside = (k >= 0) & (times <= steps[-1])
+    k = np.minimum(k, len(steps) - 2)
+    if len(steps) == 1:
+        result[inside] = solved[0]
+        return result, steps.tolist()
+    k = k[inside]
+    frac = (times[inside] - steps[k]) / (steps[k + 1] - steps[k])
+    delta = _angle_difference(solved[k + 1], solved[k])
+    result[inside] = np.mod(solved[k] + frac[:, np.newaxis] * delta, 360)
+    return result, steps.tolist()
+
+
+class TestSweep(TwoNodeTestCase):
+    def test1(self):
+        times = np.linspace(0, 1, 21)
+        angles, steps = sweep_pattern(self.nodes, self.creases, {(4, 7): 170},
+            {(4, 7): 60}, times, self.neighbors, self.neighbor_angles)
+        self.assertEqual(steps[0], 0.0)
+        self.assertEqual(steps[-1], 1.0)
+        self.assertTrue(np.all(np.diff(steps) > 0))
+        # Creases along the edge of the paper are never solved
+        self.assertTrue(np.all(np.isnan(angles[:, :10])))
+        self.assertFalse(np.any(np.isnan(angles[:, 10:])))
+        crease = [tuple(c) for c in self.creases.tolist()].index((4, 7))
+        self.assertTrue(np.allclose(angles[:, crease], np.linspace(170, 60, 21)))
+        # Continuous: no jumps between branches
+        jumps = np.fabs(_angle_difference(angles[1:, 10:], angles[:-1, 10:]))
+        self.assertTrue(np.amax(jumps) < 2 * 5.0)
+        # Each frame is close to the solution with the same driving angle
+        for i in (0, 10, 20):
+            reference = {}
+            for (a, b), angle in zip(self.creases[10:].tolist(), angles[i, 10:]):
+                reference[(a, b)] = angle
+            known_creases = solve_pattern(self.nodes, self.creases,
+                {(4, 7): angles[i, crease]}, self.neighbors,
+                self.neighbor_angles, reference=reference)
+            expected = [known_creases[(a, b)] for a, b in self.creases[10:].tolist()]
+            self.assertTrue(np.amax(np.fabs(_angle_difference(expected,
+                angles[i, 10:]))) < 0.5)
 
+    def test2(self):
+        # The margin between branches is recorded for every solved node
+        margins = []
+        solve_pattern(self.nodes, self.creases, {(4, 7): 120},
+            self.neighbors, self.neighbor_angles, margins=margins)
+        self.assertEqual(len(margins), 2)
+        self.assertTrue(min(margins) > 0)
 
-def foo3():
-    import triangle
-    import triangle.plot as plot
+    def test3(self):
+        # The waterbomb, driven as in demo.foo3: its one node has only one
+        # solution, which must not hold the steps down to min_step
+        node_list, crease_list, crease_types = load_creasepattern(
+            'test.creasepattern')
+        neighbors, neighbor_angles = get_neighbors(node_list, crease_list)
+        def drivers(angle):
+            return dict(((4, j), a) for j, a in zip(neighbors[4],
+                [angle, 180, angle, None, angle, 180, angle, None])
+                if a is not None)
+        angles, steps = sweep_pattern(node_list, crease_list, drivers(170),
+            drivers(20), np.linspace(0, 1, 11), neighbors, neighbor_angles)
+        self.assertEqual(steps[-1], 1.0)
+        self.assertTrue(len(steps) < 100)
+
+
+class TestProfiling(TwoNodeTestCase):
+    def test1(self):
+        events = []
+        with profiling(sink=lambda *event: events.append(event)) as profiler:
+            known_creases = self.solve(150)
+            propagate_frames(self.nodes, self.triangles, known_creases)
+            search_pattern(self.nodes, self.creases, {(4, 7): 150},
+                neighbors=self.neighbors, neighbor_angles=self.neighbor_angles,
+                max_solutions=4)
+        self.assertEqual(profiler.calls['solve'], 2)
+        self.assertEqual(profiler.calls['frames'], 1)
+        self.assertTrue(profiler.times['solve'] > 0)
+        self.assertTrue(profiler.counts['node_solves'] >= 4)
+        self.assertEqual(profiler.counts['renorm'], self.triangles.shape[0] - 1)
+        self.assertTrue(profiler.counts['branches'] > 0)
+        self.assertTrue(profiler.peaks['search_stack'] > 0)
+        self.assertTrue(('time', 'frames', profiler.times['frames']) in events)
+        self.assertTrue('node_solves' in profiler.summary())
 
-    node_list, crease_list, crease_types = load_creasepattern('test.creasepattern')
-    #print node_list
-    #print crease_list
+    def test2(self):
+        with profiling() as outer:
+            with profiling() as inner:
+                self.solve(150)
+            self.assertTrue(_profiler is outer)
+            self.solve(150)
+        self.assertTrue(_profiler is None)
+        self.assertEqual(inner.calls['solve'], 1)
+        self.assertEqual(outer.calls['solve'], 1)
+
+
+def solve_frame(node_list, crease_list, vertices, triangles, drivers,
+        neighbors=None, neighbor_angles=None, plan=None, nodes3d=None):
+    """
+    Find the 3D node locations for one frame of an animation.  drivers is a
+    hash from creases (pairs of node indices) to their crease angles, which
+    solve_pattern propagates over the crease pattern; creases of the
+    triangulation (vertices, triangles) that are not creases of the pattern
+    stay flat.  neighbors, neighbor_angles, plan, and nodes3d are as for
+    solve_pattern and propagate_frames, and can be passed in to save
+    computing or allocating them for every frame.
+
+    Returns nodes3d, an array of shape (nodes, 3), or the error code from
+    solve_node if the crease angles could not be solved.
+    """
+    known_creases = make_crease_table(vertices, crease_list, triangles)
+    for edge, angle in drivers.items():
+        known_creases[edge] = angle
+    known_creases = solve_pattern(node_list, crease_list, known_creases,
+        neighbors, neighbor_angles)
+    if isinstance(known_creases, numbers.Number):
+        return known_creases
+    known_creases = add_flat_creases(known_creases, triangles)
+    frames, nodes3d = propagate_frames(vertices, triangles, known_creases,
+        plan=plan, nodes3d=nodes3d, by_level=True)
+    return nodes3d
 
-    paper = {}
-    paper['vertices'] = node_list 
-    paper['segments'] = crease_list
 
-    ax1 = mpl.subplot(121, aspect='equal')
-    plot.plot(ax1, **paper)
-    
-    t = triangle.triangulate(paper, 'p')
-    print t
+# Per-process state for animate, set up once by _animate_init
+_animate_state = {}
 
-    ax2 = mpl.subplot(122, sharex=ax1, sharey=ax1)
-    plot.plot(ax2, **t)
 
-    nodes = t['vertices']
+def _animate_init(node_list, crease_list, vertices, triangles, schedule,
+        output, triangle_index, collisions=False):
+    state = _animate_state
+    state['node_list'] = node_list
+    state['crease_list'] = crease_list
+    state['vertices'] = vertices
+    state['triangles'] = triangles
+    state['schedule'] = schedule
+    if isinstance(output, str):
+        state['output'] = np.load(output, mmap_mode='r+')
+    else:
+        state['output'] = np.frombuffer(output, dtype='float64').reshape(
+            (len(schedule), vertices.shape[0], 3))
+    state['neighbors'], state['neighbor_angles'] = get_neighbors(node_list,
+        crease_list)
+    state['plan'] = build_traversal_plan(vertices, triangles, triangle_index)
+    state['bvh'] = CollisionBVH(vertices, triangles) if collisions else None
+
+
+def _animate_frames(frame_range):
+    state = _animate_state
+    output = state['output']
+    failed = []
+    for i in range(frame_range[0], frame_range[1]):
+        ans = solve_frame(state['node_list'], state['crease_list'],
+            state['vertices'], state['triangles'], state['schedule'][i],
+            state['neighbors'], state['neighbor_angles'], state['plan'],
+            output[i])
+        if isinstance(ans, numbers.Number):
+            output[i] = np.nan
+            failed.append((i, ans))
+        elif state['bvh'] is not None and \
+                len(state['bvh'].intersecting_pairs(output[i])) > 0:
+            failed.append((i, -7))
+    if isinstance(output, np.memmap):
+        output.flush()
+    return failed
+
+
+def animate(pattern, driver_schedule, processes=None, chunk_size=16,
+        triangle_index=0, output=None, collisions=False):
+    """
+    Find the 3D node locations for every frame of an animation, spreading
+    the frames over a pool of worker processes.  pattern is (node_list,
+    crease_list, crease_types) as returned by load_creasepattern, and
+    driver_schedule is a list with one hash of driving crease angles per
+    frame (see solve_frame).  triangle_index is the triangle held fixed.
+
+    The pattern, its triangulation and the schedule are handed to each
+    worker once, when it starts, and each worker writes its frames straight
+    into one shared-memory array, so nothing is sent per frame except a
+    range of frame numbers.  With processes=1 everything is done in this
+    process instead.  If output is the name of a .npy file, the frames are
+    written into it through a memory map instead, so that long animations
+    need not fit in memory.
+
+    With collisions, every solved frame is also checked for paper passing
+    through itself, with a CollisionBVH per worker that is refit from frame
+    to frame.
+
+    Returns (nodes3d, failed): nodes3d has shape (frames, nodes, 3), and
+    failed lists (frame, error code) for frames that could not be solved,
+    whose locations are nan, and for frames that intersect themselves, with
+    error code -7 (their locations are kept).  With output given, nodes3d
+    is a read-only memory map of the file.
+    """
+    node_list, crease_list = pattern[0], pattern[1]
+    # Check the pattern here: an error in the workers' initializer would
+    # only make the pool start new workers over and over
+    get_neighbors_csr(node_list, crease_list, check=True)
+    t = triangulate_pattern(node_list, crease_list)
+    vertices = t['vertices']
     triangles = t['triangles']
-    #offset = 0.01
-    for i in range(triangles.shape[0]):
-        mean_x = np.mean(nodes[triangles[i,:],0])
-        mean_y = np.mean(nodes[triangles[i,:],1])
-        mpl.text(mean_x, mean_y, '%d' % i)
-
-    edge2triangle = get_edge2triangle(t['triangles'])
-    print 'edge2triangle'
-    print edge2triangle
-
-    neighbors, neighbor_angles = get_neighbors(node_list, crease_list) 
-    i = 4
-    angle = 15
-    crease_angles = [angle, 180, angle, None, angle, 180, angle, None]
-    ans = solve_node(neighbor_angles[i], crease_angles)
-    crease_angles = ans[0]
-    known_creases = {}
-    known_creases = add_node_creases(known_creases, i, neighbors[i], crease_angles)
-    known_creases = add_flat_creases(known_creases, triangles)
-    print known_creases
+    nf = len(driver_schedule)
+    shape = (nf, vertices.shape[0], 3)
+    if output is None:
+        shared = multiprocessing.RawArray('d', nf * shape[1] * 3)
+    else:
+        shared = str(output)
+        np.lib.format.open_memmap(shared, mode='w+', dtype='float64',
+            shape=shape).flush()
+    initargs = (node_list, crease_list, vertices, triangles,
+        list(driver_schedule), shared, triangle_index, collisions)
+    ranges = [(i, min(i + chunk_size, nf)) for i in range(0, nf, chunk_size)]
+
+    if processes == 1:
+        _animate_init(*initargs)
+        results = [_animate_frames(r) for r in ranges]
+        _animate_state.clear()
+    else:
+        pool = multiprocessing.Pool(processes, _animate_init, initargs)
+        try:
+            results = pool.map(_animate_frames, ranges)
+        finally:
+            pool.close()
+            pool.join()
+
+    failed = [f for result in results for f in result]
+    if output is None:
+        nodes3d = np.frombuffer(shared, dtype='float64').reshape(shape)
+    else:
+        nodes3d = np.load(shared, mmap_mode='r')
+    return nodes3d, failed
 
-    frames, nodes3d = propagate_frames(nodes, triangles, known_creases, triangle_index=0)
-    for i, n in enumerate(nodes3d):
-        print i, n
 
-    plot_creasepattern(nodes, crease_list, crease_types=crease_types, triangles=triangles)
+def _write_array(f, a, dtype):
+    a = np.ascontiguousarray(a, dtype=dtype)
+    a.tofile(f)
+    return a.nbytes
 
 
-if __name__ == "__main__":
-    #foo()
-    #foo2()
-    foo3()
-    #unittest.main()
+def export_gltf(filename, nodes3d, triangles, frame_rate=24.0,
+        chunk_size=64):
+    """
+    Write an animation to filename (a .gltf file) and its binary buffer
+    (the same name, ending in .bin).  nodes3d has shape (frames, nodes, 3),
+    and may be the name of a .npy file as written by animate, which is then
+    read through a memory map.  triangles gives the index buffer.
+
+    The first frame is the base mesh, and each later frame is a morph
+    target; the animation moves the weight linearly from one target to the
+    next at frame_rate frames per second.  Frames are copied chunk_size at
+    a time, so only one chunk is in memory at once.  Unsolved (nan) nodes
+    are left at their base positions.
+    """
+    if isinstance(nodes3d, str):
+        nodes3d = np.load(nodes3d, mmap_mode='r')
+    nf, nn = nodes3d.shape[0], nodes3d.shape[1]
+    # Bounds are taken from the float32 values actually stored
+    base = np.nan_to_num(np.asarray(nodes3d[0], dtype='float64')).astype('<f4')
+    nt = nf - 1
+    root, ext = os.path.splitext(filename)
+    binname = root + '.bin'
+
+    views = []
+    accessors = []
+    def add_view(offset, length, target=None):
+        view = {'buffer': 0, 'byteOffset': offset, 'byteLength': length}
+        if target is not None:
+            view['target'] = target
+        views.append(view)
+        return len(views) - 1
+    def add_accessor(view, offset, component, count, kind, lo=None, hi=None):
+        accessor = {'bufferView': view, 'byteOffset': offset,
+            'componentType': component, 'count': count, 'type': kind}
+        if lo is not None:
+            accessor['min'] = [float(x) for x in lo]
+            accessor['max'] = [float(x) for x in hi]
+        accessors.append(accessor)
+        return len(accessors) - 1
+
+    with open(binname, 'wb') as f:
+        nbytes = _write_array(f, triangles, '<u4')
+        view = add_view(0, nbytes, 34963)
+        indices = add_accessor(view, 0, 5125, triangles.size, 'SCALAR')
+
+        start = nbytes
+        nbytes = _write_array(f, base, '<f4')
+        bounds = [(base.min(axis=0), base.max(axis=0))]
+        for i in range(1, nf, chunk_size):
+            chunk = np.asarray(nodes3d[i:i + chunk_size], dtype='float64')
+            chunk = chunk - base
+            chunk[np.isnan(chunk)] = 0
+            chunk = chunk.astype('<f4')
+            nbytes += _write_array(f, chunk, '<f4')
+            bounds.extend(zip(chunk.min(axis=1), chunk.max(axis=1)))
+        view = add_view(start, nbytes, 34962)
+        positions = [add_accessor(view, k * nn * 12, 5126, nn, 'VEC3', lo, hi)
+            for k, (lo, hi) in enumerate(bounds)]
+        start += nbytes
+
+        animations = []
+        if nt > 0:
+            times = (np.arange(nf) / float(frame_rate)).astype('<f4')
+            nbytes = _write_array(f, times, '<f4')
+            view = add_view(start, nbytes)
+            time_accessor = add_accessor(view, 0, 5126, nf, 'SCALAR', times[:1],
+                times[-1:])
+            start += nbytes
+            nbytes = 0
+            weights = np.zeros(nt, dtype='<f4')
+            for i in range(nf):
+                if i > 0:
+                    weights[i - 1] = 1
+                nbytes += _write_array(f, weights, '<f4')
+                if i > 0:
+                    weights[i - 1] = 0
+            view = add_view(start, nbytes)
+            weight_accessor = add_accessor(view, 0, 5126, nf * nt, 'SCALAR')
+            start += nbytes
+            animations.append({
+                'samplers': [{'input': time_accessor, 'output': weight_accessor,
+                    'interpolation': 'LINEAR'}],
+                'channels': [{'sampler': 0,
+                    'target': {'node': 0, 'path': 'weights'}}]})
+
+    primitive = {'attributes': {'POSITION': positions[0]},
+        'indices': indices, 'mode': 4}
+    mesh = {'primitives': [primitive]}
+    if nt > 0:
+        primitive['targets'] = [{'POSITION': k} for k in positions[1:]]
+        mesh['weights'] = [0.0] * nt
+    gltf = {
+        'asset': {'version': '2.0'},
+        'scene': 0,
+        'scenes': [{'nodes': [0]}],
+        'nodes': [{'mesh': 0}],
+        'meshes': [mesh],
+        'buffers': [{'uri': os.path.basename(binname), 'byteLength': start}],
+        'bufferViews': views,
+        'accessors': accessors,
+    }
+    if animations:
+        gltf['animations'] = animations
+    with open(filename, 'w') as f:
+        json.dump(gltf, f, indent=1, sort_keys=True)
+
+
+class TestAnimate(TwoNodeTestCase):
+    eps = 1e-12
+
+    def test1(self):
+        pattern = (self.nodes, self.creases, [''] * self.creases.shape[0])
+        schedule = [{(4, 7): angle} for angle in np.linspace(180, 100, 20)]
+        schedule[5] = {(4, 7): 160, (5, 9): 100}  # Overconstrained
+        for processes in (1, 2):
+            nodes3d, failed = animate(pattern, schedule, processes=processes,
+                chunk_size=3, collisions=True)
+            self.assertEqual(nodes3d.shape, (20, 12, 3))
+            self.assertEqual(failed, [(5, -2)])
+            self.assertTrue(np.all(np.isnan(nodes3d[5])))
+            t = triangulate_pattern(self.nodes, self.creases)
+            for i in (0, 7, 19):
+                expected = solve_frame(self.nodes, self.creases, t['vertices'],
+                    t['triangles'], schedule[i])
+                self.assertTrue(np.amax(np.fabs(nodes3d[i] - expected)) < self.eps)
+
+    def test2(self):
+        pattern = (self.nodes, self.creases, [''] * self.creases.shape[0])
+        schedule = [{(4, 7): angle} for angle in np.linspace(180, 100, 10)]
+        expected, failed = animate(pattern, schedule, processes=1)
+        dirname = tempfile.mkdtemp()
+        try:
+            npyname = os.path.join(dirname, 'frames.npy')
+            nodes3d, failed = animate(pattern, schedule, processes=2,
+                chunk_size=3, output=npyname)
+            self.assertTrue(isinstance(nodes3d, np.memmap))
+            self.assertTrue(np.amax(np.fabs(nodes3d - expected)) < self.eps)
+
+            gltfname = os.path.join(dirname, 'frames.gltf')
+            triangles = triangulate_pattern(self.nodes, self.creases)['triangles']
+            export_gltf(gltfname, npyname, triangles, chunk_size=4)
+            with open(gltfname) as f:
+                gltf = json.load(f)
+            data = np.fromfile(os.path.join(dirname, 'frames.bin'), dtype='u1')
+            self.assertEqual(data.size, gltf['buffers'][0]['byteLength'])
+            def read(k, dtype):
+                accessor = gltf['accessors'][k]
+                view = gltf['bufferViews'][accessor['bufferView']]
+                start = view['byteOffset'] + accessor['byteOffset']
+                size = accessor['count'] * {'VEC3': 3, 'SCALAR': 1}[accessor['type']]
+                return data[start:].view(dtype)[:size]
+            primitive = gltf['meshes'][0]['primitives'][0]
+            self.assertTrue(np.all(read(primitive['indices'], '<u4') ==
+                triangles.flatten()))
+            base = read(primitive['attributes']['POSITION'], '<f4').reshape((-1, 3))
+            self.assertEqual(len(primitive['targets']), 9)
+            for k in [primitive['attributes']['POSITION']] + [target['POSITION']
+                    for target in primitive['targets']]:
+                values = read(k, '<f4').reshape((-1, 3))
+                self.assertEqual(gltf['accessors'][k]['min'],
+                    values.min(axis=0).tolist())
+                self.assertEqual(gltf['accessors'][k]['max'],
+                    values.max(axis=0).tolist())
+            for i in (1, 9):
+                target = read(primitive['targets'][i - 1]['POSITION'], '<f4')
+                actual = base + target.reshape((-1, 3))
+                self.assertTrue(np.amax(np.fabs(actual - expected[i])) < 1e-4)
+            sampler = gltf['animations'][0]['samplers'][0]
+            weights = read(sampler['output'], '<f4').reshape((10, 9))
+            self.assertTrue(np.all(weights[1:] == np.eye(9)))
+        finally:
+            shutil.rmtree(dirname)
+
+
+class FoldModel(object):
+    """
+    A crease pattern compiled once for posing many times, as in an
+    animation.  Everything that depends only on the pattern is worked out
+    when the model is made and kept in read-only arrays:
+
+    vertices, triangles   the triangulation, from triangulate_pattern
+    indptr, indices       neighbors of each node, counter-clockwise, in CSR
+    sector_angles         form (see get_neighbors_csr)
+    edges                 every edge of the triangulation, numbered as in
+                          the crease table (these numbers are edge ids)
+    crease_ids            the edge id of each crease of crease_list
+    type_codes            1 for mountain, -1 for valley, 0 otherwise, per crease
+    plan                  the breadth-first traversal from build_traversal_plan
+    drivers               the driving creases, in the order pose takes them
+                          (KeyError if one is not an edge)
+
+    pose fills the same buffers every time: creases (a CreaseTable), frames
+    (triangles, 3, 3) and nodes3d (nodes, 3).  Their contents are replaced
+    by the next pose, so copy them to keep them.
+    """
+    __slots__ = ('node_list', 'crease_list', 'vertices', 'triangles',
+        'indptr', 'indices', 'sector_angles', 'neighbors', 'neighbor_angles',
+        'edges', 'crease_ids', 'type_codes', 'plan', 'drivers', 'driver_ids',
+        'triangle_ids', 'creases', 'previous', 'frames', 'nodes3d', 'posed')
+
+    def __init__(self, node_list, crease_list, crease_types=None,
+            drivers=None, triangle_index=0, cache_dir=None):
+        t = triangulate_pattern(node_list, crease_list, cache_dir=cache_dir)
+        self.node_list = node_list
+        self.crease_list = crease_list
+        self.vertices = t['vertices']
+        self.triangles = t['triangles']
+        self.indptr, self.indices, self.sector_angles = get_neighbors_csr(
+            node_list, crease_list, check=True)
+        self.neighbors, self.neighbor_angles = get_neighbors(node_list,
+            crease_list)
+        self.creases = make_crease_table(self.vertices, crease_list,
+            self.triangles)
+        self.previous = self.creases.copy()
+        self.edges = self.creases.edges
+        self.crease_ids = self.creases.index(crease_list)
+        if crease_types is None:
+            crease_types = [''] * crease_list.shape[0]
+        codes = {'M': 1, 'V': -1}
+        self.type_codes = np.array([codes.get(x.strip().upper(), 0)
+            for x in crease_types], dtype='int8')
+        self.plan = build_traversal_plan(self.vertices, self.triangles,
+            triangle_index)
+        self.drivers = [] if drivers is None else [tuple(e) for e in drivers]
+        self.driver_ids = self.creases.index(np.array(self.drivers,
+            dtype='int64').reshape((-1, 2)))
+        if np.any(self.driver_ids < 0):
+            raise KeyError(self.drivers[np.nonzero(self.driver_ids < 0)[0][0]])
+        self.triangle_ids = np.unique(self.creases.index(np.concatenate([
+            self.triangles[:,[0,1]], self.triangles[:,[1,2]],
+            self.triangles[:,[2,0]]])))
+        # vertices and triangles are already read-only (see
+        # triangulate_pattern)
+        for a in (self.indptr, self.indices, self.sector_angles, self.edges,
+                self.crease_ids, self.type_codes, self.driver_ids,
+                self.triangle_ids):
+            a.flags.writeable = False
+        self.frames = np.empty((self.triangles.shape[0], 3, 3))
+        self.nodes3d = np.empty((self.vertices.shape[0], 3))
+        self.posed = False
+
+    def pose(self, driver_angles, branch=0, follow=False):
+        """
+        Fold the paper.  driver_angles is either a sequence of angles for
+        the creases in drivers, or a hash from creases to angles.  Where a
+        node has two solutions, branch picks one (see solve_pattern), or with
+        follow, the one nearest the previous pose is used.
+
+        Returns nodes3d, filled in, or the error code from solve_node (and
+        then nodes3d is nan).  Creases that cannot be solved stay flat.
+        """
+        creases = self.creases
+        if follow and self.posed:
+            self.previous.angles[:] = creases.angles
+            self.previous.known[:] = creases.known
+        creases.known[:] = False
+        if isinstance(driver_angles, dict):
+            for edge, angle in driver_angles.items():
+                creases[edge] = angle
+        else:
+            creases.angles[self.driver_ids] = driver_angles
+            creases.known[self.driver_ids] = True
+        ans = solve_pattern(self.node_list, self.crease_list, creases,
+            self.neighbors, self.neighbor_angles, branch,
+            reference=self.previous if follow and self.posed else None)
+        if isinstance(ans, numbers.Number):
+            self.posed = False
+            self.nodes3d.fill(np.nan)
+            return ans
+        flat = self.triangle_ids[~creases.known[self.triangle_ids]]
+        creases.angles[flat] = 180
+        creases.known[flat] = True
+        propagate_frames(self.vertices, self.triangles, creases,
+            plan=self.plan, frames=self.frames, nodes3d=self.nodes3d,
+            by_level=True)
+        self.posed = True
+        return self.nodes3d
+
+
+class TestFoldModel(TwoNodeTestCase):
+    eps = 1e-12
 
+    def test1(self):
+        crease_types = [''] * 10 + ['M', '', 'V', '', '', '', '']
+        model = FoldModel(self.nodes, self.creases, crease_types,
+            drivers=[(4, 7)])
+        self.assertEqual(model.type_codes.tolist(),
+            [0] * 10 + [1, 0, -1, 0, 0, 0, 0])
+        self.assertEqual(model.edges[model.crease_ids[11]].tolist(), [4, 7])
+        self.assertRaises(AttributeError, setattr, model, 'extra', 1)
+        self.assertRaises(KeyError, FoldModel, self.nodes, self.creases,
+            drivers=[(4, 7), (0, 2)])
+        self.assertRaises(ValueError, model.indices.__setitem__, 0, 1)
+        buffers = (model.frames, model.nodes3d)
+        t = triangulate_pattern(self.nodes, self.creases)
+        for angle in (170, 140, 100):
+            nodes3d = model.pose([angle])
+            self.assertTrue(nodes3d is buffers[1])
+            self.assertTrue(model.frames is buffers[0])
+            expected = solve_frame(self.nodes, self.creases, t['vertices'],
+                t['triangles'], {(4, 7): angle})
+            self.assertTrue(np.amax(np.fabs(nodes3d - expected)) < self.eps)
+            nodes3d = model.pose({(4, 7): angle})
+            self.assertTrue(np.amax(np.fabs(nodes3d - expected)) < self.eps)
 
+    def test2(self):
+        model = FoldModel(self.nodes, self.creases, drivers=[(4, 7)])
+        # Following the previous pose keeps to the same branch
+        model.pose([160], branch=1)
+        expected = [model.creases[(4, j)] for j in self.neighbors[4]]
+        model.pose([159.5], follow=True)
+        actual = [model.creases[(4, j)] for j in self.neighbors[4]]
+        self.assertTrue(np.amax(np.fabs(_angle_difference(actual, expected))) < 5)
+        # Overconstrained
+        ans = model.pose({(4, 7): 160, (5, 9): 100})
+        self.assertEqual(ans, -2)
+        self.assertTrue(np.all(np.isnan(model.nodes3d)))
 
 
+if __name__ == "__main__":
+    unittest.main()